@@ -1,21 +1,69 @@
 import pandas as pd
+import numpy as np
 import logging
 import os
 import sys
+import pickle
+import hashlib
 import tempfile
-from datetime import datetime, timezone, timedelta
+import time
 from supabase import create_client, Client
 from dotenv import load_dotenv
 
+try:
+    import pyarrow.feather as feather
+except ImportError:  # Sem pyarrow a análise continua lendo o XLSX diretamente
+    feather = None
+
 # Carregar variáveis de ambiente
 load_dotenv()
 
 # Configuração de logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+BUCKET_NAME = "controle-de-bombas-suplen-files"
+
+# Diretório do cache em disco dos resultados (sobrevive a reinícios do processo)
+CACHE_DIR = os.getenv("CURATIVO_CACHE_DIR", os.path.join(".cache", "curativo"))
+
+# Sem o updated_at da planilha, um snapshot só é reaproveitado até esta idade (s)
+SNAPSHOT_MAX_AGE = int(os.getenv("CURATIVO_SNAPSHOT_MAX_AGE", "600"))
+
+# Colunas usadas nos KPIs; são as únicas gravadas no snapshot colunar
+TEXT_COLUMNS = ['Status Utili', 'Desc Produto', 'Nome Cli']
+DATE_COLUMNS = ['Dt Procedime', 'Dt Apont Uti']
+KPI_COLUMNS = TEXT_COLUMNS + ['Valor Cotado'] + DATE_COLUMNS
+
+SALES_STATUS = ['Utilizado', 'Finalizado']
+
+# Tabelas reduzidas das quais os KPIs são derivados: nome -> (chaves, só linhas de venda).
+# Cada uma cresce com a cardinalidade das próprias chaves, não com o número de linhas.
+KPI_TABLES = {
+    'status': (['Status Utili'], False),
+    'product': (['Status Utili', 'Desc Produto'], True),
+    'client': (['Nome Cli'], True),
+    'month': (['Month'], True),
+}
+COUNT_COLUMNS = ['rows', 'sales_count', 'days_count']
+
+# KPIs registrados: nome no dicionário de resultados -> função(tabelas de KPI_TABLES)
+KPI_REGISTRY = {}
+
+# Modo streaming: linhas por bloco lidas da planilha (memória limitada ao bloco;
+# blocos menores pagam mais o custo fixo de leitura e limpeza de cada bloco)
+STREAM_CHUNK_ROWS = int(os.getenv("CURATIVO_CHUNK_ROWS", "20000"))
+STREAM_DOWNLOAD_BLOCK = 1024 * 1024
+
+# Cache em memória: caminho no Storage -> {'last_updated': ..., 'results': ...}
+_results_cache = {}
+_supabase_client = None
+
 # Inicializar Supabase
 def init_supabase():
-    """Inicializa o cliente Supabase e retorna o cliente de armazenamento."""
+    """Inicializa o cliente Supabase (uma vez por processo) e o retorna."""
+    global _supabase_client
+    if _supabase_client is not None:
+        return _supabase_client
     try:
         supabase_url = os.getenv("SUPABASE_URL")
         supabase_key = os.getenv("SUPABASE_KEY")
@@ -25,6 +73,7 @@ def init_supabase():
 
         supabase: Client = create_client(supabase_url, supabase_key)
         logging.info("Supabase inicializado com sucesso.")
+        _supabase_client = supabase
         return supabase
     except Exception as e:
         logging.error(f"Erro ao inicializar Supabase: {e}")
@@ -33,8 +82,7 @@ def init_supabase():
 def download_file_from_storage(supabase, storage_path, local_path):
     """Baixa um arquivo do Supabase Storage para um caminho local."""
     try:
-        bucket_name = "controle-de-bombas-suplen-files"
-        response = supabase.storage.from_(bucket_name).download(storage_path)
+        response = supabase.storage.from_(BUCKET_NAME).download(storage_path)
         with open(local_path, "wb") as f:
             f.write(response)
         logging.info(f"Arquivo {storage_path} baixado para {local_path}")
@@ -43,11 +91,479 @@ def download_file_from_storage(supabase, storage_path, local_path):
         logging.error(f"Erro ao baixar {storage_path}: {e}")
         return False
 
-def analyze_curativo(file_path='analise/bdcurativo.xlsx'):
+def stream_file_from_storage(supabase, storage_path, local_path):
+    """
+    Baixa um arquivo do Supabase Storage em blocos através de uma URL assinada,
+    sem manter o conteúdo inteiro em memória. Usa o download simples se falhar.
+    """
+    try:
+        import httpx
+        signed = supabase.storage.from_(BUCKET_NAME).create_signed_url(storage_path, 300)
+        signed_url = signed.get('signedURL') or signed.get('signedUrl')
+        with httpx.stream("GET", signed_url, timeout=60) as response:
+            response.raise_for_status()
+            with open(local_path, "wb") as f:
+                for block in response.iter_bytes(STREAM_DOWNLOAD_BLOCK):
+                    f.write(block)
+        logging.info(f"Arquivo {storage_path} baixado em streaming para {local_path}")
+        return True
+    except Exception as e:
+        logging.warning(f"Download em streaming de {storage_path} falhou ({e}); usando download simples.")
+        return download_file_from_storage(supabase, storage_path, local_path)
+
+def get_file_timestamp(supabase, storage_path):
+    """Retorna o campo updated_at do arquivo no Supabase Storage, ou None se indisponível."""
+    folder, file_name = os.path.split(storage_path)
+    try:
+        file_list = supabase.storage.from_(BUCKET_NAME).list(path=folder)
+        for file_obj in file_list:
+            if file_obj['name'] == file_name:
+                logging.info(f"Timestamp do arquivo encontrado: {file_obj['updated_at']}")
+                return file_obj['updated_at']
+    except Exception as e:
+        logging.warning(f"Não foi possível obter os metadados do arquivo: {e}")
+    return None
+
+def _cache_path(storage_path, suffix='.pkl'):
+    """Caminho do arquivo de cache em disco para um arquivo do Storage."""
+    return os.path.join(CACHE_DIR, storage_path.replace('/', '_') + suffix)
+
+def _read_pickle(cache_file):
+    """Lê um objeto do cache em disco; None se não existir ou estiver ilegível."""
+    try:
+        with open(cache_file, 'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.warning(f"Erro ao ler cache em disco {cache_file}: {e}")
+        return None
+
+def _write_pickle(cache_file, obj):
+    """Grava um objeto no cache em disco de forma atômica."""
+    try:
+        os.makedirs(os.path.dirname(cache_file) or '.', exist_ok=True)
+        # Escreve em arquivo temporário e renomeia para não deixar cache corrompido
+        with open(cache_file + '.tmp', 'wb') as f:
+            pickle.dump(obj, f)
+        os.replace(cache_file + '.tmp', cache_file)
+    except Exception as e:
+        logging.warning(f"Erro ao salvar cache em disco {cache_file}: {e}")
+
+def load_cached_results(storage_path, last_updated):
+    """
+    Retorna os KPIs em cache para o arquivo se o timestamp coincidir, ou None.
+    Consulta primeiro a memória e depois o cache em disco.
+    """
+    if not last_updated:
+        return None
+    entry = _results_cache.get(storage_path)
+    if entry and entry['last_updated'] == last_updated:
+        return entry['results']
+    entry = _read_pickle(_cache_path(storage_path))
+    if not entry or entry.get('last_updated') != last_updated:
+        return None
+    _results_cache[storage_path] = entry
+    logging.info(f"KPIs de {storage_path} carregados do cache em disco.")
+    return entry['results']
+
+def save_cached_results(storage_path, last_updated, results):
+    """Guarda os KPIs em memória e em disco, indexados pelo timestamp do arquivo."""
+    if not last_updated:
+        return
+    entry = {'last_updated': last_updated, 'results': results}
+    _results_cache[storage_path] = entry
+    _write_pickle(_cache_path(storage_path), entry)
+
+def load_delta_state(storage_path, last_updated):
+    """
+    Estado da última versão agregada (colunas, linhas, hash e tabelas de KPI), se
+    for anterior a last_updated; sem os dois timestamps não há como ordenar as versões.
+    """
+    state = _read_pickle(_cache_path(storage_path, '.delta.pkl'))
+    if not state or not last_updated or not state.get('last_updated') or str(state['last_updated']) >= str(last_updated):
+        return None
+    return state
+
+def save_delta_state(storage_path, last_updated, state):
+    """Guarda o estado de aggregate_kpi_delta junto do cache de KPIs."""
+    if last_updated:
+        _write_pickle(_cache_path(storage_path, '.delta.pkl'), dict(state, last_updated=last_updated))
+
+def clean_curativo_df(df):
+    """
+    Aplica a limpeza da planilha e mantém apenas as colunas usadas nos KPIs. As
+    colunas originais ficam em df.attrs['source_columns'] (usadas na ingestão incremental).
+    """
+    source_columns = [str(col) for col in df.columns]
+    df = df[KPI_COLUMNS].copy()
+    df.attrs['source_columns'] = source_columns
+    # Textos numéricos na planilha viram str para que a coluna tenha um único tipo
+    for col in TEXT_COLUMNS:
+        if df[col].dtype == object:
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+    df['Valor Cotado'] = df['Valor Cotado'].replace('- 0', 0).replace('', 0)
+    df['Valor Cotado'] = pd.to_numeric(df['Valor Cotado'], errors='coerce').fillna(0)
+    for col in DATE_COLUMNS:
+        df[col] = pd.to_datetime(df[col], errors='coerce', dayfirst=True)
+    return df
+
+def read_curativo_xlsx(xlsx_path):
+    """Lê e limpa a planilha XLSX (caminho lento, via openpyxl) ou a exportação .csv."""
+    if xlsx_path.lower().endswith('.csv'):
+        return clean_curativo_df(pd.read_csv(xlsx_path))
+    return clean_curativo_df(pd.read_excel(xlsx_path))
+
+def _snapshot_path(storage_path):
+    """Caminho do snapshot colunar (Feather) de um arquivo do Storage."""
+    return os.path.join(CACHE_DIR, storage_path.replace('/', '_') + '.feather')
+
+def save_snapshot(df, snapshot_path, last_updated=None):
+    """
+    Grava o DataFrame já limpo como snapshot Feather (Arrow IPC, sem compressão
+    para permitir memory-map). O timestamp de origem vai nos metadados do schema.
+    """
+    if feather is None:
+        return False
+    try:
+        import pyarrow as pa
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        metadata = dict(table.schema.metadata or {})
+        metadata[b'last_updated'] = str(last_updated or '').encode()
+        table = table.replace_schema_metadata(metadata)
+        os.makedirs(os.path.dirname(snapshot_path) or '.', exist_ok=True)
+        feather.write_feather(table, snapshot_path + '.tmp', compression='uncompressed')
+        os.replace(snapshot_path + '.tmp', snapshot_path)
+        logging.info(f"Snapshot colunar gravado em {snapshot_path}")
+        return True
+    except Exception as e:
+        logging.warning(f"Erro ao gravar snapshot {snapshot_path}: {e}")
+        return False
+
+def load_snapshot(snapshot_path, last_updated=None, max_age=SNAPSHOT_MAX_AGE):
+    """
+    Carrega o snapshot via memory-map. Retorna None se não existir ou se foi
+    gerado a partir de outra versão da planilha (timestamp diferente). Sem o
+    timestamp da planilha não há como saber se o snapshot está atual: só é usado
+    se foi gravado há menos de max_age segundos.
+    """
+    if feather is None or not os.path.exists(snapshot_path):
+        return None
+    try:
+        if not last_updated:
+            age = time.time() - os.path.getmtime(snapshot_path)
+            if age > max_age:
+                logging.info(f"Snapshot {snapshot_path} ignorado: timestamp da planilha desconhecido e snapshot com {age:.0f}s.")
+                return None
+        table = feather.read_table(snapshot_path, memory_map=True)
+        snapshot_updated = (table.schema.metadata or {}).get(b'last_updated', b'').decode()
+        if last_updated and snapshot_updated != str(last_updated):
+            logging.info(f"Snapshot {snapshot_path} desatualizado ({snapshot_updated}).")
+            return None
+        return table.to_pandas()
+    except Exception as e:
+        logging.warning(f"Erro ao ler snapshot {snapshot_path}: {e}")
+        return None
+
+def ingest_curativo(xlsx_path, snapshot_path, last_updated=None):
+    """Converte a planilha XLSX em snapshot colunar uma única vez e retorna o DataFrame limpo."""
+    df = read_curativo_xlsx(xlsx_path)
+    save_snapshot(df, snapshot_path, last_updated)
+    return df
+
+def _group_sums(keys, values):
+    """
+    Soma cada coluna de `values` por combinação de `keys` com np.bincount. Vazios
+    (NaN/NaT) formam um grupo; as linhas saem na ordem de primeira aparição.
+    """
+    # Combina os códigos coluna a coluna; -1 (vazio) vira 0 para continuar sendo um grupo
+    group_ids = np.zeros(len(keys), dtype=np.int64)
+    for col in keys.columns:
+        codes, uniques = pd.factorize(keys[col])
+        group_ids, _ = pd.factorize(group_ids * (len(uniques) + 1) + codes + 1)
+    n_groups = int(group_ids.max()) + 1 if len(group_ids) else 0
+    _, first_rows = np.unique(group_ids, return_index=True)
+
+    table = {col: keys[col].iloc[first_rows].reset_index(drop=True) for col in keys.columns}
+    for name, weights in values.items():
+        sums = np.bincount(group_ids, weights=weights, minlength=n_groups)
+        table[name] = sums.astype(np.int64) if name in COUNT_COLUMNS else sums
+    return pd.DataFrame(table)
+
+def aggregate_kpi_rows(df):
+    """
+    Agrega a planilha limpa numa única passada nas tabelas de KPI_TABLES: por
+    status, por status/produto, por cliente e por mês do procedimento (as três
+    últimas só com as linhas de venda).
+    Returns:
+        dict: nome -> pd.DataFrame com as chaves da tabela + rows, sales_count,
+        revenue, days_sum e days_count.
+    """
+    keys = df[TEXT_COLUMNS].copy()
+    keys['Month'] = df['Dt Procedime'].dt.to_period('M')
+    days = (df['Dt Apont Uti'] - df['Dt Procedime']).dt.days.to_numpy(dtype=float)
+    has_days = ~np.isnan(days)
+    values = {
+        'rows': np.ones(len(df)),
+        'sales_count': df['Desc Produto'].notna().to_numpy(dtype=float),
+        'revenue': df['Valor Cotado'].to_numpy(dtype=float),
+        'days_sum': np.where(has_days, days, 0),
+        'days_count': has_days.astype(float),
+    }
+    is_sale = df['Status Utili'].isin(SALES_STATUS).to_numpy()
+    tables = {}
+    for name, (columns, sales_only) in KPI_TABLES.items():
+        if sales_only:
+            tables[name] = _group_sums(keys.loc[is_sale, columns], {col: v[is_sale] for col, v in values.items()})
+        else:
+            tables[name] = _group_sums(keys[columns], values)
+    return tables
+
+def kpi(name):
+    """Registra uma função de KPI calculada a partir das tabelas agregadas."""
+    def register(func):
+        KPI_REGISTRY[name] = func
+        return func
+    return register
+
+def compute_kpis(kpi_tables):
+    """Calcula todos os KPIs registrados a partir das tabelas de aggregate_kpi_rows."""
+    return {name: func(kpi_tables) for name, func in KPI_REGISTRY.items()}
+
+# KPI 1: Porcentagem de vendas por status
+@kpi('status_df')
+def _kpi_status(kpi_tables):
+    status_counts = kpi_tables['status'].groupby('Status Utili', sort=False)['rows'].sum().sort_values(ascending=False, kind='stable')
+    status_percentages = (status_counts / status_counts.sum() * 100).round(2)
+    return pd.DataFrame({
+        'Status': status_percentages.index,
+        'Percentage': status_percentages.values
+    })
+
+# KPI 2: Top 5 produtos mais vendidos
+@kpi('product_df')
+def _kpi_top_products(kpi_tables):
+    product_counts = kpi_tables['product'].groupby('Desc Produto', sort=False)['rows'].sum().sort_values(ascending=False, kind='stable').head(5)
+    return pd.DataFrame({
+        'Product': product_counts.index,
+        'Count': product_counts.values
+    })
+
+# KPI 3: Receita por status
+@kpi('revenue_status_df')
+def _kpi_revenue_status(kpi_tables):
+    revenue_by_status = kpi_tables['status'].groupby('Status Utili')['revenue'].sum().round(2)
+    return pd.DataFrame({
+        'Status': revenue_by_status.index,
+        'Revenue': revenue_by_status.values
+    })
+
+# KPI 4: Receita por produto (Finalizado)
+@kpi('revenue_product_df')
+def _kpi_revenue_product(kpi_tables):
+    products = kpi_tables['product']
+    finalized = products[products['Status Utili'] == 'Finalizado']
+    revenue_by_product = finalized.groupby('Desc Produto')['revenue'].sum().nlargest(5).round(2)
+    return pd.DataFrame({
+        'Product': revenue_by_product.index,
+        'Revenue': revenue_by_product.values
+    })
+
+# KPI 5: Desempenho por cliente
+@kpi('client_sales')
+def _kpi_client_sales(kpi_tables):
+    client_sales = kpi_tables['client'].groupby('Nome Cli')[['sales_count', 'revenue']].sum()
+    client_sales = client_sales.rename(columns={'sales_count': 'Sales Count', 'revenue': 'Revenue'}).nlargest(5, 'Sales Count')
+    client_sales['Revenue'] = client_sales['Revenue'].round(2)
+    return client_sales
+
+# KPI 6: Taxa de perda de estoque
+@kpi('loss_rate')
+def _kpi_loss_rate(kpi_tables):
+    status = kpi_tables['status']
+    non_found_count = int(status.loc[status['Status Utili'] == 'Não Encontrado', 'rows'].sum())
+    total_count = int(status['rows'].sum())
+    return round(non_found_count / total_count * 100, 2) if total_count > 0 else 0
+
+# KPI 7: Tempo médio de faturamento
+@kpi('avg_days_to_invoice')
+def _kpi_avg_days_to_invoice(kpi_tables):
+    status = kpi_tables['status']
+    finalized = status[status['Status Utili'] == 'Finalizado']
+    if finalized.empty:
+        return 0
+    days_count = finalized['days_count'].sum()
+    return np.float64(finalized['days_sum'].sum() / days_count).round(2) if days_count > 0 else np.nan
+
+# KPI 8: Vendas por mês
+@kpi('sales_by_month')
+def _kpi_sales_by_month(kpi_tables):
+    sales_by_month = kpi_tables['month'].groupby('Month')[['sales_count', 'revenue']].sum()
+    sales_by_month = sales_by_month.rename(columns={'sales_count': 'Sales Count', 'revenue': 'Revenue'})
+    sales_by_month['Revenue'] = sales_by_month['Revenue'].round(2)
+    return sales_by_month
+
+def iter_curativo_chunks(path, chunk_rows=STREAM_CHUNK_ROWS):
+    """
+    Lê a planilha em blocos de até chunk_rows linhas, já limpos. XLSX é lido com
+    openpyxl em modo read-only (linha a linha); arquivos .csv com read_csv em chunks.
+    """
+    if path.lower().endswith('.csv'):
+        header = [str(col) for col in pd.read_csv(path, nrows=0).columns]
+        for chunk in pd.read_csv(path, usecols=KPI_COLUMNS, chunksize=chunk_rows):
+            chunk = clean_curativo_df(chunk)
+            chunk.attrs['source_columns'] = header
+            yield chunk
+        return
+
+    from openpyxl import load_workbook
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = list(next(rows, None) or [])
+        missing = [col for col in KPI_COLUMNS if col not in header]
+        if missing:
+            raise KeyError(f"Colunas ausentes na planilha: {missing}")
+        indexes = [header.index(col) for col in KPI_COLUMNS]
+        source_columns = [str(col) for col in header]
+        buffer = []
+        blank_rows = 0
+        for row in rows:
+            # Linhas vazias só contam se houver dados depois (como no pd.read_excel)
+            if all(value is None for value in row):
+                blank_rows += 1
+                continue
+            buffer.extend([[None] * len(KPI_COLUMNS)] * blank_rows)
+            blank_rows = 0
+            buffer.append([row[i] if i < len(row) else None for i in indexes])
+            if len(buffer) >= chunk_rows:
+                yield _clean_buffer(buffer, source_columns)
+                buffer = []
+        if buffer:
+            yield _clean_buffer(buffer, source_columns)
+    finally:
+        workbook.close()
+
+def _clean_buffer(buffer, source_columns):
+    """Bloco de linhas lidas com openpyxl, limpo e com as colunas originais da planilha."""
+    chunk = clean_curativo_df(pd.DataFrame(buffer, columns=KPI_COLUMNS))
+    chunk.attrs['source_columns'] = source_columns
+    return chunk
+
+def merge_kpi_tables(*kpi_tables):
+    """
+    Soma resultados de aggregate_kpi_rows tabela a tabela, preservando a ordem de
+    primeira aparição das chaves. O custo depende do tamanho das tabelas, não das linhas lidas.
+    """
+    merged = {}
+    for name, (columns, _) in KPI_TABLES.items():
+        combined = pd.concat([tables[name] for tables in kpi_tables], ignore_index=True)
+        merged[name] = combined.groupby(columns, sort=False, dropna=False).sum().reset_index()
+    return merged
+
+def aggregate_kpi_stream(path, chunk_rows=STREAM_CHUNK_ROWS):
+    """
+    Agrega a planilha em modo streaming: cada bloco é reduzido com aggregate_kpi_rows
+    e somado aos acumuladores. Cada acumulador fica limitado à cardinalidade das
+    próprias chaves (status, produtos, clientes, meses); os top-N saem só no final.
+    Os blocos reduzidos só são somados quando já têm o tamanho do acumulador, para
+    não regroupar uma tabela grande de clientes a cada bloco.
+    """
+    kpi_tables = None
+    pending = []
+    for chunk in iter_curativo_chunks(path, chunk_rows):
+        pending.append(aggregate_kpi_rows(chunk))
+        kpi_tables, pending = _merge_pending(kpi_tables, pending)
+    kpi_tables, _ = _merge_pending(kpi_tables, pending, force=True)
+    if kpi_tables is None:
+        kpi_tables = aggregate_kpi_rows(clean_curativo_df(pd.DataFrame(columns=KPI_COLUMNS)))
+    return kpi_tables
+
+def _merge_pending(kpi_tables, pending, force=False):
+    """Soma os blocos pendentes ao acumulador quando já têm o tamanho dele (ou se force)."""
+    if pending and (force or kpi_tables is None or _tables_size(pending) >= _tables_size([kpi_tables])):
+        return merge_kpi_tables(*([kpi_tables] if kpi_tables else []), *pending), []
+    return kpi_tables, pending
+
+def _tables_size(kpi_tables):
+    """Total de linhas numa lista de resultados de aggregate_kpi_rows."""
+    return sum(len(table) for tables in kpi_tables for table in tables.values())
+
+def _row_hashes(df):
+    """Hash de cada linha nas colunas de KPI; não depende de como a planilha foi dividida em blocos."""
+    hashes = np.zeros(len(df), dtype=np.uint64)
+    for col in KPI_COLUMNS:
+        if col in TEXT_COLUMNS:
+            # Textos: hash só dos valores distintos; vazio (NaN/None, em coluna object ou float) vale 0
+            codes, uniques = pd.factorize(df[col])
+            unique_hashes = pd.util.hash_array(np.array([str(value) for value in uniques], dtype=object))
+            col_hashes = np.append(unique_hashes, np.uint64(0))[codes]
+        else:
+            col_hashes = pd.util.hash_array(df[col].to_numpy())
+        hashes = hashes * np.uint64(1000003) ^ col_hashes
+    return hashes
+
+def aggregate_kpi_delta(chunks, state=None):
+    """
+    Agrega uma nova versão da planilha a partir do estado da anterior (delta_state).
+    As state['rows'] primeiras linhas só são conferidas pelo hash; apenas as linhas
+    acrescentadas depois delas são agregadas e somadas às tabelas guardadas. Como as
+    linhas antigas vêm antes, a ordem de primeira aparição (e os empates dos top-N)
+    é a mesma de agregar a planilha inteira.
+    Args:
+        chunks: blocos já limpos da planilha, em ordem ([df] ou iter_curativo_chunks).
+        state (dict): estado da versão anterior; None agrega todas as linhas.
+    Returns:
+        tuple: (kpi_tables, estado da nova versão), ou None se a versão anterior não
+        é prefixo da nova (outras colunas, menos linhas ou linhas alteradas).
+    """
+    known = state['rows'] if state else 0
+    kpi_tables = state['kpi_tables'] if state else None
+    pending = []
+    hasher = hashlib.sha1()
+    rows = 0
+    source_columns = None
+    checked = state is None
+    for chunk in chunks:
+        if source_columns is None:
+            source_columns = chunk.attrs.get('source_columns')
+            if state and source_columns != state['source_columns']:
+                logging.info("Colunas da planilha mudaram; agregando a planilha inteira.")
+                return None
+        hashes = _row_hashes(chunk)
+        head = min(len(chunk), max(known - rows, 0))
+        hasher.update(hashes[:head].tobytes())
+        rows += len(chunk)
+        if head == len(chunk):
+            continue
+        if not checked:
+            if hasher.hexdigest() != state['digest']:
+                logging.info("Linhas já agregadas foram alteradas; agregando a planilha inteira.")
+                return None
+            checked = True
+        hasher.update(hashes[head:].tobytes())
+        pending.append(aggregate_kpi_rows(chunk.iloc[head:]))
+        kpi_tables, pending = _merge_pending(kpi_tables, pending)
+    if not checked and (rows < known or hasher.hexdigest() != state['digest']):
+        logging.info(f"Planilha com {rows} linhas não contém as {known} já agregadas; agregando a planilha inteira.")
+        return None
+    kpi_tables, _ = _merge_pending(kpi_tables, pending, force=True)
+    if kpi_tables is None:
+        kpi_tables = aggregate_kpi_rows(clean_curativo_df(pd.DataFrame(columns=KPI_COLUMNS)))
+    if state:
+        logging.info(f"Planilha incremental: {rows - known} linhas novas agregadas ({known} reaproveitadas).")
+    return kpi_tables, {'source_columns': source_columns, 'rows': rows, 'digest': hasher.hexdigest(), 'kpi_tables': kpi_tables}
+
+def analyze_curativo(file_path='analise/bdcurativo.xlsx', streaming=None):
     """
     Analisa a planilha bdcurativo.xlsx do Supabase Storage e retorna KPIs para uso em dashboards.
+    O resultado fica em cache (memória e disco) até o updated_at do arquivo mudar.
+    Numa versão nova, só as linhas acrescentadas ao fim da planilha são agregadas
+    (aggregate_kpi_delta); qualquer outra mudança agrega a planilha inteira.
     Args:
-        file_path (str): Caminho do arquivo no Supabase Storage.
+        file_path (str): Caminho do arquivo no Supabase Storage (.xlsx ou .csv).
+        streaming (bool): Lê a planilha em blocos com memória limitada. Por padrão
+            usa a variável de ambiente CURATIVO_STREAMING.
     Returns:
         dict: Dicionário com DataFrames e KPIs.
     """
@@ -59,121 +575,107 @@ def analyze_curativo(file_path='analise/bdcurativo.xlsx'):
             return {"error": "Erro ao conectar ao Supabase Storage. Verifique as credenciais."}
 
         # **NOVA LÓGICA: Buscar metadados do arquivo para obter data de atualização**
-        last_updated_timestamp = None
-        bucket_name = "controle-de-bombas-suplen-files"
-        try:
-            file_list = supabase.storage.from_(bucket_name).list(path='analise')
-            for file_obj in file_list:
-                if file_obj['name'] == 'bdcurativo.xlsx':
-                    last_updated_timestamp = file_obj['updated_at']
-                    logging.info(f"Timestamp do arquivo encontrado: {last_updated_timestamp}")
-                    break
-        except Exception as e:
-            logging.warning(f"Não foi possível obter os metadados do arquivo: {e}")
-
-
-        # Criar arquivo temporário para armazenar o download
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.xlsx') as temp_file:
-            temp_path = temp_file.name
-
-        # Baixar o arquivo do Storage
-        if not download_file_from_storage(supabase, file_path, temp_path):
-            logging.error(f"Arquivo {file_path} não encontrado no Supabase Storage.")
-            return {"error": f"Arquivo {file_path} não encontrado no Supabase Storage."}
-
-        # Ler a planilha
-        df = pd.read_excel(temp_path)
-
-        # Remover arquivo temporário
-        try:
-            os.remove(temp_path)
-            logging.info(f"Arquivo temporário {temp_path} removido.")
-        except Exception as e:
-            logging.warning(f"Erro ao remover arquivo temporário {temp_path}: {e}")
-
-        # Limpeza de dados
-        df['Valor Cotado'] = df['Valor Cotado'].replace('- 0', 0).replace('', 0)
-        df['Valor Cotado'] = pd.to_numeric(df['Valor Cotado'], errors='coerce').fillna(0)
-        date_columns = ['Dt Procedime', 'Dt Apont Uti']
-        for col in date_columns:
-            df[col] = pd.to_datetime(df[col], errors='coerce', dayfirst=True)
-
-        # KPI 1: Porcentagem de vendas por status
-        status_counts = df['Status Utili'].value_counts()
-        status_percentages = (status_counts / status_counts.sum() * 100).round(2)
-        status_df = pd.DataFrame({
-            'Status': status_percentages.index,
-            'Percentage': status_percentages.values
-        })
+        last_updated_timestamp = get_file_timestamp(supabase, file_path)
 
-        # KPI 2: Top 5 produtos mais vendidos
-        sales_df = df[df['Status Utili'].isin(['Utilizado', 'Finalizado'])]
-        product_counts = sales_df['Desc Produto'].value_counts().head(5)
-        product_df = pd.DataFrame({
-            'Product': product_counts.index, 
-            'Count': product_counts.values
-        })
+        cached_results = load_cached_results(file_path, last_updated_timestamp)
+        if cached_results is not None:
+            logging.info(f"KPIs de {file_path} reaproveitados do cache ({last_updated_timestamp}).")
+            return cached_results
 
-        # KPI 3: Receita por status
-        revenue_by_status = df.groupby('Status Utili')['Valor Cotado'].sum().round(2)
-        revenue_status_df = pd.DataFrame({
-            'Status': revenue_by_status.index,
-            'Revenue': revenue_by_status.values
-        })
+        if streaming is None:
+            streaming = os.getenv("CURATIVO_STREAMING", "").lower() in ("1", "true", "sim")
 
-        # KPI 4: Receita por produto (Finalizado)
-        finalized_df = df[df['Status Utili'] == 'Finalizado']
-        revenue_by_product = finalized_df.groupby('Desc Produto')['Valor Cotado'].sum().nlargest(5).round(2)
-        revenue_product_df = pd.DataFrame({
-            'Product': revenue_by_product.index,
-            'Revenue': revenue_by_product.values
-        })
+        # Usa o snapshot colunar quando existe; senão baixa o arquivo
+        snapshot_path = _snapshot_path(file_path)
+        kpi_tables = None
+        df = None if streaming else load_snapshot(snapshot_path, last_updated_timestamp)
+        if df is not None:
+            logging.info(f"Planilha carregada do snapshot {snapshot_path}")
+        else:
+            # Criar arquivo temporário para armazenar o download
+            with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(file_path)[1]) as temp_file:
+                temp_path = temp_file.name
+
+            # Baixar o arquivo do Storage
+            download = stream_file_from_storage if streaming else download_file_from_storage
+            if not download(supabase, file_path, temp_path):
+                logging.error(f"Arquivo {file_path} não encontrado no Supabase Storage.")
+                return {"error": f"Arquivo {file_path} não encontrado no Supabase Storage."}
 
-        # KPI 5: Desempenho por cliente
-        client_sales = sales_df.groupby('Nome Cli').agg({
-            'Desc Produto': 'count',
-            'Valor Cotado': 'sum'
-        }).rename(columns={'Desc Produto': 'Sales Count', 'Valor Cotado': 'Revenue'}).nlargest(5, 'Sales Count')
-        client_sales['Revenue'] = client_sales['Revenue'].round(2)
-
-        # KPI 6: Taxa de perda de estoque
-        non_found_count = df[df['Status Utili'] == 'Não Encontrado'].shape[0]
-        total_count = df.shape[0]
-        loss_rate = round(non_found_count / total_count * 100, 2) if total_count > 0 else 0
-
-        # KPI 7: Tempo médio de faturamento
-        finalized_df = finalized_df.copy()
-        finalized_df['Days to Invoice'] = (finalized_df['Dt Apont Uti'] - finalized_df['Dt Procedime']).dt.days
-        avg_days_to_invoice = finalized_df['Days to Invoice'].mean().round(2) if not finalized_df.empty else 0
-
-        # KPI 8: Vendas por mês
-        sales_df = sales_df.copy()
-        sales_df['Month'] = sales_df['Dt Procedime'].dt.to_period('M')
-        sales_by_month = sales_df.groupby('Month').agg({
-            'Desc Produto': 'count',
-            'Valor Cotado': 'sum'
-        }).rename(columns={'Desc Produto': 'Sales Count', 'Valor Cotado': 'Revenue'})
-        sales_by_month['Revenue'] = sales_by_month['Revenue'].round(2)
+            try:
+                # Só as linhas acrescentadas desde a versão anterior são agregadas; se ela
+                # não é prefixo desta, a planilha inteira é agregada de novo
+                state = load_delta_state(file_path, last_updated_timestamp)
+                if streaming:
+                    # Agrega bloco a bloco, sem carregar a planilha inteira
+                    delta = state and aggregate_kpi_delta(iter_curativo_chunks(temp_path), state)
+                    delta = delta or aggregate_kpi_delta(iter_curativo_chunks(temp_path))
+                else:
+                    # Ler e limpar a planilha, gravando o snapshot para as próximas análises
+                    df = ingest_curativo(temp_path, snapshot_path, last_updated_timestamp)
+                    delta = (state and aggregate_kpi_delta([df], state)) or aggregate_kpi_delta([df])
+                kpi_tables, state = delta
+                save_delta_state(file_path, last_updated_timestamp, state)
+            finally:
+                # Remover arquivo temporário
+                try:
+                    os.remove(temp_path)
+                    logging.info(f"Arquivo temporário {temp_path} removido.")
+                except Exception as e:
+                    logging.warning(f"Erro ao remover arquivo temporário {temp_path}: {e}")
+
+        # Todos os KPIs saem das tabelas reduzidas de uma única agregação da planilha
+        if kpi_tables is None:
+            kpi_tables = aggregate_kpi_rows(df)
+        results = compute_kpis(kpi_tables)
 
         logging.info("Análise da planilha concluída com sucesso.")
-        return {
-            'status_df': status_df,
-            'product_df': product_df,
-            'revenue_status_df': revenue_status_df,
-            'revenue_product_df': revenue_product_df,
-            'client_sales': client_sales,
-            'loss_rate': loss_rate,
-            'avg_days_to_invoice': avg_days_to_invoice,
-            'sales_by_month': sales_by_month,
+        results.update({
             'error': None,
             'last_updated': last_updated_timestamp  # **NOVA INFORMAÇÃO RETORNADA**
-        }
+        })
+        save_cached_results(file_path, last_updated_timestamp, results)
+        return results
 
     except Exception as e:
         logging.error(f"Erro na análise da planilha: {e}")
         return {"error": f"Erro na análise: {str(e)}"}
 
+def benchmark_snapshot(n_rows=50000):
+    """Compara a leitura a frio do XLSX com a carga do snapshot numa planilha sintética."""
+    rng = np.random.default_rng(0)
+    dates = pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 365, n_rows), unit='D')
+    df = pd.DataFrame({
+        'Status Utili': rng.choice(['Utilizado', 'Finalizado', 'Disponível', 'Não Encontrado'], n_rows),
+        'Desc Produto': rng.choice([f'PRODUTO {i}' for i in range(50)], n_rows),
+        'Nome Cli': rng.choice([f'CLIENTE {i}' for i in range(500)], n_rows),
+        'Valor Cotado': rng.choice(['- 0', '', '150.5', '89.9'], n_rows),
+        'Dt Procedime': dates.strftime('%d/%m/%Y'),
+        'Dt Apont Uti': (dates + pd.Timedelta(days=10)).strftime('%d/%m/%Y'),
+    })
+    with tempfile.TemporaryDirectory() as temp_dir:
+        xlsx_path = os.path.join(temp_dir, 'bdcurativo.xlsx')
+        snapshot_path = os.path.join(temp_dir, 'bdcurativo.feather')
+        df.to_excel(xlsx_path, index=False)
+
+        start = time.perf_counter()
+        ingest_curativo(xlsx_path, snapshot_path)
+        xlsx_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        load_snapshot(snapshot_path)
+        snapshot_seconds = time.perf_counter() - start
+
+    print(f"Linhas: {n_rows}")
+    print(f"XLSX (leitura + limpeza): {xlsx_seconds:.3f}s")
+    print(f"Snapshot Feather (memory-map): {snapshot_seconds:.3f}s")
+    if snapshot_seconds > 0:
+        print(f"Ganho: {xlsx_seconds / snapshot_seconds:.1f}x")
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--benchmark":
+        benchmark_snapshot(int(sys.argv[2]) if len(sys.argv) > 2 else 50000)
+        sys.exit(0)
     results = analyze_curativo()
     if not results.get('error'):
         print("KPI 1: Porcentagem de Vendas por Status:")
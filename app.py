@@ -1,14 +1,18 @@
 import streamlit as st
+import asyncio
 import json
+import re
 import os
 import sys
 import logging
 import tempfile
+import threading
+import time
+import zipfile
 from datetime import datetime, timedelta, timezone
 import pandas as pd
+import numpy as np
 from io import BytesIO
-from docx import Document
-from PyPDF2 import PdfMerger
 import plotly.express as px
 import folium
 from streamlit_folium import st_folium
@@ -16,7 +20,12 @@ import unicodedata
 from supabase import create_client, Client
 from dotenv import load_dotenv
 from analyze_curativo import analyze_curativo
-import subprocess
+import contract_pdf
+import storage_client
+import search_index
+import event_writer
+import text_normalize
+from text_normalize import normalize_text
 
 
 
@@ -116,12 +125,21 @@ FILIAIS = ["BRASILIA", "GOIANIA", "CUIABA"]
 CONTRATO_LOCAL_PATH = "contrato.docx"
 CONTRATO_STORAGE_PATH = "contratos/contrato.docx"
 MAINTENANCE_STORAGE_PATH = "nfs/"
+# "rpc" usa a função dashboard_metrics do Postgres, "pandas" calcula no app;
+# "auto" tenta a RPC e volta para o pandas se ela não estiver disponível.
+DASHBOARD_METRICS_BACKEND = os.getenv("DASHBOARD_METRICS_BACKEND", "auto").lower()
 
-# Função para normalizar texto
-def normalize_text(text):
-    if not isinstance(text, str):
-        return ""
-    return unicodedata.normalize('NFKD', text).encode('ASCII', 'ignore').decode('ASCII').upper().strip()
+# Limite de entradas do memo de normalização (evita crescer sem fim)
+NORMALIZED_MEMO_MAX = 200_000
+
+@st.cache_resource
+def _normalized_text_memo():
+    """Memo por processo (valor original -> normalize_text(valor)), compartilhado entre sessões."""
+    return text_normalize.NormalizedTextMemo(NORMALIZED_MEMO_MAX)
+
+def normalize_series(values):
+    """normalize_text vetorizado para uma Series, com o memo do processo."""
+    return _normalized_text_memo().series(values)
 
 # --- INÍCIO DA NOVA FUNÇÃO CENTRALIZADA PARA DATAS ---
 def parse_supabase_date(date_string: str | None) -> datetime | None:
@@ -162,22 +180,58 @@ def init_supabase():
         st.stop()
 supabase = init_supabase()
 
+# -------------------- INVALIDAÇÃO DE CACHE --------------------
+# Loaders em cache por dependência: nome da tabela ou "storage:<prefixo>" -> funções
+_CACHE_DEPENDENCIES = {}
+
+def cached_loader(*dependencies, shared=False, **cache_kwargs):
+    """
+    Igual a st.cache_data, registrando as tabelas e prefixos do storage que a
+    função lê. Uma escrita chama invalidate_caches só com o que alterou.
+    Com shared=True usa st.cache_resource: o mesmo objeto é devolvido a todas
+    as sessões, sem cópia por chamada, e não deve ser alterado.
+    """
+    def decorator(func):
+        cache = st.cache_resource if shared else st.cache_data
+        cached = cache(**cache_kwargs)(func)
+        for dependency in dependencies:
+            _CACHE_DEPENDENCIES.setdefault(dependency, []).append(cached)
+        return cached
+    return decorator
+
+def invalidate_caches(*touched):
+    """Limpa apenas os loaders (e snapshots de tabela) que dependem de `touched`."""
+    for dependency in touched:
+        for cached in _CACHE_DEPENDENCIES.get(dependency, []):
+            cached.clear()
+        if not dependency.startswith("storage:"):
+            get_table_snapshots().invalidate(dependency)
+    logging.info(f"Caches invalidados para: {', '.join(touched)}")
+
 # -------------------- FUNÇÕES AUXILIARES OTIMIZADAS --------------------
-@st.cache_data(ttl=300)
-def download_file_from_storage(storage_path):
+@st.cache_resource
+def get_storage_client():
+    """Cliente do bucket compartilhado pelas sessões: downloads em paralelo, com novas tentativas."""
+    return storage_client.StorageClient(supabase.storage, "controle-de-bombas-suplen-files")
+
+def fetch_storage_file(storage_path):
+    """Baixa direto do storage, sem st.cache_data (pode rodar fora da thread da sessão)."""
     try:
-        bucket_name = "controle-de-bombas-suplen-files"
-        response = supabase.storage.from_(bucket_name).download(storage_path)
+        response = get_storage_client().download(storage_path)
+        if response is None:
+            logging.warning(f"Arquivo não encontrado no storage: {storage_path}")
+            return None
         logging.info(f"Arquivo {storage_path} baixado com sucesso.")
         return response
     except Exception as e:
-        if "Object not found" in str(e):
-            logging.warning(f"Arquivo não encontrado no storage: {storage_path}")
-            return None
         logging.error(f"Erro ao baixar {storage_path}: {str(e)}")
         return None
 
-@st.cache_data(ttl=300)
+@cached_loader("storage:contratos/", "storage:pdfs/", ttl=300)
+def download_file_from_storage(storage_path):
+    return fetch_storage_file(storage_path)
+
+@cached_loader("DADOS_BOMBAS", ttl=300)
 def get_dados_bombas_df():
     try:
         response = supabase.table("DADOS_BOMBAS").select("Serial, Modelo, Ultima_Manut, Venc_Manut").execute()
@@ -186,7 +240,7 @@ def get_dados_bombas_df():
             logging.warning("A tabela DADOS_BOMBAS está vazia ou não foi encontrada.")
             return pd.DataFrame(columns=['Serial', 'Modelo', 'Ultima_Manut', 'Venc_Manut'])
         df = pd.DataFrame(data)
-        df['Serial_Normalized'] = df['Serial'].apply(normalize_text)
+        df['Serial_Normalized'] = normalize_series(df['Serial'])
         df['Ultima_Manut'] = pd.to_datetime(df['Ultima_Manut'], errors='coerce')
         df['Venc_Manut'] = pd.to_datetime(df['Venc_Manut'], errors='coerce')
         logging.info("Dados da tabela DADOS_BOMBAS (tipo DATE) carregados com sucesso.")
@@ -196,6 +250,239 @@ def get_dados_bombas_df():
         st.error(f"Não foi possível carregar os dados de manutenção das bombas: {e}")
         return pd.DataFrame()
 
+EQUIPMENT_COLUMNS = ['Modelo', 'modelo', 'ultima_manut', 'venc_manut']
+
+@cached_loader("DADOS_BOMBAS", shared=True, ttl=300)
+def get_equipment_index():
+    """
+    Índice serial normalizado -> Modelo e datas de manutenção já formatadas,
+    montado uma vez por carga de DADOS_BOMBAS. Seriais repetidos na tabela
+    ficam com a primeira linha.
+    """
+    dados_bombas_df = get_dados_bombas_df()
+    if dados_bombas_df.empty:
+        return pd.DataFrame(columns=EQUIPMENT_COLUMNS)
+    dados = dados_bombas_df.drop_duplicates('Serial_Normalized').set_index('Serial_Normalized')
+    return pd.DataFrame({
+        'Modelo': dados['Modelo'],
+        'modelo': dados['Modelo'].fillna('N/A'),
+        'ultima_manut': dados['Ultima_Manut'].dt.strftime('%d/%m/%Y').fillna('N/A'),
+        'venc_manut': dados['Venc_Manut'].dt.strftime('%d/%m/%Y').fillna('N/A'),
+    }, index=dados.index)
+
+def lookup_equipment(serials):
+    """Busca no índice de equipamentos os seriais (já normalizados), na mesma ordem."""
+    found = get_equipment_index().reindex(serials.to_numpy())
+    found.index = serials.index
+    for column in ['modelo', 'ultima_manut', 'venc_manut']:
+        found[column] = found[column].fillna('N/A')
+    return found
+
+def enrich_with_equipment(df, serial_column='serial'):
+    """Preenche modelo, ultima_manut e venc_manut de df a partir do índice de equipamentos."""
+    found = lookup_equipment(normalize_series(df[serial_column]))
+    df['modelo'] = found['modelo']; df['ultima_manut'] = found['ultima_manut']; df['venc_manut'] = found['venc_manut']
+    return df
+
+# -------------------- SNAPSHOTS DAS TABELAS --------------------
+# Colunas pesquisáveis por tabela (TableSnapshots.search)
+SEARCH_FIELDS = {"bombas": ("serial", "paciente", "hospital"), "manutencao": ("serial", "defeito", "nf_numero"), "historico": ("data_evento", "descricao", "filial")}
+
+def search_documents(table, rows):
+    """Um texto por linha com as colunas pesquisáveis, datas como aparecem na tela."""
+    df = pd.DataFrame.from_records(rows, columns=list(SEARCH_FIELDS[table]))
+    documents = None
+    for field in df.columns:
+        values = df[field].where(df[field].notna(), "")
+        if field == "data_evento":
+            values = values.map({value: (parse_supabase_date(value).strftime("%d/%m/%Y, %H:%M") if parse_supabase_date(value) else value) for value in values.unique()})
+        values = values.astype(str)
+        documents = values if documents is None else documents + " " + values
+    return documents.tolist()
+
+class TableSnapshots:
+    """
+    Cópias em memória das tabelas do Supabase, compartilhadas entre sessões.
+    Cada combinação (tabela, filial, filtros) é lida uma vez por TTL; busca,
+    filtros e formatação de datas rodam sobre a cópia, sem ida ao banco.
+    Tabelas acompanhadas pelo ChangeFeed não expiram: recebem as alterações
+    linha a linha. As linhas retornadas são compartilhadas e não devem ser alteradas.
+    A busca usa um índice invertido por snapshot, refeito na primeira consulta
+    depois que as linhas mudam.
+    """
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._entries = {}
+        self._versions = {}
+        self.live_tables = set()
+        self._lock = threading.Lock()
+
+    def get(self, table, filial=None, filters=()):
+        """Retorna as linhas de `table`; `filters` é uma tupla de (método, coluna, valor) do PostgREST."""
+        key = (table, filial, filters)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and not entry["stale"] and (table in self.live_tables or time.monotonic() - entry["loaded_at"] < self.ttl):
+                return entry["rows"]
+            version = (self._versions.get(table, 0), self._versions.get(None, 0))
+        query = supabase.table(table).select("*")
+        if filial:
+            query = query.eq("filial", filial)
+        for method, column, value in filters:
+            query = getattr(query, method)(column, value)
+        rows = query.execute().data or []
+        with self._lock:
+            # Alterações recebidas durante a leitura podem não estar nas linhas: relê na próxima
+            stale = (self._versions.get(table, 0), self._versions.get(None, 0)) != version
+            self._entries[key] = {"rows": rows, "loaded_at": time.monotonic(), "stale": stale}
+        logging.info(f"Snapshot da tabela {table} (filial: {filial or 'todas'}) carregado: {len(rows)} linhas.")
+        return rows
+
+    def search(self, table, query, filial=None, filters=()):
+        """Linhas de `table` com todos os termos de `query` (sem acento e sem caixa) nas colunas de SEARCH_FIELDS."""
+        rows = self.get(table, filial, filters)
+        if not normalize_text(query) or not rows:
+            return rows
+        key = (table, filial, filters)
+        with self._lock:
+            entry = self._entries.get(key)
+            index = entry.get("index") if entry and entry["rows"] is rows else None
+        if index is None:
+            start = time.perf_counter()
+            index = search_index.SearchIndex(search_documents(table, rows), normalize=text_normalize.normalize_texts)
+            logging.info(f"Índice de busca de {table} (filial: {filial or 'todas'}): {len(rows)} linhas em {time.perf_counter() - start:.2f}s.")
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry and entry["rows"] is rows:
+                    entry["index"] = index
+        return [rows[i] for i in index.search(query)]
+
+    def invalidate(self, table=None):
+        """Descarta os snapshots de `table` (ou de todas as tabelas); leituras em andamento voltam marcadas como velhas."""
+        with self._lock:
+            for key in [k for k in self._entries if table is None or k[0] == table]:
+                del self._entries[key]
+            self._versions[table] = self._versions.get(table, 0) + 1
+
+    @staticmethod
+    def _matches(row, filial, filters):
+        if filial and row.get("filial") != filial:
+            return False
+        for method, column, value in filters:
+            if method == "eq" and row.get(column) != value:
+                return False
+            if method == "ilike":
+                pattern = "^" + re.escape(value).replace("%", ".*").replace("_", ".") + "$"
+                if not re.match(pattern, str(row.get(column) or ""), re.IGNORECASE | re.DOTALL):
+                    return False
+        return True
+
+    def apply_change(self, table, event_type, record=None, old_record=None):
+        """Aplica um INSERT/UPDATE/DELETE (por id) a todos os snapshots de `table`."""
+        row_id = (record or old_record or {}).get("id")
+        if row_id is None:
+            return
+        with self._lock:
+            self._versions[table] = self._versions.get(table, 0) + 1
+            for key, entry in self._entries.items():
+                if key[0] != table:
+                    continue
+                # Nova lista a cada alteração: quem já leu o snapshot não vê mudança no meio da iteração
+                rows = [row for row in entry["rows"] if row.get("id") != row_id]
+                if event_type != "DELETE" and record and self._matches(record, key[1], key[2]):
+                    rows.append(record)
+                entry["rows"] = rows
+                entry.pop("index", None)
+
+class ChangeFeed:
+    """
+    Assinatura opcional do Supabase Realtime (mudanças do Postgres) que mantém os
+    snapshots atualizados sem leituras periódicas. Roda num thread próprio com
+    reconexão; enquanto o canal não está ativo, as tabelas voltam ao TTL.
+    """
+    def __init__(self, snapshots, tables, on_change=None):
+        self.snapshots = snapshots
+        self.tables = tables
+        self.on_change = on_change
+        self._thread = threading.Thread(target=self._run, name="supabase-realtime", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _set_live(self, live):
+        for table in self.tables:
+            if live:
+                self.snapshots.live_tables.add(table)
+            else:
+                self.snapshots.live_tables.discard(table)
+            # Mudanças entre a última leitura e a assinatura (ou durante a queda) não
+            # chegaram pelo canal: a próxima leitura vai ao banco nos dois casos
+            self.snapshots.invalidate(table)
+            if self.on_change:
+                self.on_change(table)
+        logging.info(f"Realtime {'ativo' if live else 'indisponível, usando TTL'} para: {', '.join(self.tables)}")
+
+    def _handle(self, payload):
+        data = payload.get("data", {})
+        table = data.get("table")
+        self.snapshots.apply_change(table, data.get("type"), data.get("record"), data.get("old_record"))
+        if self.on_change:
+            self.on_change(table)
+
+    def _run(self):
+        asyncio.run(self._listen())
+
+    async def _listen(self):
+        from supabase import acreate_client
+        from realtime import RealtimeSubscribeStates
+        backoff = 1
+        while True:
+            connected = asyncio.Event()
+            lost = asyncio.Event()
+
+            def on_status(status, error):
+                if status == RealtimeSubscribeStates.SUBSCRIBED:
+                    connected.set()
+                else:
+                    logging.warning(f"Canal realtime em estado {status}: {error}")
+                    lost.set()
+
+            client = None
+            try:
+                client = await acreate_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY"))
+                channel = client.channel("controle-equipamentos")
+                for table in self.tables:
+                    channel.on_postgres_changes("*", schema="public", table=table, callback=self._handle)
+                await channel.subscribe(on_status)
+                await asyncio.wait_for(connected.wait(), timeout=30)
+                self._set_live(True)
+                backoff = 1
+                await lost.wait()
+            except Exception as e:
+                logging.warning(f"Erro no feed realtime: {e}")
+            self._set_live(False)
+            if client is not None:
+                try:
+                    await client.remove_all_channels()
+                except Exception as e:
+                    logging.warning(f"Erro ao fechar canais realtime: {e}")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 300)
+
+REALTIME_TABLES = ["bombas", "manutencao", "historico", "saldo_curativo"]
+
+def _clear_dependent_loaders(table):
+    for cached in _CACHE_DEPENDENCIES.get(table, []):
+        cached.clear()
+
+@st.cache_resource
+def get_table_snapshots():
+    snapshots = TableSnapshots(ttl=300)
+    if os.getenv("SUPABASE_REALTIME", "").lower() in ("1", "true", "sim"):
+        ChangeFeed(snapshots, REALTIME_TABLES, on_change=_clear_dependent_loaders).start()
+    return snapshots
+
 # -------------------- CONFIGURAÇÃO INICIAL --------------------
 def load_config():
     if os.path.exists(CONFIG_FILE):
@@ -274,7 +561,6 @@ def setup_filial():
 
 # -------------------- LÓGICA DE DADOS OTIMIZADA --------------------
 def calculate_status(data_saida, periodo):
-    logging.info(f"Calculando status com data_saida: {data_saida} (tipo: {type(data_saida)}) e periodo: {periodo} (tipo: {type(periodo)})")
     if not data_saida or not periodo:
         return "Indefinido"
     try:
@@ -291,6 +577,132 @@ def calculate_status(data_saida, periodo):
         logging.error(f"Erro em calculate_status: {e}")
         return "Data Inválida"
 
+# -------------------- MOTOR DE STATUS --------------------
+# Mesmas faixas de calculate_status: vencida, vence em até 7 dias, no prazo
+STATUS_ALERTA_DIAS = 7
+STATUS_UPDATE_CHUNK = 500
+
+def compute_due_dates(data_saida, periodo):
+    """Vencimento (data_saida + periodo) vetorizado, em datetime64[D]; NaT se a data ou o período forem inválidos."""
+    saida = pd.to_datetime(pd.Series(data_saida, dtype=object), errors='coerce', format='ISO8601', utc=True)
+    dias = pd.to_numeric(pd.Series(periodo, dtype=object), errors='coerce')
+    dias = dias.where(dias > 0)
+    due = saida.dt.tz_localize(None).dt.normalize() + pd.to_timedelta(dias.to_numpy(), unit='D')
+    return due.to_numpy(dtype='datetime64[D]')
+
+class StatusIndex:
+    """
+    Vencimentos das bombas ativas em ordem crescente. Cada status é uma faixa
+    contígua do array ("Fora Prazo" antes de hoje, "Menos de 7 dias" até hoje+7,
+    "No Prazo" depois), então as transições saem de buscas binárias. As leituras
+    (tabela e dashboard, no app e na RPC) usam a coluna status que elas mantêm.
+    """
+    def __init__(self, bombas):
+        df = pd.DataFrame(bombas, columns=["id", "status", "data_saida", "periodo"])
+        due = compute_due_dates(df["data_saida"], df["periodo"])
+        valid = ~np.isnat(due)
+        order = np.argsort(due[valid], kind="stable")
+        self.due = due[valid][order]
+        self.ids = df["id"].to_numpy()[valid][order]
+        # Sem vencimento calculável a bomba fica de fora e mantém o status gravado ("Indefinido", "Data Inválida")
+        self.stored = df["status"].to_numpy()[valid][order]
+
+    @staticmethod
+    def _bounds(due, hoje):
+        hoje = np.datetime64(hoje, 'D')
+        fora = int(np.searchsorted(due, hoje, side='left'))
+        alerta = int(np.searchsorted(due, hoje + STATUS_ALERTA_DIAS, side='right'))
+        return fora, alerta
+
+    def transitions(self, hoje, desde=None):
+        """
+        Ids cujo status gravado difere do status em `hoje`, por novo status. Com
+        `desde` (data da última execução) só olha as faixas que cruzaram um limite
+        nesse intervalo; sem ela confere todas as bombas ativas.
+        """
+        fora, alerta = self._bounds(self.due, hoje)
+        if desde is None:
+            faixas = {"Fora Prazo": (0, fora), "Menos de 7 dias": (fora, alerta), "No Prazo": (alerta, len(self.due))}
+        else:
+            fora_antes, alerta_antes = self._bounds(self.due, desde)
+            faixas = {"Fora Prazo": (fora_antes, fora), "Menos de 7 dias": (max(alerta_antes, fora), alerta)}
+        changes = {}
+        for status, (inicio, fim) in faixas.items():
+            ids = self.ids[inicio:fim][self.stored[inicio:fim] != status]
+            if len(ids):
+                changes[status] = ids.tolist()
+        return changes
+
+@cached_loader("bombas", shared=True, ttl=300)
+def get_status_index():
+    return StatusIndex(get_table_snapshots().get("bombas", filters=(("eq", "ativo", True),)))
+
+def apply_status_transitions(hoje, desde=None):
+    """Grava em lote os status que mudaram desde `desde` (ou todos); retorna quantas linhas mudaram."""
+    changes = get_status_index().transitions(hoje, desde)
+    total = 0
+    for status, ids in changes.items():
+        for start in range(0, len(ids), STATUS_UPDATE_CHUNK):
+            chunk = ids[start:start + STATUS_UPDATE_CHUNK]
+            supabase.table("bombas").update({"status": status}).in_("id", chunk).execute()
+            total += len(chunk)
+    if total:
+        invalidate_caches("bombas")
+    return total
+
+@st.cache_resource
+def _status_refresh_state():
+    return {"ultima_execucao": None, "lock": threading.Lock()}
+
+def refresh_pump_status(hoje=None):
+    """
+    Job diário de status. Usa a RPC refresh_bombas_status quando existe (também
+    agendada no pg_cron); senão aplica as transições pelo StatusIndex. Roda no
+    máximo uma vez por dia em cada processo.
+    """
+    hoje = hoje or datetime.now().date()
+    state = _status_refresh_state()
+    if state["ultima_execucao"] == hoje or not state["lock"].acquire(blocking=False):
+        return
+    try:
+        try:
+            total = supabase.rpc("refresh_bombas_status", {"p_hoje": hoje.isoformat()}).execute().data
+            if total:
+                invalidate_caches("bombas")
+        except Exception as e:
+            logging.warning(f"RPC refresh_bombas_status indisponível, atualizando status pelo app: {e}")
+            total = apply_status_transitions(hoje, state["ultima_execucao"])
+        state["ultima_execucao"] = hoje
+        logging.info(f"Status das bombas atualizado para {hoje:%d/%m/%Y}: {total or 0} alterações.")
+    except Exception as e:
+        logging.error(f"Erro ao atualizar o status das bombas: {e}")
+    finally:
+        state["lock"].release()
+
+def _insert_historico(events):
+    supabase.table("historico").insert(events).execute()
+
+def historico_recusado(error):
+    """O banco recusou os dados (SQLSTATE 22xxx/23xxx): repetir o mesmo evento não adianta."""
+    return str(getattr(error, "code", None) or "")[:2] in ("22", "23")
+
+def _insert_historico_rejeitados(rows):
+    supabase.table("historico_rejeitados").insert([{
+        "payload": row["payload"], "erro": row["erro"],
+        "criado_em": datetime.fromtimestamp(row["criado_em"], timezone.utc).isoformat(),
+        "rejeitado_em": datetime.fromtimestamp(row["rejeitado_em"], timezone.utc).isoformat(),
+    } for row in rows]).execute()
+
+@st.cache_resource
+def get_event_writer():
+    """Gravador do histórico compartilhado pelas sessões: diário local e inserts em lote num thread."""
+    snapshots = get_table_snapshots()
+
+    def historico_gravado():
+        _clear_dependent_loaders("historico")
+        snapshots.invalidate("historico")
+    return event_writer.EventWriter(_insert_historico, on_flush=historico_gravado, is_rejected=historico_recusado, dead_letter=_insert_historico_rejeitados).start()
+
 def register_event(table, record_id, description, filial):
     if "event_buffer" not in st.session_state:
         st.session_state.event_buffer = []
@@ -301,33 +713,25 @@ def register_event(table, record_id, description, filial):
     })
 
 def flush_events():
+    """Passa os eventos da sessão ao gravador do histórico, sem esperar o Supabase."""
     if st.session_state.get("event_buffer"):
         try:
-            supabase.table("historico").insert(st.session_state.event_buffer).execute()
+            get_event_writer().append(st.session_state.event_buffer)
             st.session_state.event_buffer = []
-            logging.info("Eventos registrados em lote.")
+            logging.info("Eventos registrados no diário para gravação em lote.")
         except Exception as e:
             logging.error(f"Erro ao registrar eventos em lote: {e}")
             st.error("Erro ao salvar eventos.")
 
-@st.cache_data(ttl=300, show_spinner=False)
 def get_bombas(search_term="", filial=None, active_only=True):
     try:
-        query = supabase.table("bombas").select("*")
+        bombas = get_table_snapshots().search("bombas", search_term, filial)
         if active_only:
-            query = query.eq("ativo", True)
-        if filial:
-            query = query.eq("filial", filial)
-        bombas = query.execute().data
+            bombas = [bomba for bomba in bombas if bomba.get("ativo") is True]
         if not bombas:
             return []
-        if search_term:
-            result = []
-            search_term_lower = search_term.lower()
-            for bomba in bombas:
-                if any(search_term_lower in str(bomba.get(field, "")).lower() for field in ["serial", "paciente", "hospital"]):
-                    result.append(bomba)
-            bombas = result
+        # Cópias: o snapshot é compartilhado entre sessões
+        bombas = [dict(bomba) for bomba in bombas]
         for bomba in bombas:
             bomba["id"] = str(bomba["id"])
             for field in ["data_saida", "data_registro", "data_retorno"]:
@@ -342,34 +746,15 @@ def get_bombas(search_term="", filial=None, active_only=True):
         st.error("Erro ao acessar dados das bombas.")
         return []
 
-@st.cache_data(ttl=300, show_spinner=False)
 def get_manutencao(search_term="", filial=None):
     try:
-        query = supabase.table("manutencao").select("*")
-        if filial:
-            query = query.eq("filial", filial)
-        manutencoes = query.execute().data
+        manutencoes = get_table_snapshots().search("manutencao", search_term, filial)
         if not manutencoes:
             return []
         manut_df = pd.DataFrame(manutencoes)
-        if search_term:
-            search_term_lower = search_term.lower()
-            mask = manut_df.apply(lambda row: any(search_term_lower in str(row.get(field, "")).lower() for field in ["serial", "defeito", "nf_numero"]), axis=1)
-            manut_df = manut_df[mask]
         if manut_df.empty:
             return []
-        bombas_df = get_dados_bombas_df()
-        if not bombas_df.empty:
-            manut_df['Serial_Normalized'] = manut_df['serial'].apply(normalize_text)
-            merged_df = pd.merge(manut_df, bombas_df[['Serial_Normalized', 'Modelo', 'Ultima_Manut', 'Venc_Manut']], left_on='Serial_Normalized', right_on='Serial_Normalized', how='left')
-        else:
-            merged_df = manut_df
-            merged_df['Modelo'] = "N/A"
-            merged_df['Ultima_Manut'] = pd.NaT
-            merged_df['Venc_Manut'] = pd.NaT
-        merged_df['modelo'] = merged_df['Modelo'].fillna("N/A")
-        merged_df['ultima_manut'] = pd.to_datetime(merged_df['Ultima_Manut'], errors='coerce').dt.strftime('%d/%m/%Y').fillna("N/A")
-        merged_df['venc_manut'] = pd.to_datetime(merged_df['Venc_Manut'], errors='coerce').dt.strftime('%d/%m/%Y').fillna("N/A")
+        merged_df = enrich_with_equipment(manut_df.copy())
         
         # --- USO DA NOVA FUNÇÃO DE DATA ---
         merged_df['data_registro'] = merged_df['data_registro'].apply(lambda x: (parse_supabase_date(x).strftime('%d/%m/%Y') if parse_supabase_date(x) else "N/A"))
@@ -381,26 +766,78 @@ def get_manutencao(search_term="", filial=None):
         st.error("Erro ao acessar dados de manutenção.")
         return []
 
-@st.cache_data(ttl=300, show_spinner=False)
-def get_historico_devolvidas(filial=None):
+# -------------------- CONSULTA DO HISTÓRICO --------------------
+# Linhas por página; tipo_evento (coluna gerada) -> filtro equivalente sem a migração
+HISTORICO_PAGE_SIZE = 50
+HISTORICO_TIPO_FILTERS = {"DEVOLVIDA": (("ilike", "descricao", "%BOMBA DEVOLVIDA%"),)}
+
+def historico_search_query(search_term):
+    """Termos da busca -> (tsquery por início de palavra, datas dd/mm/aaaa citadas)."""
+    words, dates = [], []
+    for term in normalize_text(search_term).split():
+        try:
+            dates.append(datetime.strptime(term, "%d/%m/%Y").date())
+            continue
+        except ValueError:
+            pass
+        words += [f"{part}:*" for part in re.findall(r"[A-Z0-9]+", term)]
+    return " & ".join(words), dates
+
+def _historico_page_from_snapshot(tipo, filial, search_term, cursor, limit):
+    """Mesma página montada sobre o snapshot, para bancos sem a migração historico_consulta."""
+    historico = get_table_snapshots().search("historico", search_term, filial, filters=HISTORICO_TIPO_FILTERS.get(tipo, ()))
+    historico = sorted(historico, key=lambda doc: (doc.get("data_evento") or "", doc.get("id") or 0), reverse=True)
+    if cursor:
+        historico = [doc for doc in historico if ((doc.get("data_evento") or ""), doc.get("id") or 0) < tuple(cursor)]
+    return historico[:limit + 1]
+
+@cached_loader("historico", ttl=300)
+def query_historico(tipo=None, filial=None, search_term="", cursor=None, limit=HISTORICO_PAGE_SIZE):
+    """
+    Uma página do histórico, do evento mais recente para o mais antigo. A paginação é
+    por chave: `cursor` é o (data_evento, id) da última linha da página anterior.
+    Retorna (linhas, cursor da próxima página ou None).
+    """
+    try:
+        query = supabase.table("historico").select("id, data_evento, descricao, filial")
+        if tipo: query = query.eq("tipo_evento", tipo)
+        if filial: query = query.eq("filial", filial)
+        tsquery, dates = historico_search_query(search_term)
+        if tsquery: query = query.filter("busca", "fts(simple)", tsquery)
+        for day in dates: query = query.gte("data_evento", day.isoformat()).lt("data_evento", (day + timedelta(days=1)).isoformat())
+        if cursor:
+            data_evento, row_id = cursor
+            query = query.or_(f'data_evento.lt."{data_evento}",and(data_evento.eq."{data_evento}",id.lt.{row_id})')
+        rows = query.order("data_evento", desc=True).order("id", desc=True).limit(limit + 1).execute().data or []
+    except Exception as e:
+        logging.warning(f"Consulta paginada do histórico indisponível ({e}); usando o snapshot.")
+        rows = _historico_page_from_snapshot(tipo, filial, search_term, cursor, limit)
+    next_cursor = (rows[limit - 1]["data_evento"], rows[limit - 1]["id"]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+def get_historico_devolvidas(filial=None, search_term="", pages=1):
+    """As `pages` primeiras páginas de devoluções, com as datas formatadas; retorna (linhas, há mais)."""
     try:
-        query = supabase.table("historico").select("*").ilike("descricao", "%BOMBA DEVOLVIDA%").order("data_evento", desc=True)
-        if filial:
-            query = query.eq("filial", filial)
-        historico = query.execute().data
+        historico, cursor = [], None
+        for _ in range(pages):
+            rows, cursor = query_historico("DEVOLVIDA", filial, search_term, cursor)
+            historico += rows
+            if not cursor:
+                break
+        historico = [dict(doc) for doc in historico]
         for doc in historico:
             doc["id"] = str(doc["id"])
             # --- USO DA NOVA FUNÇÃO DE DATA ---
             dt_obj = parse_supabase_date(doc.get("data_evento"))
             if dt_obj:
                 doc["data_evento"] = dt_obj.strftime("%d/%m/%Y, %H:%M")
-        return historico
+        return historico, cursor is not None
     except Exception as e:
         logging.error(f"Erro ao buscar histórico de devolvidas: {e}")
         st.error(f"Erro ao acessar histórico: {e}")
-        return []
+        return [], False
 
-@st.cache_data(ttl=300, show_spinner="Carregando dados de curativos...")
+@cached_loader("saldo_curativo", ttl=300, show_spinner="Carregando dados de curativos...")
 def get_saldo_curativo_data():
     try:
         # Busca dados do banco
@@ -422,14 +859,38 @@ def get_saldo_curativo_data():
         st.error(f"Não foi possível carregar os dados de saldo de curativos: {e}")
         return pd.DataFrame()
 
-@st.cache_data(ttl=300, show_spinner=False)
+def get_dashboard_metrics_rpc(filial=None):
+    """Métricas do dashboard agregadas no Postgres (supabase/migrations, dashboard_metrics)."""
+    metrics = supabase.rpc("dashboard_metrics", {"p_filial": filial}).execute().data
+    if not metrics:
+        raise ValueError("RPC dashboard_metrics não retornou dados.")
+    metrics["status_counts"] = {**{"No Prazo": 0, "Menos de 7 dias": 0, "Fora Prazo": 0}, **metrics["status_counts"]}
+    metrics["bombas_por_filial"] = {**{"BRASILIA": 0, "GOIANIA": 0, "CUIABA": 0}, **metrics["bombas_por_filial"]}
+    return metrics
+
+@cached_loader("bombas", "manutencao", "DADOS_BOMBAS", ttl=300, show_spinner=False)
 def get_dashboard_metrics(filial=None):
+    if DASHBOARD_METRICS_BACKEND in ("rpc", "auto"):
+        try:
+            return get_dashboard_metrics_rpc(filial)
+        except Exception as e:
+            if DASHBOARD_METRICS_BACKEND == "rpc":
+                logging.error(f"Erro ao obter métricas do dashboard via RPC: {e}")
+                st.error(f"Erro ao carregar métricas do dashboard: {e}")
+                return None
+            logging.warning(f"RPC dashboard_metrics indisponível, calculando no app: {e}")
+    return get_dashboard_metrics_pandas(filial)
+
+def get_dashboard_metrics_pandas(filial=None):
     try:
         dados_bombas_df = get_dados_bombas_df()
         if dados_bombas_df.empty:
             logging.warning("DADOS_BOMBAS está vazio, as métricas podem ser imprecisas.")
         active_pumps_list = supabase.table("bombas").select("serial, ativo, status, hospital, filial").eq("ativo", True).execute().data
         active_pumps_df = pd.DataFrame(active_pumps_list if active_pumps_list else [])
+        if not active_pumps_df.empty:
+            active_pumps_df['Serial_Normalized'] = normalize_series(active_pumps_df['serial'])
+            active_pumps_df['Modelo'] = lookup_equipment(active_pumps_df['Serial_Normalized'])['Modelo']
         manut_list = supabase.table("manutencao").select("id, filial, serial").eq("status", "Em Manutenção").execute().data
         manut_df = pd.DataFrame(manut_list if manut_list else [])
 
@@ -447,16 +908,14 @@ def get_dashboard_metrics(filial=None):
         ulta_count = 0
         activac_count = 0
         if not scoped_active_pumps_df.empty and not dados_bombas_df.empty:
-            scoped_active_pumps_df['Serial_Normalized'] = scoped_active_pumps_df['serial'].apply(normalize_text)
-            merged_df = pd.merge(scoped_active_pumps_df, dados_bombas_df[['Serial_Normalized', 'Modelo']], on='Serial_Normalized', how='left')
-            model_counts = merged_df['Modelo'].str.upper().value_counts().to_dict()
+            model_counts = scoped_active_pumps_df['Modelo'].str.upper().value_counts().to_dict()
             ulta_count = model_counts.get('ULTA', 0)
             activac_count = model_counts.get('ACTIVAC', 0)
         total_comodato_painel = ulta_count + activac_count
 
         total_bombas_inventario = len(dados_bombas_df)
-        seriais_ativos = set(active_pumps_df['serial'].apply(normalize_text)) if not active_pumps_df.empty else set()
-        seriais_manut = set(manut_df['serial'].apply(normalize_text)) if not manut_df.empty else set()
+        seriais_ativos = set(active_pumps_df['Serial_Normalized']) if not active_pumps_df.empty else set()
+        seriais_manut = set(normalize_series(manut_df['serial'])) if not manut_df.empty else set()
         seriais_indisponiveis = seriais_ativos.union(seriais_manut)
 
         df_estoque = pd.DataFrame()
@@ -473,17 +932,16 @@ def get_dashboard_metrics(filial=None):
             if not df_disponiveis.empty:
                 modelos_disponiveis_counts = df_disponiveis['Modelo'].str.upper().value_counts().to_dict()
 
+        # Status gravado (atualizado por refresh_pump_status), como na RPC dashboard_metrics e na tabela
         status_counts = scoped_active_pumps_df['status'].value_counts().to_dict() if not scoped_active_pumps_df.empty else {}
-        hosp_counts = scoped_active_pumps_df['hospital'].apply(normalize_text).value_counts().to_dict() if not scoped_active_pumps_df.empty else {}
-        bombas_por_filial = active_pumps_df['filial'].apply(normalize_text).value_counts().to_dict() if not active_pumps_df.empty else {}
+        hosp_counts = normalize_series(scoped_active_pumps_df['hospital']).value_counts().to_dict() if not scoped_active_pumps_df.empty else {}
+        bombas_por_filial = normalize_series(active_pumps_df['filial']).value_counts().to_dict() if not active_pumps_df.empty else {}
         
         modelos_por_filial_records = []
         if not active_pumps_df.empty and not dados_bombas_df.empty:
-            active_pumps_df['Serial_Normalized'] = active_pumps_df['serial'].apply(normalize_text)
-            merged_global_df = pd.merge(active_pumps_df, dados_bombas_df[['Serial_Normalized', 'Modelo']], on='Serial_Normalized', how='left')
-            if not merged_global_df.empty and 'filial' in merged_global_df.columns and 'Modelo' in merged_global_df.columns:
-                merged_global_df.dropna(subset=['filial', 'Modelo'], inplace=True)
-                modelos_por_filial_df = merged_global_df.groupby(['filial', 'Modelo']).size().reset_index(name='Quantidade')
+            if 'filial' in active_pumps_df.columns:
+                modelos_df = active_pumps_df.dropna(subset=['filial', 'Modelo'])
+                modelos_por_filial_df = modelos_df.groupby(['filial', 'Modelo']).size().reset_index(name='Quantidade')
                 modelos_por_filial_records = modelos_por_filial_df.to_dict('records')
         
         metrics = {
@@ -501,54 +959,56 @@ def get_dashboard_metrics(filial=None):
         st.error(f"Erro ao carregar métricas do dashboard: {e}")
         return None
 
-def convert_docx_to_pdf(docx_path: str, pdf_path: str) -> bool:
+def get_contract_template(temp_dir):
+    """Caminho de um contrato.docx utilizável: o local ou uma cópia baixada do storage."""
+    if os.path.exists(CONTRATO_LOCAL_PATH):
+        return CONTRATO_LOCAL_PATH
+    file_content = download_file_from_storage(CONTRATO_STORAGE_PATH)
+    if not file_content:
+        return None
+    template_path = os.path.join(temp_dir, "contrato.docx")
+    with open(template_path, "wb") as f: f.write(file_content)
+    return template_path
+
+def fetch_contract_annex(serial):
+    return fetch_storage_file(f"pdfs/{serial}.pdf")
+
+@cached_loader("storage:pdfs/", ttl=300)
+def get_contract_annex_etag(serial):
+    """ETag de pdfs/{serial}.pdf ("" se não existe, None se não deu para saber), para o cache de documentos."""
     try:
-        out_dir = os.path.dirname(pdf_path) or "."; os.makedirs(out_dir, exist_ok=True)
-        cmd = ["soffice", "--headless", "--convert-to", "pdf", "--outdir", out_dir, docx_path]
-        result = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=60)
-        converted_pdf = os.path.join(out_dir, os.path.splitext(os.path.basename(docx_path))[0] + ".pdf")
-        if not os.path.exists(converted_pdf): raise FileNotFoundError(f"PDF não encontrado: {converted_pdf}. Output: {result.stderr.decode()}")
-        if os.path.abspath(converted_pdf) != os.path.abspath(pdf_path): os.replace(converted_pdf, pdf_path)
-        return True
+        info = supabase.storage.from_("controle-de-bombas-suplen-files").info(f"pdfs/{serial}.pdf")
+        return str(info.get("etag") or (info.get("metadata") or {}).get("eTag") or info.get("last_modified") or info.get("updated_at") or "")
     except Exception as e:
-        st.warning(f"Erro ao converter para PDF: {e}")
-        return False
+        if "not found" in str(e).lower():
+            return ""
+        logging.warning(f"Não foi possível obter o ETag de pdfs/{serial}.pdf: {e}")
+        return None
 
 def generate_combined_pdf(bomba_data):
     try:
         with tempfile.TemporaryDirectory() as temp_dir:
-            temp_docx_path = os.path.join(temp_dir, f"contrato_{bomba_data['serial']}.docx")
-            if os.path.exists(CONTRATO_LOCAL_PATH):
-                import shutil
-                shutil.copyfile(CONTRATO_LOCAL_PATH, temp_docx_path)
-            else:
-                file_content = download_file_from_storage(CONTRATO_STORAGE_PATH)
-                if not file_content: st.error("Modelo 'contrato.docx' não encontrado!"); return None
-                with open(temp_docx_path, "wb") as f: f.write(file_content)
-            doc = Document(temp_docx_path)
-            data_atual = datetime.now()
-            meses = ["Janeiro", "Fevereiro", "Março", "Abril", "Maio", "Junho", "Julho", "Agosto", "Setembro", "Outubro", "Novembro", "Dezembro"]
-            data_formatada = f"Brasília, {data_atual.day:02d} de {meses[data_atual.month - 1]} de {data_atual.year}"
-            replacements = {"{SERIAL}": bomba_data.get("serial", "N/A"), "{PACIENTE}": bomba_data.get("paciente", "N/A"), "{NOTA_FISCAL}": bomba_data.get("nf", "N/A"), "{DATA_ATUAL}": data_formatada}
-            for p in doc.paragraphs:
-                for key, value in replacements.items():
-                    if key in p.text:
-                        inline = p.runs
-                        for i in range(len(inline)):
-                            if key in inline[i].text: inline[i].text = inline[i].text.replace(key, str(value))
-            doc.save(temp_docx_path)
-            temp_pdf_path = os.path.join(temp_dir, f"contrato_{bomba_data['serial']}.pdf")
-            if not convert_docx_to_pdf(temp_docx_path, temp_pdf_path): return None
-            merger = PdfMerger()
-            merger.append(temp_pdf_path)
-            pdf_serial_content = download_file_from_storage(f"pdfs/{bomba_data['serial']}.pdf")
-            if pdf_serial_content: merger.append(BytesIO(pdf_serial_content))
-            pdf_buffer = BytesIO(); merger.write(pdf_buffer); merger.close(); pdf_buffer.seek(0)
-            return pdf_buffer
+            template_path = get_contract_template(temp_dir)
+            if not template_path: st.error("Modelo 'contrato.docx' não encontrado!"); return None
+            return contract_pdf.render_contract(template_path, bomba_data, fetch_contract_annex, annex_etag=get_contract_annex_etag(bomba_data['serial']))
     except Exception as e:
         st.error(f"Erro ao gerar PDF: {e}")
         return None
 
+def generate_contracts_batch(bombas, output="zip", progress=None):
+    """Documentos de várias bombas numa única conversão do LibreOffice; retorna (BytesIO, seriais com falha)."""
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            template_path = get_contract_template(temp_dir)
+            if not template_path: st.error("Modelo 'contrato.docx' não encontrado!"); return None, []
+            result = contract_pdf.render_contracts(template_path, bombas, fetch_contract_annex, output=output, progress=progress, annex_etag=get_contract_annex_etag)
+        logging.info(f"Conversor de PDF: {contract_pdf.get_conversion_pool().metrics()}")
+        return result
+    except Exception as e:
+        logging.error(f"Erro ao gerar documentos em lote: {e}")
+        st.error(f"Erro ao gerar documentos em lote: {e}")
+        return None, []
+
 def generate_excel_saldo_curativo(df):
     if df.empty: return None
     output = BytesIO()
@@ -578,44 +1038,194 @@ def upload_nf_assinada(bomba_data, file):
             except (ValueError, TypeError): data_registro_str = str(bomba_data['data_registro']).replace('/', '-')
         file_name = f"nfs_assinadas/{serial}*{hospital}_{paciente}*{data_registro_str}_assinado.pdf"
         supabase.storage.from_(bucket_name).upload(file_name, file.getvalue(), file_options={"content-type": "application/pdf", "cache-control": "3600", "upsert": "true"})
+        get_nfs_assinadas_index().put(file_name)
         return True
     except Exception as e:
         st.error(f"Erro ao enviar NF assinada: {e}")
         return False
 
-@st.cache_data(ttl=300)
+def nf_assinada_serial(name):
+    return name.split('*')[0] if name.endswith("_assinado.pdf") else None
+
+@st.cache_resource
+def get_nfs_assinadas_index():
+    """Índice serial -> NF assinada compartilhado pelas sessões e salvo em disco."""
+    return storage_client.StorageIndex(supabase.storage, "controle-de-bombas-suplen-files", "nfs_assinadas/", nf_assinada_serial)
+
 def get_all_nfs_assinadas_info():
+    index = get_nfs_assinadas_index()
     try:
-        bucket_name = "controle-de-bombas-suplen-files"
-        path = "nfs_assinadas/"
-        files = supabase.storage.from_(bucket_name).list(path)
-        serial_to_filename_map = {}
-        for file_info in files:
-            name = file_info.get('name')
-            if name and name.endswith("_assinado.pdf"):
-                serial_to_filename_map[name.split('*')[0]] = f"{path}{name}"
-        return serial_to_filename_map
+        index.refresh()
     except Exception as e:
         logging.error(f"Erro ao listar NFs assinadas: {e}")
-        return {}
+    return index.mapping()
 
 def get_nf_assinada_filename(serial, nf_map): return nf_map.get(serial)
 def check_nf_assinada(serial, nf_map): return serial in nf_map
 
-@st.cache_data(ttl=300)
+def _storage_time(value):
+    """updated_at do storage (ISO 8601, com Z ou fuso) como datetime UTC, ou None."""
+    try:
+        return datetime.fromisoformat(str(value).replace("Z", "+00:00")).astimezone(timezone.utc)
+    except (TypeError, ValueError):
+        return None
+
+def mesma_nf_assinada(pedido, atual):
+    """
+    O objeto atual do índice é a NF da bomba devolvida: mesmo caminho (se já era
+    conhecido) e mesmo ETag, ou, sem ETag capturado, enviado antes da devolução. Uma NF
+    de um novo registro do serial só pode ter sido enviada depois, e fica.
+    """
+    if atual is None or (pedido.get("path") and atual["path"] != pedido["path"]):
+        return False
+    if pedido.get("etag"):
+        return atual.get("etag") == pedido["etag"]
+    enviada, devolvida = _storage_time(atual.get("updated_at")), _storage_time(pedido.get("devolvida_em"))
+    return enviada is not None and devolvida is not None and enviada <= devolvida
+
+@st.cache_resource
+def get_nf_cleanup():
+    """Remoção das NFs assinadas de bombas devolvidas, em segundo plano (diário local, lotes e novas tentativas)."""
+    index = get_nfs_assinadas_index()
+
+    def remove_nfs_assinadas(pedidos):
+        # A listagem fica aqui, fora da devolução. Só apaga a NF que existia quando a
+        # bomba foi devolvida: se ela voltou a ser registrada e ganhou outra NF (mesmo
+        # no mesmo caminho), o pedido é descartado
+        index.refresh(max_age=0)
+        paths = []
+        for pedido in pedidos:
+            atual = index.entry(pedido["serial"])
+            if mesma_nf_assinada(pedido, atual):
+                paths.append(atual["path"])
+            else:
+                logging.info(f"NF assinada de {pedido['serial']} mantida: {(atual or {}).get('path') or 'nenhuma'} foi enviada depois da devolução ou já foi removida.")
+        if paths:
+            supabase.storage.from_("controle-de-bombas-suplen-files").remove(paths)
+            for path in paths:
+                index.remove(path)
+            logging.info(f"NFs assinadas desvinculadas: {', '.join(paths)}")
+    journal_path = os.path.join(os.path.dirname(event_writer.EVENT_JOURNAL_PATH), "nfs_assinadas_remocao.sqlite3")
+    return event_writer.EventWriter(remove_nfs_assinadas, journal_path=journal_path, name="nf-cleanup").start()
+
+# -------------------- REGISTRO E DEVOLUÇÃO --------------------
+def rpc_indisponivel(error):
+    """A função não existe no banco (migração ainda não aplicada)."""
+    return getattr(error, "code", None) in ("PGRST202", "42883")
+
+def registrar_bomba(record):
+    """
+    Insere a bomba e o evento "BOMBA REGISTRADA" numa chamada e numa transação (RPC
+    registrar_bomba, migração bombas_transacoes). Serial já ativo levanta ValueError.
+    Sem a migração, volta para a consulta, o insert e o evento pelo app.
+    """
+    duplicada = f"ERRO: A bomba com o serial '{record['serial']}' já está registrada e ativa."
+    try:
+        bomba = supabase.rpc("registrar_bomba", {"p_bomba": record, "p_data_evento": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}).execute().data
+        invalidate_caches("bombas", "historico")
+        return bomba
+    except Exception as e:
+        if getattr(e, "code", None) == "23505":
+            raise ValueError(duplicada) from e
+        if not rpc_indisponivel(e):
+            raise
+        logging.warning(f"RPC registrar_bomba indisponível, registrando pelo app: {e}")
+    existing = supabase.table("bombas").select("id", count='exact').eq("serial", record["serial"]).eq("ativo", True).execute()
+    if existing.count > 0:
+        raise ValueError(duplicada)
+    response = supabase.table("bombas").insert(record).execute()
+    if not response.data:
+        raise ValueError("Ocorreu um erro ao registrar a bomba.")
+    register_event("bombas", response.data[0]["id"], f"BOMBA REGISTRADA (SERIAL: {record['serial']})", record["filial"])
+    flush_events()
+    invalidate_caches("bombas")
+    return response.data[0]
+
+def devolver_bomba(bomba, data_retorno, nf_devolucao, filial):
+    """
+    Marca a bomba como devolvida e grava o evento numa chamada (RPC devolver_bomba).
+    A NF assinada vai para a fila de remoção do storage; retorna True se o índice
+    conhecia uma.
+    """
+    try:
+        supabase.rpc("devolver_bomba", {"p_id": bomba["id"], "p_data_retorno": data_retorno.strftime("%Y-%m-%d"), "p_nf_devolucao": nf_devolucao, "p_data_evento": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}).execute()
+        invalidate_caches("bombas", "historico")
+    except Exception as e:
+        if getattr(e, "code", None) == "P0002":
+            raise ValueError(f"A bomba {bomba['serial']} já foi devolvida.") from e
+        if not rpc_indisponivel(e):
+            raise
+        logging.warning(f"RPC devolver_bomba indisponível, devolvendo pelo app: {e}")
+        supabase.table("bombas").update({"ativo": False, "status": "✅ DEVOLVIDA", "data_retorno": data_retorno.strftime("%Y-%m-%d"), "nf_devolucao": nf_devolucao}).eq("id", bomba["id"]).execute()
+        register_event("bombas", bomba["id"], f"BOMBA DEVOLVIDA (SERIAL: {bomba['serial']}) NF: {nf_devolucao}", filial)
+        flush_events()
+        invalidate_caches("bombas")
+    # Sem ida ao storage aqui: o pedido leva o que o índice em memória sabe da NF e a
+    # hora da devolução, e o job lista o storage e confere a versão antes de apagar
+    nf_assinada = get_nfs_assinadas_index().entry(bomba["serial"]) or {}
+    try:
+        get_nf_cleanup().append([{**nf_assinada, "serial": bomba["serial"], "devolvida_em": datetime.now(timezone.utc).isoformat()}])
+    except Exception as e:
+        logging.error(f"Erro ao agendar a remoção da NF assinada de {bomba['serial']}: {e}")
+    return bool(nf_assinada)
+
+# Downloads simultâneos na exportação das NFs assinadas
+NF_ZIP_CONCURRENCY = 6
+# O st.download_button lê o ZIP inteiro para a memória: acima deste tamanho as NFs
+# restantes ficam de fora e a exportação pede um período menor
+NF_ZIP_MAX_MB = int(os.getenv("NF_ZIP_MAX_MB", "100"))
+
 def download_nf_assinada(serial):
+    # Sem cache: cada PDF é baixado sob demanda e não fica na memória do processo
     try:
         nf_map = get_all_nfs_assinadas_info()
         file_path = get_nf_assinada_filename(serial, nf_map)
-        if file_path: return supabase.storage.from_("controle-de-bombas-suplen-files").download(file_path)
+        if file_path: return get_storage_client().download(file_path)
         return None
     except Exception as e:
         logging.error(f"Erro ao baixar NF assinada para {serial}: {e}")
         return None
 
+def data_saida_no_periodo(bomba, inicio, fim):
+    try: return inicio <= datetime.strptime(bomba.get('data_saida', ''), '%d/%m/%Y').date() <= fim
+    except (ValueError, TypeError): return False
+
+def build_nfs_assinadas_zip(paths, progress=None, max_bytes=NF_ZIP_MAX_MB * 1024 * 1024):
+    """
+    ZIP com as NFs assinadas de `paths`, montado em arquivo temporário à medida que
+    os downloads (concorrentes) terminam; cada PDF é descartado depois de escrito.
+    Não é streaming: o st.download_button copia o ZIP pronto para a memória, por isso
+    os PDFs gravados não passam de max_bytes (fora o índice do ZIP) e a NF que não
+    cabe e as seguintes ficam de fora.
+    Retorna (arquivo posicionado no início, caminhos que falharam, caminhos omitidos).
+    """
+    progress = progress or (lambda fraction, text: None)
+    # Sem buffer (RawIOBase): formato aceito direto pelo st.download_button
+    output = tempfile.TemporaryFile(buffering=0)
+    falhas = []
+    incluidos = set()
+    # PDFs já vêm comprimidos: ZIP_STORED evita gastar CPU à toa
+    with zipfile.ZipFile(output, "w", zipfile.ZIP_STORED) as zf:
+        for i, (path, data) in enumerate(get_storage_client().download_many(paths, NF_ZIP_CONCURRENCY), 1):
+            if data is None: falhas.append(path)
+            elif output.tell() + len(data) > max_bytes: break
+            else: zf.writestr(os.path.basename(path).replace('*', '_'), data)
+            incluidos.add(path)
+            progress(i / len(paths), f"{i}/{len(paths)} NFs baixadas")
+    omitidos = [path for path in paths if path not in incluidos]
+    output.seek(0)
+    logging.info(f"Exportação de NFs assinadas: {len(incluidos) - len(falhas)} arquivos, {len(falhas)} falhas, {len(omitidos)} acima do limite. Storage: {get_storage_client().metrics()}")
+    return output, falhas, omitidos
+
+# Status -> (rótulo, fundo, texto): as mesmas cores das classes .status-* do CSS
+STATUS_BADGES = {"No Prazo": ("🟢 No Prazo", "#d1fae5", "#065f46"), "Menos de 7 dias": ("🟡 Menos de 7 dias", "#fefcbf", "#92400e"), "Fora Prazo": ("🔴 Fora Prazo", "#fee2e2", "#991b1b"), "Indefinido": ("Indefinido", "#e5e7eb", "#4b5563"), "Data Inválida": ("Data Inválida", "#e5e7eb", "#4b5563"), "✅ DEVOLVIDA": ("✅ Devolvida", "#d1e7dd", "#0f5132"), "Em Manutenção": ("🛠 Em Manutenção", "#fefcbf", "#92400e")}
+STATUS_CELL_STYLES = {label: f"background-color: {bg}; color: {fg}; font-weight: 500" for label, bg, fg in STATUS_BADGES.values()}
+
 def format_status(status):
-    status_map = {"No Prazo": '<span class="status-badge status-no-prazo">🟢 No Prazo</span>', "Menos de 7 dias": '<span class="status-badge status-menos-7-dias">🟡 Menos de 7 dias</span>', "Fora Prazo": '<span class="status-badge status-fora-prazo">🔴 Fora Prazo</span>', "Indefinido": '<span class="status-badge status-indefinido">Indefinido</span>', "Data Inválida": '<span class="status-badge status-data-invalida">Data Inválida</span>', "✅ DEVOLVIDA": '<span class="status-badge status-devolvida">✅ Devolvida</span>', "Em Manutenção": '<span class="status-badge status-em-manutencao">🛠 Em Manutenção</span>'}
-    return status_map.get(status, status)
+    return STATUS_BADGES[status][0] if status in STATUS_BADGES else status
+
+def style_status_cell(label):
+    return STATUS_CELL_STYLES.get(label, "")
 
 def display_manutencao_table(title, manutencoes):
     st.markdown(f"### {title}");
@@ -633,31 +1243,53 @@ def display_manutencao_table(title, manutencoes):
                 with st.spinner("Atualizando status..."):
                     supabase.table("manutencao").update({"status": "Devolvida"}).eq("id", selected_manut["id"]).execute()
                     register_event("manutencao", selected_manut["id"], f"BOMBA DEVOLVIDA APÓS MANUTENÇÃO (SERIAL: {selected_manut['serial']})", selected_manut['filial'])
-                    flush_events(); st.session_state.messages.append({"text": f"Bomba {selected_manut['serial']} marcada como devolvida!", "icon": "✅"}); st.cache_data.clear(); st.rerun()
+                    flush_events(); st.session_state.messages.append({"text": f"Bomba {selected_manut['serial']} marcada como devolvida!", "icon": "✅"}); invalidate_caches("manutencao"); st.rerun()
             except Exception as e: st.error(f"Erro ao marcar como devolvida: {e}")
     else: st.info("Nenhuma bomba 'Em Manutenção' para realizar ações.")
 
-def display_bombas_table(title, bombas_list, bombas_df, nf_map):
+# Tabela de bombas: opções de linhas por página e colunas ordenáveis (rótulo -> coluna)
+BOMBAS_PAGE_SIZES = [25, 50, 100]
+BOMBAS_SORT_COLUMNS = {"SERIAL": "serial", "HOSPITAL": "hospital", "PACIENTE": "paciente", "DATA SAÍDA": "data_saida", "PERÍODO": "periodo", "STATUS": "status", "NF": "nf"}
+
+def bombas_table_page(bombas_list, nf_map, sort_by="DATA SAÍDA", ascending=False, page=1, page_size=BOMBAS_PAGE_SIZES[0]):
+    """
+    Uma página da listagem: ordena a lista inteira por uma coluna leve e só então
+    enriquece e formata as linhas visíveis. Retorna (DataFrame da página, total de páginas).
+    """
+    df = pd.DataFrame(bombas_list)
+    column = BOMBAS_SORT_COLUMNS.get(sort_by, "data_saida")
+    if column == "data_saida": sort_key = pd.to_datetime(df["data_saida"], format="%d/%m/%Y", errors="coerce")
+    elif column == "periodo": sort_key = pd.to_numeric(df["periodo"], errors="coerce")
+    else: sort_key = df[column].astype(str).str.upper()
+    total_pages = max(1, -(-len(df) // page_size))
+    page = min(max(1, page), total_pages)
+    order = sort_key.reset_index(drop=True).sort_values(ascending=ascending, na_position="last", kind="stable").index
+    df = enrich_with_equipment(df.iloc[order[(page - 1) * page_size:page * page_size]].reset_index(drop=True))
+    df['nf_assinada_str'] = np.where(df['serial'].isin(list(nf_map)), "✅ Sim", "❌ Não")
+    df['status_str'] = df['status'].map(format_status); df['periodo_str'] = df['periodo'].apply(lambda x: f"{x} dias" if pd.notna(x) and x != "N/A" else "N/A")
+    page_df = df[["serial", "modelo", "hospital", "paciente", "data_saida", "periodo_str", "status_str", "nf", "ultima_manut", "venc_manut", "nf_assinada_str"]].rename(columns={"serial": "SERIAL", "modelo": "MODELO", "hospital": "HOSPITAL", "paciente": "PACIENTE", "data_saida": "DATA SAÍDA", "periodo_str": "PERÍODO", "status_str": "STATUS", "nf": "NF", "ultima_manut": "ÚLTIMA MANUT", "venc_manut": "VENC MANUT", "nf_assinada_str": "NF ASSINADA"})
+    return page_df, total_pages
+
+def display_bombas_table(title, bombas_list, nf_map, key="bombas_tabela"):
     st.markdown(f"### {title}");
     if not bombas_list: st.info("Nenhum registro encontrado."); return
-    df = pd.DataFrame(bombas_list)
-    df['serial_normalized'] = df['serial'].apply(normalize_text)
-    if not bombas_df.empty:
-        merged_df = pd.merge(df, bombas_df, left_on='serial_normalized', right_on='Serial_Normalized', how='left')
-        df['modelo'] = merged_df['Modelo'].fillna('N/A'); df['ultima_manut'] = merged_df['Ultima_Manut'].dt.strftime('%d/%m/%Y').fillna('N/A'); df['venc_manut'] = merged_df['Venc_Manut'].dt.strftime('%d/%m/%Y').fillna('N/A')
-    else: df['modelo'] = 'N/A'; df['ultima_manut'] = 'N/A'; df['venc_manut'] = 'N/A'
-    df['nf_assinada'] = df['serial'].apply(lambda s: check_nf_assinada(s, nf_map)); df['nf_assinada_str'] = df['nf_assinada'].apply(lambda x: "✅ Sim" if x else "❌ Não")
-    df['status_html'] = df['status'].apply(format_status); df['periodo_str'] = df['periodo'].apply(lambda x: f"{x} dias" if pd.notna(x) and x != "N/A" else "N/A")
-    display_df = df[["serial", "modelo", "hospital", "paciente", "data_saida", "periodo_str", "status_html", "nf", "ultima_manut", "venc_manut", "nf_assinada_str"]].rename(columns={"serial": "SERIAL", "modelo": "MODELO", "hospital": "HOSPITAL", "paciente": "PACIENTE", "data_saida": "DATA SAÍDA", "periodo_str": "PERÍODO", "status_html": "STATUS", "nf": "NF", "ultima_manut": "ÚLTIMA MANUT", "venc_manut": "VENC MANUT", "nf_assinada_str": "NF ASSINADA"})
-    st.markdown(display_df.to_html(escape=False, index=False), unsafe_allow_html=True)
-
-def generate_excel_bombas_ativas(bombas, bombas_df, filial, nf_map):
+    col_sort, col_order, col_size, col_page = st.columns([2, 2, 1, 1])
+    sort_by = col_sort.selectbox("Ordenar por", list(BOMBAS_SORT_COLUMNS), index=3, key=f"{key}_ordem")
+    ascending = col_order.radio("Ordem", ["Decrescente", "Crescente"], horizontal=True, key=f"{key}_sentido") == "Crescente"
+    page_size = col_size.selectbox("Linhas", BOMBAS_PAGE_SIZES, key=f"{key}_tamanho")
+    total_pages = max(1, -(-len(bombas_list) // page_size))
+    # A página vive só no session_state (sem value=): o widget não avisa de valor duplicado
+    if f"{key}_pagina" not in st.session_state: st.session_state[f"{key}_pagina"] = 1
+    elif st.session_state[f"{key}_pagina"] > total_pages: st.session_state[f"{key}_pagina"] = total_pages
+    page = col_page.number_input("Página", min_value=1, max_value=total_pages, step=1, key=f"{key}_pagina")
+    page_df, total_pages = bombas_table_page(bombas_list, nf_map, sort_by, ascending, page, page_size)
+    # Estilo por célula no Styler: só as linhas da página vão para o navegador
+    st.dataframe(page_df.style.map(style_status_cell, subset=["STATUS"]), use_container_width=True, hide_index=True)
+    st.caption(f"Página {min(page, total_pages)} de {total_pages} · {len(bombas_list)} bombas")
+
+def generate_excel_bombas_ativas(bombas, filial, nf_map):
     if not bombas: return None
-    df = pd.DataFrame(bombas); df['serial_normalized'] = df['serial'].apply(normalize_text)
-    if not bombas_df.empty:
-        merged_df = pd.merge(df, bombas_df, left_on='serial_normalized', right_on='Serial_Normalized', how='left')
-        df['modelo'] = merged_df['Modelo'].fillna('N/A'); df['ultima_manut'] = merged_df['Ultima_Manut'].dt.strftime('%d/%m/%Y').fillna('N/A'); df['venc_manut'] = merged_df['Venc_Manut'].dt.strftime('%d/%m/%Y').fillna('N/A')
-    else: df['modelo'] = 'N/A'; df['ultima_manut'] = 'N/A'; df['venc_manut'] = 'N/A'
+    df = enrich_with_equipment(pd.DataFrame(bombas))
     df['nf_assinada'] = df['serial'].apply(lambda s: check_nf_assinada(s, nf_map)); df['NF ASSINADA'] = df['nf_assinada'].apply(lambda x: "Sim" if x else "Não")
     cols = ["serial", "modelo", "hospital", "paciente", "data_saida", "periodo", "status", "nf", "ultima_manut", "venc_manut", "NF ASSINADA"]
     display_cols = ["SERIAL", "MODELO", "HOSPITAL", "PACIENTE", "DATA SAÍDA", "PERÍODO", "STATUS", "NF", "ÚLTIMA MANUT", "VENC MANUT", "NF ASSINADA"]
@@ -676,6 +1308,7 @@ def main():
     if not filial and not st.session_state.get("general_mode", False):
         st.sidebar.warning("Por favor, selecione e confirme uma filial para continuar.")
         return
+    refresh_pump_status()
     if filial:
         st.markdown(f'<p class="filial-main">Filial: {filial}</p>', unsafe_allow_html=True)
     else:
@@ -935,24 +1568,13 @@ def main():
                     st.error("ERRO: O campo 'PERÍODO' deve ser um número inteiro de dias, maior que zero.")
                 else:
                     try:
-                        with st.spinner("Verificando e registrando..."):
-                            existing = supabase.table("bombas").select("id", count='exact').eq("serial", serial).eq("ativo", True).execute()
-                            if existing.count > 0:
-                                st.error(f"ERRO: A bomba com o serial '{serial}' já está registrada e ativa.")
-                            else:
-                                data_saida_fmt = data_saida.strftime("%Y-%m-%d")
-                                status_inicial = calculate_status(data_saida, periodo)
-                                new_record = {"serial": serial, "hospital": hospital, "paciente": paciente, "medico": medico, "convenio": convenio, "data_registro": datetime.now().strftime("%Y-%m-%d"), "data_saida": data_saida_fmt, "periodo": int(periodo), "status": status_inicial, "nf": nf, "pedido": pedido, "ativo": True, "filial": filial, "nf_devolucao": ""}
-                                response = supabase.table("bombas").insert(new_record).execute()
-                                if response.data:
-                                    bomba_id = response.data[0]["id"]
-                                    register_event("bombas", bomba_id, f"BOMBA REGISTRADA (SERIAL: {serial})", filial)
-                                    flush_events()
-                                    st.session_state.messages.append({"text": "Bomba registrada com sucesso!", "icon": "✅"})
-                                    st.cache_data.clear()
-                                    st.rerun()
-                                else:
-                                    st.error(f"Ocorreu um erro ao registrar a bomba. Detalhes: {response.error}")
+                        with st.spinner("Registrando..."):
+                            new_record = {"serial": serial, "hospital": hospital, "paciente": paciente, "medico": medico, "convenio": convenio, "data_registro": datetime.now().strftime("%Y-%m-%d"), "data_saida": data_saida.strftime("%Y-%m-%d"), "periodo": int(periodo), "status": calculate_status(data_saida, periodo), "nf": nf, "pedido": pedido, "ativo": True, "filial": filial, "nf_devolucao": ""}
+                            registrar_bomba(new_record)
+                        st.session_state.messages.append({"text": "Bomba registrada com sucesso!", "icon": "✅"})
+                        st.rerun()
+                    except ValueError as e:
+                        st.error(str(e))
                     except Exception as e:
                         logging.error(f"Erro no registro da bomba: {e}")
                         st.error(f"ERRO AO REGISTRAR: {e}")
@@ -962,11 +1584,10 @@ def main():
         search_term = st.text_input("Pesquisar bombas em comodato (por Serial, Paciente ou Hospital)...", key="listagem_search")
         with st.spinner("Carregando bombas..."):
             bombas_ativas = get_bombas(search_term, filial, active_only=True)
-            bombas_df = get_dados_bombas_df()
             nf_map = get_all_nfs_assinadas_info()
-        display_bombas_table("Listagem de Bombas Ativas", bombas_ativas, bombas_df, nf_map)
+        display_bombas_table("Listagem de Bombas Ativas", bombas_ativas, nf_map)
         st.markdown("---")
-        excel_buffer = generate_excel_bombas_ativas(bombas_ativas, bombas_df, filial, nf_map)
+        excel_buffer = generate_excel_bombas_ativas(bombas_ativas, filial, nf_map)
         if excel_buffer:
             st.download_button(label="✅ Baixar Listagem em Comodato (Excel)", data=excel_buffer, file_name=f"bombas_comodato_{filial}_{datetime.now().strftime('%Y%m%d')}.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
         st.markdown("---")
@@ -1013,7 +1634,7 @@ def main():
                                         register_event("bombas", bomba_to_edit['id'], f"DADOS DA BOMBA ATUALIZADOS (SERIAL: {serial})", filial)
                                         flush_events()
                                         st.session_state.messages.append({"text": "Dados da bomba atualizados!", "icon": "📝"})
-                                        st.cache_data.clear()
+                                        invalidate_caches("bombas")
                                         st.session_state.bomba_edit_key += 1
                                         st.rerun()
                                     except Exception as e:
@@ -1032,6 +1653,28 @@ def main():
                 if "pdf_to_download" in st.session_state:
                     st.download_button(label="Clique aqui para Baixar o PDF Gerado", data=st.session_state.pdf_to_download["data"], file_name=st.session_state.pdf_to_download["name"], mime="application/pdf")
                     del st.session_state.pdf_to_download
+                st.markdown("---")
+                st.subheader("Gerar Documentos em Lote")
+                bombas_lote = st.multiselect("Selecione as bombas:", bombas_ativas, format_func=lambda b: f"SERIAL: {b.get('serial', 'N/A')} | PACIENTE: {b.get('paciente', 'N/A')} | HOSPITAL: {b.get('hospital', 'N/A')}", key="pdf_lote_select", placeholder="Selecione uma ou mais bombas...")
+                formato_lote = st.radio("Formato:", ["ZIP (um PDF por bomba)", "PDF único"], key="pdf_lote_formato", horizontal=True)
+                if bombas_lote and st.button(f"Gerar Documentos de {len(bombas_lote)} Bombas", key="generate_pdf_lote_button"):
+                    progress_bar = st.progress(0.0, text="Preparando contratos...")
+                    output = "pdf" if formato_lote == "PDF único" else "zip"
+                    buffer, falhas = generate_contracts_batch(bombas_lote, output=output, progress=lambda fraction, text: progress_bar.progress(min(fraction, 1.0), text=text))
+                    if buffer:
+                        extensao, mime = ("pdf", "application/pdf") if output == "pdf" else ("zip", "application/zip")
+                        st.session_state.pdf_lote_to_download = {"data": buffer, "name": f"documentos_{filial or 'geral'}_{datetime.now().strftime('%Y%m%d_%H%M')}.{extensao}", "mime": mime}
+                        for bomba in bombas_lote:
+                            if bomba['serial'] not in falhas:
+                                register_event("bombas", bomba['id'], "DOCUMENTOS GERADOS", filial)
+                        flush_events()
+                    if falhas: st.warning(f"Não foi possível gerar os documentos de: {', '.join(falhas)}")
+                if "pdf_lote_to_download" in st.session_state:
+                    lote = st.session_state.pdf_lote_to_download
+                    st.download_button(label="Clique aqui para Baixar os Documentos", data=lote["data"], file_name=lote["name"], mime=lote["mime"])
+                    del st.session_state.pdf_lote_to_download
+                with st.expander("Conversor de PDF (LibreOffice)"):
+                    st.json(contract_pdf.get_conversion_pool().metrics())
             with tab_anexar_nf:
                 st.subheader("Anexar NF Assinada")
                 bombas_sem_nf = [b for b in bombas_ativas if not check_nf_assinada(b['serial'], nf_map)]
@@ -1043,7 +1686,7 @@ def main():
                         with st.spinner("Enviando NF..."):
                             if upload_nf_assinada(bomba_anexar, nf_file):
                                 register_event("bombas", bomba_anexar["id"], f"NF ASSINADA ENVIADA (SERIAL: {bomba_anexar['serial']})", filial)
-                                flush_events(); st.session_state.messages.append({"text": "NF assinada enviada com sucesso!", "icon": "📎"}); st.cache_data.clear(); st.rerun()
+                                flush_events(); st.session_state.messages.append({"text": "NF assinada enviada com sucesso!", "icon": "📎"}); st.rerun()
             with tab_download_nf:
                 st.subheader("Baixar NF Assinada")
                 bombas_com_nf = [b for b in bombas_ativas if check_nf_assinada(b['serial'], nf_map)]
@@ -1057,6 +1700,22 @@ def main():
                                 nf_filename_path = get_nf_assinada_filename(bomba_selecionada['serial'], nf_map)
                                 st.download_button(label="Clique aqui para baixar", data=nf_data, file_name=os.path.basename(nf_filename_path), mime="application/pdf")
                             else: st.error("Erro ao encontrar a NF para download.")
+                    st.markdown("---")
+                    st.subheader("Exportar NFs Assinadas (ZIP)")
+                    filtrar_periodo = st.checkbox("Filtrar por data de saída", key="nf_zip_filtrar")
+                    bombas_zip = bombas_com_nf
+                    if filtrar_periodo:
+                        periodo_zip = st.date_input("Período", value=(datetime.now() - timedelta(days=30), datetime.now()), format="DD/MM/YYYY", key="nf_zip_periodo")
+                        if len(periodo_zip) == 2:
+                            bombas_zip = [b for b in bombas_com_nf if data_saida_no_periodo(b, *periodo_zip)]
+                    if st.button(f"Exportar {len(bombas_zip)} NFs Assinadas", key="exportar_nfs_zip", disabled=not bombas_zip):
+                        progress_bar = st.progress(0.0, text="Baixando NFs...")
+                        zip_file, falhas, omitidos = build_nfs_assinadas_zip([get_nf_assinada_filename(b['serial'], nf_map) for b in bombas_zip], progress=lambda fraction, text: progress_bar.progress(min(fraction, 1.0), text=text))
+                        # O botão copia o conteúdo na criação; o arquivo temporário pode ser fechado logo depois
+                        with zip_file:
+                            if falhas: st.warning(f"Não foi possível baixar {len(falhas)} NF(s): {', '.join(os.path.basename(f) for f in falhas)}")
+                            if omitidos: st.warning(f"O ZIP chegou ao limite de {NF_ZIP_MAX_MB} MB e {len(omitidos)} NF(s) ficaram de fora. Filtre um período menor para exportá-las.")
+                            st.download_button(label="Clique aqui para baixar o ZIP", data=zip_file, file_name=f"nfs_assinadas_{filial or 'geral'}_{datetime.now().strftime('%Y%m%d_%H%M')}.zip", mime="application/zip")
 
     elif choice == "Devolver":
         st.markdown('<h2 style="font-size: 1.25rem; margin-bottom: 1rem;">Devolver Bomba</h2>', unsafe_allow_html=True)
@@ -1075,25 +1734,13 @@ def main():
                         st.error("Selecione uma bomba e preencha a NF de Devolução.")
                     else:
                         try:
-                            with st.spinner("Registrando devolução e desvinculando NF antiga..."):
-                                serial_devolvido = bomba['serial']
-                                nf_map = get_all_nfs_assinadas_info()
-                                nf_assinada_path = get_nf_assinada_filename(serial_devolvido, nf_map)
-                                if nf_assinada_path:
-                                    try:
-                                        supabase.storage.from_("controle-de-bombas-suplen-files").remove([nf_assinada_path])
-                                        msg_sucesso = f"Bomba {serial_devolvido} devolvida e NF assinada anterior desvinculada!"
-                                    except Exception as e_storage:
-                                        st.warning(f"Atenção: Erro ao remover a NF assinada anterior: {e_storage}")
-                                        msg_sucesso = f"Bomba {serial_devolvido} devolvida (com aviso)."
-                                else:
-                                    msg_sucesso = "Bomba devolvida com sucesso!"
-                                supabase.table("bombas").update({"ativo": False, "status": "✅ DEVOLVIDA", "data_retorno": data_retorno.strftime("%Y-%m-%d"), "nf_devolucao": nf_devolucao}).eq("id", bomba["id"]).execute()
-                                register_event("bombas", bomba["id"], f"BOMBA DEVOLVIDA (SERIAL: {bomba['serial']}) NF: {nf_devolucao}", filial)
-                                flush_events()
-                                st.session_state.messages.append({"text": msg_sucesso, "icon": "✅"})
-                                st.cache_data.clear()
-                                st.rerun()
+                            with st.spinner("Registrando devolução..."):
+                                tinha_nf = devolver_bomba(bomba, data_retorno, nf_devolucao, filial)
+                            msg_sucesso = f"Bomba {bomba['serial']} devolvida e NF assinada anterior desvinculada!" if tinha_nf else "Bomba devolvida com sucesso!"
+                            st.session_state.messages.append({"text": msg_sucesso, "icon": "✅"})
+                            st.rerun()
+                        except ValueError as e:
+                            st.error(str(e))
                         except Exception as e:
                             logging.error(f"Erro ao devolver bomba: {e}")
                             st.error(f"Erro ao registrar devolução: {e}")
@@ -1128,7 +1775,7 @@ def main():
                                     register_event("manutencao", manutencao_id, f"MANUTENÇÃO REGISTRADA (SERIAL: {serial})", filial)
                                     flush_events()
                                     st.session_state.messages.append({"text": "Manutenção registrada!", "icon": "🛠️"})
-                                    st.cache_data.clear()
+                                    invalidate_caches("manutencao", "storage:nfs/")
                                     st.rerun()
         with tabs[1]:
             st.markdown("### Listagem de Bombas em Manutenção")
@@ -1140,15 +1787,20 @@ def main():
     elif choice == "Histórico Devolvidas":
         st.markdown('<h2 style="font-size: 1.25rem; margin-bottom: 1rem;">Histórico de Bombas Devolvidas</h2>', unsafe_allow_html=True)
         search_term = st.text_input("Pesquisar no histórico (serial, NF, etc.)...", key="historico_search")
-        historico = get_historico_devolvidas(filial if not st.session_state.get("general_mode", False) else None)
+        filial_historico = filial if not st.session_state.get("general_mode", False) else None
+        # Começa pelas páginas mais recentes; "Carregar mais" busca a próxima a partir do cursor
+        if st.session_state.get("historico_consulta") != (filial_historico, search_term):
+            st.session_state.historico_consulta = (filial_historico, search_term); st.session_state.historico_paginas = 1
+        historico, tem_mais = get_historico_devolvidas(filial_historico, search_term, st.session_state.historico_paginas)
         if not historico:
-            st.info("Nenhuma bomba devolvida registrada.")
+            st.info("Nenhuma bomba devolvida encontrada." if search_term else "Nenhuma bomba devolvida registrada.")
         else:
             df = pd.DataFrame(historico, columns=["data_evento", "descricao", "filial"])
             df.columns = ["Data do Evento", "Descrição", "Filial"]
-            if search_term:
-                df = df[df.apply(lambda row: search_term.lower() in str(row.values).lower(), axis=1)]
             st.dataframe(df, use_container_width=True, hide_index=True)
+            st.caption(f"{len(historico)} eventos mais recentes" + (" (há mais)" if tem_mais else ""))
+            if tem_mais and st.button("Carregar mais", key="historico_mais"):
+                st.session_state.historico_paginas += 1; st.rerun()
 
     elif choice == "Saldo Curativo":
         st.markdown('<h2 style="font-size: 1.25rem; margin-bottom: 1rem;">Saldo de Curativos</h2>', unsafe_allow_html=True)
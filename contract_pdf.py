@@ -0,0 +1,1141 @@
+import atexit
+import hashlib
+import json
+import logging
+import os
+import pickle
+import queue
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unicodedata
+import zipfile
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from io import BytesIO
+from docx import Document
+from docx.opc.constants import CONTENT_TYPE as CT
+from docx.oxml.ns import qn
+from PyPDF2 import PageObject, PdfMerger, PdfReader, PdfWriter
+from PyPDF2._cmap import build_char_map
+from PyPDF2.generic import ArrayObject, ByteStringObject, ContentStream, DecodedStreamObject, DictionaryObject, FloatObject, NameObject, NumberObject
+
+# python3-uno (packages.txt) instala a ponte para o Python do sistema; fora dele
+# (venv do deploy) o módulo só é achado procurando também nesses diretórios
+UNO_PATHS = ["/usr/lib/python3/dist-packages", "/usr/lib/libreoffice/program"]
+
+def _import_uno():
+    """Importa a ponte UNO, procurando também nos diretórios do python3-uno; (None, None) se indisponível."""
+    extra = [path for path in UNO_PATHS if os.path.isdir(path) and path not in sys.path]
+    sys.path.extend(extra)
+    try:
+        import uno
+        from com.sun.star.beans import PropertyValue
+        return uno, PropertyValue
+    except Exception as e:  # Sem a ponte UNO cada job roda um soffice --convert-to (com perfil próprio)
+        logging.info(f"Ponte UNO indisponível ({e}); conversões via soffice --convert-to.")
+        return None, None
+    finally:
+        for path in extra:
+            sys.path.remove(path)
+
+uno, PropertyValue = _import_uno()
+
+MESES = ["Janeiro", "Fevereiro", "Março", "Abril", "Maio", "Junho", "Julho", "Agosto", "Setembro", "Outubro", "Novembro", "Dezembro"]
+
+# Tempo limite do soffice: base mais um acréscimo por arquivo do lote
+SOFFICE_TIMEOUT = 60
+SOFFICE_TIMEOUT_PER_FILE = 10
+
+# Pool de conversão: workers LibreOffice de longa duração, cada um com seu perfil.
+# Perfis ficam em subdiretórios por pid e, com a porta base 0, cada worker escuta
+# numa porta livre escolhida pelo sistema: vários processos do app não colidem
+OFFICE_WORKERS = int(os.getenv("CONTRACT_PDF_WORKERS", "2"))
+OFFICE_PROFILE_DIR = os.getenv("CONTRACT_PDF_PROFILE_DIR", os.path.join(tempfile.gettempdir(), "contract_pdf_office"))
+OFFICE_BASE_PORT = int(os.getenv("CONTRACT_PDF_BASE_PORT", "0"))
+OFFICE_START_TIMEOUT = 30
+
+# "auto" preenche por sobreposição no PDF do modelo quando o layout permite;
+# "libreoffice" sempre preenche o DOCX e converte
+CONTRACT_PDF_RENDERER = os.getenv("CONTRACT_PDF_RENDERER", "auto")
+CACHE_DIR = os.getenv("CONTRACT_PDF_CACHE_DIR", os.path.join(".cache", "contratos"))
+
+# Documentos gerados guardados em disco; acima do limite saem os menos usados
+DOCUMENT_CACHE_MAX_BYTES = int(os.getenv("CONTRACT_PDF_CACHE_MAX_MB", "200")) * 1024 * 1024
+
+# Anexos baixados em paralelo enquanto os contratos são preenchidos e convertidos
+ANNEX_PREFETCH_WORKERS = int(os.getenv("CONTRACT_PDF_ANNEX_WORKERS", "4"))
+
+def format_contract_date(data=None):
+    """Data por extenso usada no contrato, ex.: 'Brasília, 05 de Março de 2026'."""
+    data = data or datetime.now()
+    return f"Brasília, {data.day:02d} de {MESES[data.month - 1]} de {data.year}"
+
+def contract_replacements(bomba_data, data_formatada=None):
+    """Valores dos placeholders do contrato.docx para uma bomba."""
+    return {
+        "{SERIAL}": bomba_data.get("serial", "N/A"),
+        "{PACIENTE}": bomba_data.get("paciente", "N/A"),
+        "{NOTA_FISCAL}": bomba_data.get("nf", "N/A"),
+        "{DATA_ATUAL}": data_formatada or format_contract_date(),
+    }
+
+# -------------------- MODELO DOCX COMPILADO --------------------
+HEADER_FOOTER_TYPES = (CT.WML_HEADER, CT.WML_FOOTER)
+
+def _template_parts(doc):
+    """Corpo do documento mais todos os cabeçalhos e rodapés, por nome da parte."""
+    parts = {str(doc.part.partname): doc.part.element}
+    for part in doc.part.package.iter_parts():
+        if part.content_type in HEADER_FOOTER_TYPES:
+            parts[str(part.partname)] = part.element
+    return parts
+
+def _paragraph_texts(p):
+    # w:t do próprio parágrafo (inclusive dentro de hiperlinks), sem os de caixas de texto aninhadas
+    return [t for t in p.iter(qn("w:t")) if next(t.iterancestors(qn("w:p"))) is p]
+
+class CompiledTemplate:
+    """
+    contrato.docx analisado uma vez: guarda os bytes do modelo e, para cada
+    placeholder, a parte (corpo, cabeçalho ou rodapé), o parágrafo e os trechos
+    de w:t que ele ocupa, mesmo quando o Word o dividiu em vários runs. Preencher
+    é abrir o modelo e editar só esses pontos.
+    """
+    def __init__(self, template_bytes, locations):
+        self.template_bytes = template_bytes
+        # {parte: {índice do parágrafo: [(placeholder, [(índice do w:t, início, fim), ...]), ...]}}
+        self.locations = locations
+
+    @classmethod
+    def compile(cls, template_bytes):
+        doc = Document(BytesIO(template_bytes))
+        locations = {}
+        for partname, element in _template_parts(doc).items():
+            for p_index, p in enumerate(element.xpath(".//w:p")):
+                if "{" not in "".join(p.itertext()):
+                    continue
+                texts = [t.text or "" for t in _paragraph_texts(p)]
+                # posição de cada caractere do parágrafo -> (w:t, deslocamento)
+                char_map = [(t_index, offset) for t_index, text in enumerate(texts) for offset in range(len(text))]
+                found = []
+                for match in PLACEHOLDER_PATTERN.finditer("".join(texts)):
+                    segments = {}
+                    for t_index, offset in char_map[match.start():match.end()]:
+                        start, end = segments.get(t_index, (offset, offset))
+                        segments[t_index] = (start, offset + 1)
+                    found.append((match.group(), [(t_index, start, end) for t_index, (start, end) in segments.items()]))
+                if found:
+                    locations.setdefault(partname, {})[p_index] = found
+        return cls(template_bytes, locations)
+
+    @property
+    def placeholders(self):
+        return sorted({key for paragraphs in self.locations.values() for found in paragraphs.values() for key, _ in found})
+
+    def fill(self, replacements, out_path):
+        """Grava em out_path o modelo com os placeholders substituídos; os ausentes em replacements ficam como estão."""
+        doc = Document(BytesIO(self.template_bytes))
+        parts = _template_parts(doc)
+        for partname, paragraphs in self.locations.items():
+            all_paragraphs = parts[partname].xpath(".//w:p")
+            for p_index, found in paragraphs.items():
+                texts = _paragraph_texts(all_paragraphs[p_index])
+                # Da direita para a esquerda: os deslocamentos anteriores continuam válidos
+                for key, segments in reversed(found):
+                    if key not in replacements:
+                        continue
+                    for position, (t_index, start, end) in enumerate(segments):
+                        t = texts[t_index]
+                        value = str(replacements[key]) if position == 0 else ""
+                        t.text = (t.text or "")[:start] + value + (t.text or "")[end:]
+                        t.set(qn("xml:space"), "preserve")
+        doc.save(out_path)
+        return out_path
+
+_compiled_templates = {}
+
+def compile_docx_template(template_path):
+    """CompiledTemplate do modelo, compilado uma vez por versão do arquivo (hash do conteúdo)."""
+    template_hash = file_sha256(template_path)
+    if template_hash not in _compiled_templates:
+        with open(template_path, "rb") as f:
+            _compiled_templates[template_hash] = CompiledTemplate.compile(f.read())
+    return _compiled_templates[template_hash]
+
+def fill_contract_docx(template_path, bomba_data, out_path, data_formatada=None):
+    """Preenche os placeholders do modelo (corpo, tabelas, cabeçalhos e rodapés) e grava o DOCX em out_path."""
+    return compile_docx_template(template_path).fill(contract_replacements(bomba_data, data_formatada), out_path)
+
+def _converted_pdfs(docx_paths, out_dir):
+    return {docx_path: pdf_path for docx_path in docx_paths
+            if os.path.exists(pdf_path := os.path.join(out_dir, os.path.splitext(os.path.basename(docx_path))[0] + ".pdf"))}
+
+def _free_port():
+    """Porta TCP livre em 127.0.0.1, escolhida pelo sistema."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def _kill_process_group(process):
+    # soffice é um script que dispara o soffice.bin: mata o grupo inteiro
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+    process.wait()
+
+class OfficeWorker:
+    """
+    Um LibreOffice headless com perfil isolado (-env:UserInstallation). Com a ponte
+    UNO o processo fica no ar escutando numa porta local e converte vários jobs;
+    sem ela, cada job é um soffice --convert-to usando o mesmo perfil (já aquecido).
+    """
+    def __init__(self, index, profile_dir, port=0):
+        self.index = index
+        # 0: uma porta livre a cada start (um reinício não espera a porta anterior liberar)
+        self.fixed_port = port
+        self.port = port
+        self.profile_path = os.path.abspath(os.path.join(profile_dir, f"{os.getpid()}_worker_{index}"))
+        self.profile_url = "file://" + self.profile_path
+        self.process = None
+        self.desktop = None
+
+    def _base_cmd(self):
+        return ["soffice", f"-env:UserInstallation={self.profile_url}", "--headless", "--invisible", "--nologo", "--norestore", "--nodefault"]
+
+    def start(self):
+        self.port = self.fixed_port or _free_port()
+        self.process = subprocess.Popen(self._base_cmd() + [f"--accept=socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+        local = uno.getComponentContext()
+        resolver = local.ServiceManager.createInstanceWithContext("com.sun.star.bridge.UnoUrlResolver", local)
+        deadline = time.monotonic() + OFFICE_START_TIMEOUT
+        while True:
+            try:
+                ctx = resolver.resolve(f"uno:socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext")
+                self.desktop = ctx.ServiceManager.createInstanceWithContext("com.sun.star.frame.Desktop", ctx)
+                logging.info(f"Worker LibreOffice {self.index} pronto na porta {self.port}.")
+                return
+            except Exception:
+                if self.process.poll() is not None or time.monotonic() > deadline:
+                    self.stop()
+                    raise RuntimeError(f"Worker LibreOffice {self.index} não iniciou")
+                time.sleep(0.25)
+
+    def stop(self, remove_profile=False):
+        if self.process and self.process.poll() is None:
+            _kill_process_group(self.process)
+        self.process = None
+        self.desktop = None
+        if remove_profile:
+            shutil.rmtree(self.profile_path, ignore_errors=True)
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def convert(self, docx_paths, out_dir, timeout):
+        os.makedirs(out_dir, exist_ok=True)
+        if uno is None:
+            self.process = subprocess.Popen(self._base_cmd() + ["--convert-to", "pdf", "--outdir", out_dir, *docx_paths], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, start_new_session=True)
+            try:
+                _, stderr = self.process.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                _kill_process_group(self.process)
+                raise
+            finally:
+                self.process = None
+            converted = _converted_pdfs(docx_paths, out_dir)
+            if len(converted) < len(docx_paths):
+                logging.warning(f"soffice não converteu {len(docx_paths) - len(converted)} arquivo(s): {stderr.decode(errors='replace')}")
+            return converted
+        if not self.alive:
+            self.start()
+        for docx_path in docx_paths:
+            pdf_path = os.path.join(out_dir, os.path.splitext(os.path.basename(docx_path))[0] + ".pdf")
+            doc = self.desktop.loadComponentFromURL(uno.systemPathToFileUrl(os.path.abspath(docx_path)), "_blank", 0, (PropertyValue(Name="Hidden", Value=True),))
+            try:
+                doc.storeToURL(uno.systemPathToFileUrl(os.path.abspath(pdf_path)), (PropertyValue(Name="FilterName", Value="writer_pdf_Export"),))
+            finally:
+                doc.close(True)
+        return _converted_pdfs(docx_paths, out_dir)
+
+class ConversionPool:
+    """
+    Fila de conversões atendida por `size` OfficeWorkers em threads próprias.
+    Cada job tem tempo limite: estourado, o worker é derrubado e reiniciado no
+    próximo job. Se o LibreOffice cair no meio de um job, ele é refeito uma vez.
+    """
+    def __init__(self, size=OFFICE_WORKERS, profile_dir=OFFICE_PROFILE_DIR, base_port=OFFICE_BASE_PORT):
+        self.jobs = queue.Queue()
+        self.workers = [OfficeWorker(i, profile_dir, base_port + i if base_port else 0) for i in range(size)]
+        self.busy = 0
+        self.stats = {"jobs": 0, "files": 0, "failures": 0, "timeouts": 0, "restarts": 0}
+        self.durations = deque(maxlen=500)
+        self._lock = threading.Lock()
+        for worker in self.workers:
+            threading.Thread(target=self._run, args=(worker,), name=f"office-worker-{worker.index}", daemon=True).start()
+
+    def submit(self, docx_paths, out_dir, timeout=None):
+        """Enfileira um job; o Future resolve para {docx: pdf}."""
+        future = Future()
+        timeout = timeout or SOFFICE_TIMEOUT + SOFFICE_TIMEOUT_PER_FILE * len(docx_paths)
+        self.jobs.put((future, list(docx_paths), out_dir, timeout))
+        return future
+
+    def convert(self, docx_paths, out_dir, timeout=None):
+        """Divide os arquivos entre os workers e espera todos; retorna {docx: pdf} dos convertidos."""
+        if not docx_paths:
+            return {}
+        size = len(self.workers)
+        chunks = [docx_paths[i::size] for i in range(size) if docx_paths[i::size]]
+        futures = [self.submit(chunk, out_dir, timeout) for chunk in chunks]
+        converted = {}
+        for future in futures:
+            try:
+                converted.update(future.result())
+            except Exception as e:
+                logging.error(f"Falha num job de conversão: {e}")
+        return converted
+
+    def _run(self, worker):
+        while True:
+            future, docx_paths, out_dir, timeout = self.jobs.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            with self._lock:
+                self.busy += 1
+            start = time.perf_counter()
+            try:
+                future.set_result(self._convert_with_recovery(worker, docx_paths, out_dir, timeout))
+                with self._lock:
+                    self.stats["files"] += len(docx_paths)
+            except Exception as e:
+                with self._lock:
+                    self.stats["failures"] += 1
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    self.busy -= 1
+                    self.stats["jobs"] += 1
+                    self.durations.append(time.perf_counter() - start)
+
+    def _convert_with_recovery(self, worker, docx_paths, out_dir, timeout):
+        for attempt in range(2):
+            timed_out = threading.Event()
+            watchdog = threading.Timer(timeout, self._on_timeout, args=(worker, timed_out))
+            watchdog.start()
+            try:
+                return worker.convert(docx_paths, out_dir, timeout)
+            except subprocess.TimeoutExpired:
+                with self._lock:
+                    self.stats["timeouts"] += 1
+                raise TimeoutError(f"Conversão excedeu {timeout}s")
+            except Exception as e:
+                if timed_out.is_set():
+                    # O watchdog derrubou o worker: tempo esgotado, não repete
+                    raise TimeoutError(f"Conversão excedeu {timeout}s") from e
+                if attempt or uno is None:
+                    raise
+                logging.warning(f"Worker LibreOffice {worker.index} falhou ({e}); reiniciando.")
+                worker.stop()
+                with self._lock:
+                    self.stats["restarts"] += 1
+            finally:
+                watchdog.cancel()
+
+    def _on_timeout(self, worker, timed_out):
+        # Só no modo UNO: a chamada bloqueada falha quando o processo morre
+        if uno is not None and worker.alive:
+            timed_out.set()
+            logging.warning(f"Worker LibreOffice {worker.index} excedeu o tempo limite; reiniciando.")
+            worker.stop()
+            with self._lock:
+                self.stats["timeouts"] += 1
+                self.stats["restarts"] += 1
+
+    def metrics(self):
+        """Profundidade da fila, workers ocupados, contadores e tempos de conversão (s)."""
+        with self._lock:
+            durations = sorted(self.durations)
+            metrics = {"mode": "uno" if uno is not None else "subprocess", "workers": len(self.workers), "queue_depth": self.jobs.qsize(), "busy": self.busy, **self.stats}
+        if durations:
+            metrics["conversion_p50_s"] = round(durations[len(durations) // 2], 3)
+            metrics["conversion_p95_s"] = round(durations[min(len(durations) - 1, int(len(durations) * 0.95))], 3)
+            metrics["conversion_max_s"] = round(durations[-1], 3)
+        return metrics
+
+    def shutdown(self):
+        for worker in self.workers:
+            worker.stop(remove_profile=True)
+
+_conversion_pool = None
+_conversion_pool_lock = threading.Lock()
+
+def get_conversion_pool():
+    """Pool de conversão do processo, criado no primeiro uso."""
+    global _conversion_pool
+    with _conversion_pool_lock:
+        if _conversion_pool is None:
+            _conversion_pool = ConversionPool()
+            atexit.register(_conversion_pool.shutdown)
+        return _conversion_pool
+
+def convert_docx_batch(docx_paths, out_dir, timeout=None):
+    """
+    Converte vários DOCX para PDF pelo pool de workers LibreOffice, sem pagar a
+    inicialização do office a cada arquivo. Retorna {docx: pdf} dos convertidos.
+    """
+    return get_conversion_pool().convert(list(docx_paths), out_dir, timeout)
+
+def convert_docx_to_pdf(docx_path, pdf_path):
+    """Converte um único DOCX para pdf_path."""
+    converted = convert_docx_batch([docx_path], os.path.dirname(pdf_path) or ".", timeout=SOFFICE_TIMEOUT)
+    if docx_path not in converted:
+        raise FileNotFoundError(f"PDF não encontrado para {docx_path}")
+    if os.path.abspath(converted[docx_path]) != os.path.abspath(pdf_path):
+        os.replace(converted[docx_path], pdf_path)
+    return pdf_path
+
+def merge_pdfs(parts):
+    """Junta PDFs (caminhos ou bytes, None é ignorado) num BytesIO."""
+    merger = PdfMerger()
+    for part in parts:
+        if part:
+            merger.append(BytesIO(part) if isinstance(part, bytes) else part)
+    pdf_buffer = BytesIO(); merger.write(pdf_buffer); merger.close(); pdf_buffer.seek(0)
+    return pdf_buffer
+
+# -------------------- RENDERIZADOR POR SOBREPOSIÇÃO --------------------
+# Larguras (AFM, milésimos do corpo) dos caracteres ASCII 32..126 nas fontes padrão do PDF.
+# As oblíquas da Helvetica têm as larguras da reta e a Courier é monoespaçada.
+STANDARD_FONT_WIDTHS = {
+    "Helvetica": [
+        278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+        556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+        1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+        667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+        333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+        556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584,
+    ],
+    "Helvetica-Bold": [
+        278, 333, 474, 556, 556, 889, 722, 238, 333, 333, 389, 584, 278, 333, 278, 278,
+        556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 333, 333, 584, 584, 584, 611,
+        975, 722, 722, 722, 722, 667, 611, 778, 722, 278, 556, 722, 611, 833, 722, 778,
+        667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 333, 278, 333, 584, 556,
+        333, 556, 611, 556, 611, 556, 333, 611, 611, 278, 278, 556, 278, 889, 611, 611,
+        611, 611, 389, 556, 333, 611, 556, 778, 556, 556, 500, 389, 280, 389, 584,
+    ],
+    "Times-Roman": [
+        250, 333, 408, 500, 500, 833, 778, 180, 333, 333, 500, 564, 250, 333, 250, 278,
+        500, 500, 500, 500, 500, 500, 500, 500, 500, 500, 278, 278, 564, 564, 564, 444,
+        921, 722, 667, 667, 722, 611, 556, 722, 722, 333, 389, 722, 611, 889, 722, 722,
+        556, 722, 667, 556, 611, 722, 722, 944, 722, 722, 611, 333, 278, 333, 469, 500,
+        333, 444, 500, 444, 500, 444, 333, 500, 500, 278, 278, 500, 278, 778, 500, 500,
+        500, 500, 333, 389, 278, 500, 500, 722, 500, 500, 444, 480, 200, 480, 541,
+    ],
+    "Times-Bold": [
+        250, 333, 555, 500, 500, 1000, 833, 278, 333, 333, 500, 570, 250, 333, 250, 278,
+        500, 500, 500, 500, 500, 500, 500, 500, 500, 500, 333, 333, 570, 570, 570, 500,
+        930, 722, 667, 722, 722, 667, 611, 778, 778, 389, 500, 778, 667, 944, 722, 778,
+        611, 778, 722, 556, 667, 722, 722, 1000, 722, 722, 667, 333, 278, 333, 581, 500,
+        333, 500, 556, 444, 556, 444, 333, 500, 556, 278, 333, 556, 278, 833, 556, 500,
+        556, 556, 444, 389, 333, 556, 500, 722, 500, 500, 444, 394, 220, 394, 520,
+    ],
+    "Times-Italic": [
+        250, 333, 420, 500, 500, 833, 778, 214, 333, 333, 500, 675, 250, 333, 250, 278,
+        500, 500, 500, 500, 500, 500, 500, 500, 500, 500, 333, 333, 675, 675, 675, 500,
+        920, 611, 611, 667, 722, 611, 611, 722, 722, 333, 444, 667, 556, 833, 667, 722,
+        611, 722, 611, 500, 556, 722, 611, 833, 611, 556, 556, 389, 278, 389, 422, 500,
+        333, 500, 500, 444, 500, 444, 278, 500, 500, 278, 278, 444, 278, 722, 500, 500,
+        500, 500, 389, 389, 278, 500, 444, 667, 444, 444, 389, 400, 275, 400, 541,
+    ],
+    "Times-BoldItalic": [
+        250, 389, 555, 500, 500, 833, 778, 278, 333, 333, 500, 570, 250, 333, 250, 278,
+        500, 500, 500, 500, 500, 500, 500, 500, 500, 500, 333, 333, 570, 570, 570, 500,
+        832, 667, 667, 667, 722, 667, 667, 722, 778, 389, 500, 667, 611, 889, 722, 722,
+        611, 722, 667, 556, 611, 722, 667, 889, 667, 611, 611, 333, 278, 333, 570, 500,
+        333, 500, 500, 444, 500, 444, 333, 500, 556, 278, 278, 500, 278, 778, 556, 500,
+        500, 500, 389, 389, 278, 556, 444, 667, 500, 444, 389, 348, 220, 348, 570,
+    ],
+}
+STANDARD_FONT_WIDTHS["Helvetica-Oblique"] = STANDARD_FONT_WIDTHS["Helvetica"]
+STANDARD_FONT_WIDTHS["Helvetica-BoldOblique"] = STANDARD_FONT_WIDTHS["Helvetica-Bold"]
+for _courier in ("Courier", "Courier-Bold", "Courier-Oblique", "Courier-BoldOblique"):
+    STANDARD_FONT_WIDTHS[_courier] = [600] * 95
+STANDARD_FONTS = sorted(STANDARD_FONT_WIDTHS)
+
+# Fontes do modelo (nome sem o prefixo do subconjunto) e a fonte padrão de mesmas
+# métricas usada para reescrever o trecho: (regular, negrito, itálico, negrito itálico)
+FONT_FAMILIES = [
+    (("LIBERATIONSERIF", "TIMESNEWROMAN", "TIMES"), ("Times-Roman", "Times-Bold", "Times-Italic", "Times-BoldItalic")),
+    (("LIBERATIONSANS", "ARIAL", "HELVETICA"), ("Helvetica", "Helvetica-Bold", "Helvetica-Oblique", "Helvetica-BoldOblique")),
+    (("LIBERATIONMONO", "COURIERNEW", "COURIER"), ("Courier", "Courier-Bold", "Courier-Oblique", "Courier-BoldOblique")),
+]
+# Trechos de uma mesma linha mais distantes que isto (em corpos) estão em colunas/tabulações diferentes
+RUN_GAP_TOLERANCE = 0.5
+PLACEHOLDER_PATTERN = re.compile(r"\{[A-Z_]+\}")
+OVERLAY_CACHE_VERSION = 3
+
+def standard_font(base_font):
+    """Fonte padrão com as métricas de `base_font`, ou None se não há equivalente."""
+    name = re.sub(r"[\s,_-]", "", (base_font or "").split("+")[-1].upper())
+    if "NARROW" in name or "CONDENSED" in name:
+        return None
+    for prefixes, variants in FONT_FAMILIES:
+        if name.startswith(prefixes):
+            return variants[("BOLD" in name) + 2 * ("ITALIC" in name or "OBLIQUE" in name)]
+    return None
+
+def text_width(text, size, font="Helvetica"):
+    """Largura de `text` na fonte padrão `font`, no corpo `size` (acentos contam como a letra base)."""
+    widths = STANDARD_FONT_WIDTHS[font]
+    total = 0
+    for char in text:
+        base = unicodedata.normalize("NFKD", char)[:1] or char
+        code = ord(base)
+        total += widths[code - 32] if 32 <= code <= 126 else widths[ord("n") - 32]
+    return total * size / 1000.0
+
+def _mult(m, n):
+    return [
+        m[0] * n[0] + m[1] * n[2], m[0] * n[1] + m[1] * n[3],
+        m[2] * n[0] + m[3] * n[2], m[2] * n[1] + m[3] * n[3],
+        m[4] * n[0] + m[5] * n[2] + n[4], m[4] * n[1] + m[5] * n[3] + n[5],
+    ]
+
+def _raw_bytes(operand):
+    return operand.get_original_bytes() if hasattr(operand, "get_original_bytes") else bytes(operand)
+
+def _decode_pdf_bytes(raw, font):
+    if font is None:
+        return raw.decode("latin-1")
+    encoding, map_dict = font
+    if isinstance(encoding, str):
+        try:
+            text = raw.decode(encoding, "surrogatepass")
+        except Exception:
+            text = raw.decode("utf-16-be" if encoding == "charmap" else "charmap", "surrogatepass")
+    else:
+        text = "".join(encoding.get(byte, chr(byte)) for byte in raw)
+    return "".join(map_dict.get(char, char) for char in text)
+
+def _font_metrics(font_dict):
+    """
+    (nome, larguras código -> milésimos, largura padrão) de uma fonte simples, ou
+    None para fontes compostas ou sem larguras conhecidas (esses trechos não são medidos).
+    """
+    font_dict = font_dict.get_object()
+    base_font = str(font_dict.get("/BaseFont", "")).lstrip("/")
+    if font_dict.get("/Subtype") not in ("/Type1", "/TrueType", "/MMType1"):
+        return None
+    if "/Widths" in font_dict:
+        first = int(font_dict.get("/FirstChar", 0))
+        descriptor = font_dict.get("/FontDescriptor")
+        missing = float(descriptor.get_object().get("/MissingWidth", 0)) if descriptor else 0.0
+        return base_font, {first + i: float(width) for i, width in enumerate(font_dict["/Widths"].get_object())}, missing
+    if base_font in STANDARD_FONT_WIDTHS:
+        return base_font, None, 0.0
+    return None
+
+def extract_text_runs(page):
+    """
+    Trechos de texto da página: posição de início (x, y da linha de base), fim, corpo
+    efetivo, fonte e índice do operador no content stream. `glyphs` lista (texto do
+    glifo, avanço) na ordem do operador, com os ajustes do TJ como (None, avanço); fica
+    None quando a fonte não pode ser medida.
+    """
+    contents = page.get_contents()
+    if contents is None:
+        return []
+    if not isinstance(contents, ContentStream):
+        contents = ContentStream(contents, page.pdf)
+    resources = (page.get("/Resources") or DictionaryObject()).get_object()
+    font_resources = (resources.get("/Font") or DictionaryObject()).get_object()
+    fonts = {}
+    runs = []
+    ctm, stack = [1, 0, 0, 1, 0, 0], []
+    tm = tlm = [1, 0, 0, 1, 0, 0]
+    font, metrics, font_size, leading = None, None, 0.0, 0.0
+    char_spacing, word_spacing, horizontal_scale = 0.0, 0.0, 1.0
+
+    def show(parts):
+        nonlocal tm
+        matrix = _mult(tm, ctm)
+        x, y = matrix[4:6]
+        scale = (abs(tm[3] * ctm[3]) or abs(tm[0] * ctm[0]))
+        glyphs, text_advance = [], 0.0
+        for part in parts:
+            if isinstance(part, (int, float, NumberObject, FloatObject)):
+                advance = -float(part) / 1000 * font_size * horizontal_scale
+                glyphs.append((None, advance * matrix[0]))
+                text_advance += advance
+                continue
+            for code in _raw_bytes(part):
+                piece = _decode_pdf_bytes(bytes([code]), font)
+                if metrics is None:
+                    width = 0.0
+                elif metrics[1] is None:
+                    width = text_width(piece, 1000, metrics[0])
+                else:
+                    width = metrics[1].get(code, metrics[2])
+                advance = (width / 1000 * font_size + char_spacing + (word_spacing if code == 32 else 0.0)) * horizontal_scale
+                glyphs.append((piece, advance * matrix[0]))
+                text_advance += advance
+        text = "".join(piece for piece, _ in glyphs if piece)
+        tm = _mult([1, 0, 0, 1, text_advance, 0], tm)
+        if text:
+            runs.append({
+                "text": text, "x": x, "y": y, "end": x + sum(advance for _, advance in glyphs),
+                "size": font_size * scale, "font": metrics[0] if metrics else None,
+                "glyphs": glyphs if metrics else None, "char_spacing": char_spacing * scale, "word_spacing": word_spacing * scale,
+                "horizontal_scale": horizontal_scale, "rotated": bool(matrix[1] or matrix[2]), "op": op_index,
+            })
+
+    for op_index, (operands, operator) in enumerate(contents.operations):
+        if operator == b"q":
+            stack.append((ctm, char_spacing, word_spacing, horizontal_scale))
+        elif operator == b"Q":
+            ctm, char_spacing, word_spacing, horizontal_scale = stack.pop() if stack else ([1, 0, 0, 1, 0, 0], 0.0, 0.0, 1.0)
+        elif operator == b"cm":
+            ctm = _mult([float(v) for v in operands], ctm)
+        elif operator == b"BT":
+            tm = tlm = [1, 0, 0, 1, 0, 0]
+        elif operator == b"Tf":
+            name = operands[0]
+            if name not in fonts:
+                try:
+                    _, _, encoding, map_dict, _ = build_char_map(name, 200.0, page)
+                    decoder = (encoding, map_dict)
+                except Exception:
+                    decoder = None
+                try:
+                    font_metrics = _font_metrics(font_resources[name])
+                except Exception:
+                    font_metrics = None
+                fonts[name] = (decoder, font_metrics)
+            (font, metrics), font_size = fonts[name], float(operands[1])
+        elif operator == b"Tc":
+            char_spacing = float(operands[0])
+        elif operator == b"Tw":
+            word_spacing = float(operands[0])
+        elif operator == b"Tz":
+            horizontal_scale = float(operands[0]) / 100
+        elif operator == b"TL":
+            leading = float(operands[0])
+        elif operator in (b"Td", b"TD"):
+            if operator == b"TD":
+                leading = -float(operands[1])
+            tm = tlm = _mult([1, 0, 0, 1, float(operands[0]), float(operands[1])], tlm)
+        elif operator == b"Tm":
+            tm = tlm = [float(v) for v in operands]
+        elif operator in (b"T*", b"'", b'"'):
+            tm = tlm = _mult([1, 0, 0, 1, 0, -leading], tlm)
+            if operator == b'"':
+                word_spacing, char_spacing = float(operands[0]), float(operands[1])
+            if operator != b"T*":
+                show([operands[-1]])
+        elif operator == b"Tj":
+            show([operands[0]])
+        elif operator == b"TJ":
+            show(list(operands[0]))
+    return runs
+
+def _split_run(run, char_index):
+    """(glifos mantidos, x) do corte de `run` antes do caractere `char_index`, ou None se o corte cai dentro de um glifo."""
+    seen, kept, x = 0, 0, run["x"]
+    for piece, advance in run["glyphs"]:
+        if piece is not None:
+            if seen == char_index:
+                return kept, x
+            if seen + len(piece) > char_index:
+                return None
+            seen += len(piece)
+            kept += 1
+        x += advance
+    return (kept, x) if seen == char_index else None
+
+def _truncated_string(operand, keep):
+    return ByteStringObject(_raw_bytes(operand)[:keep])
+
+def _truncated_array(array, keep):
+    kept = ArrayObject()
+    for part in array:
+        if keep <= 0:
+            break
+        if isinstance(part, (int, float, NumberObject, FloatObject)):
+            kept.append(part)
+        else:
+            raw = _raw_bytes(part)[:keep]
+            kept.append(ByteStringObject(raw))
+            keep -= len(raw)
+    return kept
+
+class OverlayTemplate:
+    """
+    Modelo do contrato já convertido para PDF, com a posição de cada placeholder.
+    Preencher é apagar o texto a partir do placeholder até o fim do trecho contínuo da
+    linha e escrevê-lo de novo, com os valores, na fonte padrão de mesmas métricas e no
+    mesmo corpo. O que vem antes do placeholder fica intacto.
+    """
+    def __init__(self, pdf_bytes, lines):
+        self.pdf_bytes = pdf_bytes
+        self.lines = lines
+
+    def render(self, replacements):
+        """PDF preenchido em bytes, ou None se algum valor não couber na linha (usa-se o LibreOffice)."""
+        stamps = {}
+        for line in self.lines:
+            x, parts = line["x"], []
+            for segment in line["segments"]:
+                text = segment["text"]
+                for key, value in replacements.items():
+                    text = text.replace(key, str(value))
+                try:
+                    encoded = text.encode("cp1252")
+                except UnicodeEncodeError:
+                    return None
+                encoded = encoded.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)")
+                parts.append(b"BT /S%d %.2f Tf %.3f Tc %.1f Tz 1 0 0 1 %.2f %.2f Tm (%s) Tj ET" % (
+                    STANDARD_FONTS.index(segment["font"]), segment["size"], segment["char_spacing"], segment["horizontal_scale"] * 100, x, line["y"], encoded))
+                x += (text_width(text, segment["size"], segment["font"]) + segment["char_spacing"] * len(text)) * segment["horizontal_scale"]
+            if x > line["limit"]:
+                return None
+            page_stamps = stamps.setdefault(line["page"], {"cuts": [], "content": [], "fonts": set()})
+            page_stamps["cuts"].extend(line["cuts"])
+            page_stamps["content"].extend(parts)
+            page_stamps["fonts"].update(segment["font"] for segment in line["segments"])
+        reader = PdfReader(BytesIO(self.pdf_bytes))
+        writer = PdfWriter()
+        for index, page in enumerate(reader.pages):
+            if index in stamps:
+                self._drop_text(page, stamps[index]["cuts"])
+                page.merge_page(self._overlay_page(page, b"\n".join(stamps[index]["content"]), stamps[index]["fonts"]))
+            writer.add_page(page)
+        buffer = BytesIO(); writer.write(buffer)
+        return buffer.getvalue()
+
+    @staticmethod
+    def _drop_text(page, cuts):
+        # Cada operador fica só com os `keep` primeiros glifos; ' e " mantêm o avanço de linha
+        contents = ContentStream(page.get_contents(), page.pdf)
+        for op_index, keep in cuts:
+            operands, operator = contents.operations[op_index]
+            if operator == b"TJ":
+                contents.operations[op_index] = ([_truncated_array(operands[0], keep)], operator)
+            else:
+                contents.operations[op_index] = (list(operands[:-1]) + [_truncated_string(operands[-1], keep)], operator)
+        page[NameObject("/Contents")] = contents
+
+    @staticmethod
+    def _overlay_page(page, content, fonts):
+        overlay = PageObject.create_blank_page(width=page.mediabox.width, height=page.mediabox.height)
+        font_resources = DictionaryObject()
+        for name in fonts:
+            font_resources[NameObject(f"/S{STANDARD_FONTS.index(name)}")] = DictionaryObject({
+                NameObject("/Type"): NameObject("/Font"), NameObject("/Subtype"): NameObject("/Type1"),
+                NameObject("/BaseFont"): NameObject(f"/{name}"), NameObject("/Encoding"): NameObject("/WinAnsiEncoding"),
+            })
+        overlay[NameObject("/Resources")] = DictionaryObject({NameObject("/Font"): font_resources})
+        stream = DecodedStreamObject()
+        stream.set_data(content)
+        overlay[NameObject("/Contents")] = stream
+        return overlay
+
+def _placeholder_line(row):
+    """
+    Corte e trechos a reescrever de uma linha com placeholders, ou o motivo (str)
+    para não usar a sobreposição neste modelo.
+    """
+    text = "".join(run["text"] for run in row)
+    found = PLACEHOLDER_PATTERN.findall(text)
+    if text.count("{") != len(found):
+        return f"placeholder incompleto na linha '{text}'"
+    if any(run["glyphs"] is None or run["rotated"] for run in row):
+        return f"fonte sem larguras conhecidas ou texto girado na linha '{text}'"
+    first = next(i for i, run in enumerate(row) if "{" in run["text"])
+    # Linha justificada: o Tw alarga os espaços e a reescrita (sem Tw) mudaria o alinhamento
+    if any(run["word_spacing"] and " " in run["text"] for run in row[first:]):
+        return f"espaçamento entre palavras (Tw) na linha justificada '{text}'"
+    for previous, run in zip(row, row[1:]):
+        if abs(run["x"] - previous["end"]) > RUN_GAP_TOLERANCE * max(run["size"], previous["size"]):
+            return f"trechos separados (tabela ou tabulação) na linha '{text}'"
+    char_index = row[first]["text"].index("{")
+    cut = _split_run(row[first], char_index)
+    if cut is None:
+        return f"placeholder dentro de um glifo na linha '{text}'"
+    segments = []
+    for i, run in enumerate(row[first:]):
+        font = standard_font(run["font"])
+        if font is None:
+            return f"fonte '{run['font']}' sem equivalente padrão na linha '{text}'"
+        piece = run["text"][char_index:] if i == 0 else run["text"]
+        style = (font, round(run["size"], 2), round(run["char_spacing"], 3), run["horizontal_scale"])
+        # Trechos seguidos com o mesmo estilo viram um só (placeholder partido entre operadores)
+        if segments and segments[-1]["style"] == style:
+            segments[-1]["text"] += piece
+        else:
+            segments.append({"style": style, "text": piece})
+    if sum(len(PLACEHOLDER_PATTERN.findall(segment["text"])) for segment in segments) != len(found):
+        return f"placeholder com estilos diferentes na linha '{text}'"
+    return {
+        "x": cut[1], "y": row[0]["y"], "end": row[-1]["end"],
+        "cuts": [(row[first]["op"], cut[0])] + [(run["op"], 0) for run in row[first + 1:]],
+        "segments": [dict(zip(("font", "size", "char_spacing", "horizontal_scale"), segment["style"]), text=segment["text"]) for segment in segments],
+    }
+
+def compile_overlay_template(template_pdf, placeholders=None):
+    """
+    Localiza no PDF do modelo as linhas com placeholders. Retorna None quando o
+    layout não permite a sobreposição (placeholder quebrado entre linhas, trechos da
+    linha em colunas separadas, linha justificada, fonte sem equivalente padrão, texto
+    girado etc.) ou quando os placeholders achados no PDF não são os `placeholders`
+    do DOCX (um que o extrator não leu sairia como {CAMPO} no contrato), e aí o
+    contrato segue pelo LibreOffice.
+    """
+    reader = PdfReader(BytesIO(template_pdf))
+    lines = []
+    for index, page in enumerate(reader.pages):
+        runs = extract_text_runs(page)
+        page_right = float(page.mediabox.right)
+        left_margin = min((run["x"] for run in runs), default=0.0)
+        by_baseline = {}
+        for run in runs:
+            by_baseline.setdefault(round(run["y"], 1), []).append(run)
+        for row in by_baseline.values():
+            if "{" not in "".join(run["text"] for run in row):
+                continue
+            row.sort(key=lambda run: run["x"])
+            line = _placeholder_line(row)
+            if isinstance(line, str):
+                logging.warning(f"Sobreposição desativada: {line}.")
+                return None
+            # O texto reescrito pode ir até a margem direita (simétrica à esquerda)
+            line.update(page=index, limit=max(page_right - left_margin, line.pop("end")))
+            lines.append(line)
+    if not lines:
+        logging.warning("Nenhum placeholder encontrado no PDF do modelo; sobreposição desativada.")
+        return None
+    located = {key for line in lines for segment in line["segments"] for key in PLACEHOLDER_PATTERN.findall(segment["text"])}
+    if placeholders is not None and located != set(placeholders):
+        logging.warning(f"Sobreposição desativada: placeholders do DOCX não localizados no PDF {sorted(set(placeholders) - located)}, "
+                        f"a mais no PDF {sorted(located - set(placeholders))}.")
+        return None
+    return OverlayTemplate(template_pdf, lines)
+
+_overlay_templates = {}
+
+def get_overlay_template(template_path):
+    """
+    OverlayTemplate do modelo, convertido pelo LibreOffice uma vez por versão do
+    arquivo (hash do conteúdo) e guardado em memória e em disco. None se o
+    modelo não admite sobreposição.
+    """
+    template_hash = file_sha256(template_path)
+    if template_hash in _overlay_templates:
+        return _overlay_templates[template_hash]
+    cache_path = os.path.join(CACHE_DIR, f"overlay_v{OVERLAY_CACHE_VERSION}_{template_hash}.pkl")
+    overlay = None
+    try:
+        with open(cache_path, "rb") as f:
+            overlay = pickle.load(f)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logging.warning(f"Cache do modelo de sobreposição ilegível ({e}); recompilando.")
+    if overlay is None:
+        try:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                pdf_path = convert_docx_to_pdf(template_path, os.path.join(temp_dir, "modelo.pdf"))
+                with open(pdf_path, "rb") as f:
+                    overlay = compile_overlay_template(f.read(), compile_docx_template(template_path).placeholders)
+        except Exception as e:
+            # Não tenta de novo nesta versão do modelo; segue pelo LibreOffice
+            logging.error(f"Erro ao compilar o modelo para sobreposição: {e}")
+            _overlay_templates[template_hash] = None
+            return None
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(overlay if overlay else False, f)
+        os.replace(tmp_path, cache_path)
+    _overlay_templates[template_hash] = overlay or None
+    return _overlay_templates[template_hash]
+
+def render_overlay(template_path, bomba_data, data_formatada=None):
+    """Contrato preenchido por sobreposição (bytes), ou None para cair no LibreOffice."""
+    if CONTRACT_PDF_RENDERER == "libreoffice":
+        return None
+    overlay = get_overlay_template(template_path)
+    if overlay is None:
+        return None
+    pdf = overlay.render(contract_replacements(bomba_data, data_formatada))
+    if pdf is None:
+        logging.info(f"Contrato da bomba {bomba_data.get('serial')} não cabe no layout; usando o LibreOffice.")
+    return pdf
+
+# -------------------- CACHE DE DOCUMENTOS --------------------
+_file_hashes = {}
+
+def file_sha256(path):
+    """sha256 do arquivo, recalculado só quando o tamanho ou o mtime mudam."""
+    stat = os.stat(path)
+    signature = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if signature not in _file_hashes:
+        with open(path, "rb") as f:
+            _file_hashes[signature] = hashlib.sha256(f.read()).hexdigest()
+    return _file_hashes[signature]
+
+class DocumentCache:
+    """
+    PDFs gerados, endereçados pelo hash de tudo que os define: modelo, valores
+    dos placeholders, data de emissão e ETag do anexo. Mudou qualquer entrada,
+    muda a chave; as versões antigas saem pelo limite de tamanho (LRU por mtime).
+    """
+    def __init__(self, directory=os.path.join(CACHE_DIR, "documentos"), max_bytes=DOCUMENT_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(template_hash, replacements, data_emissao, annex_etag):
+        payload = json.dumps([template_hash, sorted((k, str(v)) for k, v in replacements.items()), data_emissao, annex_etag], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.pdf")
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+            os.utime(self._path(key))  # marca como usado recentemente
+            self.hits += 1
+            return data
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+
+    def put(self, key, data):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self._path(key))
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if entry.name.endswith(".pdf"):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except FileNotFoundError:
+                    pass
+
+_document_cache = None
+
+def get_document_cache():
+    global _document_cache
+    if _document_cache is None:
+        _document_cache = DocumentCache()
+    return _document_cache
+
+def _document_key(template_path, bomba_data, data_formatada, annex_etag):
+    if annex_etag is None:
+        return None
+    return DocumentCache.key(file_sha256(template_path), contract_replacements(bomba_data, data_formatada), data_formatada, annex_etag)
+
+_annex_executor = ThreadPoolExecutor(max_workers=ANNEX_PREFETCH_WORKERS, thread_name_prefix="anexos")
+
+def prefetch_annex(fetch_annex, serial):
+    """Começa a baixar o anexo de `serial` em segundo plano; None sem fetch_annex."""
+    if not fetch_annex:
+        return None
+    return _annex_executor.submit(fetch_annex, serial)
+
+def _annex_result(future, serial):
+    if future is None:
+        return None
+    try:
+        return future.result()
+    except Exception as e:
+        logging.error(f"Erro ao baixar o anexo da bomba {serial}: {e}")
+        return None
+
+def _annex_failed(future, annex, etag):
+    """O anexo foi pedido e não veio, sem o storage ter dito que ele não existe (ETag "")."""
+    return future is not None and annex is None and etag != ""
+
+def _safe_name(text):
+    return re.sub(r"[^A-Za-z0-9_-]+", "_", str(text)) or "SEM_SERIAL"
+
+def render_contracts(template_path, bombas, fetch_annex=None, output="zip", progress=None, annex_etag=None):
+    """
+    Gera os documentos (contrato preenchido + pdfs/{serial}.pdf) de várias bombas.
+    Os contratos que não saem por sobreposição vão numa única conversão do LibreOffice;
+    os anexos são baixados em paralelo enquanto isso.
+
+    output="zip" devolve um ZIP com documentos_{serial}.pdf por bomba; "pdf" devolve
+    um único PDF com todas em sequência. progress(fração, texto) recebe o andamento.
+    annex_etag(serial) ("" sem anexo, None se desconhecido) habilita o cache de documentos.
+    Retorna (BytesIO, lista de seriais que falharam).
+    """
+    progress = progress or (lambda fraction, text: None)
+    total = len(bombas)
+    data_formatada = format_contract_date()
+    failures = []
+    cache = get_document_cache()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        contracts, docx_by_index, keys, etags, cached, annexes = {}, {}, {}, {}, {}, {}
+        for i, bomba in enumerate(bombas):
+            serial = bomba.get("serial", "N/A")
+            progress(0.3 * i / total, f"Preenchendo contrato {i + 1}/{total} ({serial})")
+            try:
+                etags[i] = annex_etag(serial) if annex_etag else None
+                keys[i] = _document_key(template_path, bomba, data_formatada, etags[i])
+                cached[i] = cache.get(keys[i]) if keys[i] else None
+                if cached[i] is not None:
+                    continue
+                if serial not in annexes:
+                    annexes[serial] = prefetch_annex(fetch_annex, serial)
+                contracts[i] = render_overlay(template_path, bomba, data_formatada)
+                if contracts[i] is None:
+                    docx_path = os.path.join(temp_dir, f"contrato_{i:04d}_{_safe_name(serial)}.docx")
+                    docx_by_index[i] = fill_contract_docx(template_path, bomba, docx_path, data_formatada)
+            except Exception as e:
+                logging.error(f"Erro ao preencher contrato da bomba {serial}: {e}")
+                failures.append(serial)
+
+        if docx_by_index:
+            progress(0.3, f"Convertendo {len(docx_by_index)} contratos para PDF...")
+            converted = convert_docx_batch(list(docx_by_index.values()), os.path.join(temp_dir, "pdf"))
+            for i, docx_path in docx_by_index.items():
+                contracts[i] = converted.get(docx_path)
+
+        documents = []
+        for i, bomba in enumerate(bombas):
+            serial = bomba.get("serial", "N/A")
+            if cached.get(i) is not None:
+                documents.append((serial, cached[i]))
+                continue
+            if i not in contracts:
+                continue
+            progress(0.6 + 0.4 * i / total, f"Anexando documentos {i + 1}/{total} ({serial})")
+            pdf_path = contracts[i]
+            if not pdf_path:
+                failures.append(serial)
+                continue
+            annex = _annex_result(annexes.get(serial), serial)
+            document = merge_pdfs([pdf_path, annex]).getvalue()
+            # Sem o anexo (download falhou) o documento é entregue, mas não vai para o cache
+            if keys.get(i) and not _annex_failed(annexes.get(serial), annex, etags[i]):
+                cache.put(keys[i], document)
+            documents.append((serial, document))
+
+        buffer = BytesIO()
+        if output == "pdf":
+            buffer = merge_pdfs([document for _, document in documents])
+        else:
+            names = {}
+            with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zf:
+                for serial, document in documents:
+                    name = f"documentos_{_safe_name(serial)}"
+                    names[name] = names.get(name, 0) + 1
+                    suffix = f"_{names[name]}" if names[name] > 1 else ""
+                    zf.writestr(f"{name}{suffix}.pdf", document)
+            buffer.seek(0)
+    progress(1.0, f"{len(documents)} de {total} documentos gerados.")
+    logging.info(f"Lote de contratos: {len(documents)} gerados, {len(failures)} falhas.")
+    return buffer, failures
+
+def render_contract(template_path, bomba_data, fetch_annex=None, annex_etag=None):
+    """
+    Documentos de uma bomba: por sobreposição quando possível, senão um soffice,
+    com o anexo sendo baixado durante o preenchimento.
+    Com annex_etag ("" sem anexo) o resultado vem do / vai para o cache de documentos.
+    """
+    serial = bomba_data.get("serial", "N/A")
+    data_formatada = format_contract_date()
+    cache = get_document_cache()
+    key = _document_key(template_path, bomba_data, data_formatada, annex_etag)
+    document = cache.get(key) if key else None
+    if document is not None:
+        return BytesIO(document)
+    annex = prefetch_annex(fetch_annex, serial)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        contract = render_overlay(template_path, bomba_data, data_formatada)
+        if contract is None:
+            docx_path = fill_contract_docx(template_path, bomba_data, os.path.join(temp_dir, f"contrato_{_safe_name(serial)}.docx"), data_formatada)
+            contract = convert_docx_to_pdf(docx_path, os.path.join(temp_dir, f"contrato_{_safe_name(serial)}.pdf"))
+        annex_pdf = _annex_result(annex, serial)
+        buffer = merge_pdfs([contract, annex_pdf])
+    # Sem o anexo (download falhou) o documento é entregue, mas não vai para o cache
+    if key and not _annex_failed(annex, annex_pdf, annex_etag):
+        cache.put(key, buffer.getvalue())
+    return buffer
+
+def benchmark_contracts(n_pumps=20, template_path="contrato.docx"):
+    """Compara, para n bombas, o LibreOffice bomba a bomba, o lote no LibreOffice e a sobreposição."""
+    global CONTRACT_PDF_RENDERER
+    bombas = [{"serial": f"BENCH{i:04d}", "paciente": f"PACIENTE {i}", "nf": str(1000 + i)} for i in range(n_pumps)]
+    renderer = CONTRACT_PDF_RENDERER
+    try:
+        CONTRACT_PDF_RENDERER = "libreoffice"
+        start = time.perf_counter()
+        for bomba in bombas:
+            render_contract(template_path, bomba)
+        sequential_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        _, failures = render_contracts(template_path, bombas, output="zip")
+        batch_seconds = time.perf_counter() - start
+
+        CONTRACT_PDF_RENDERER = "auto"
+        start = time.perf_counter()
+        overlay = get_overlay_template(template_path)
+        compile_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        render_contracts(template_path, bombas, output="zip")
+        overlay_seconds = time.perf_counter() - start
+    finally:
+        CONTRACT_PDF_RENDERER = renderer
+
+    print(f"Bombas: {n_pumps}")
+    print(f"Sequencial (um soffice por bomba): {sequential_seconds:.2f}s")
+    print(f"Lote (um soffice para todas): {batch_seconds:.2f}s")
+    if failures:
+        print(f"Falhas no lote: {', '.join(failures)}")
+    if batch_seconds > 0:
+        print(f"Ganho do lote: {sequential_seconds / batch_seconds:.1f}x")
+    if overlay is None:
+        print("Sobreposição indisponível para este modelo (usa o LibreOffice).")
+    else:
+        print(f"Sobreposição: {overlay_seconds:.3f}s (+{compile_seconds:.2f}s para compilar o modelo, uma vez por versão)")
+        if overlay_seconds > 0:
+            print(f"Ganho da sobreposição: {sequential_seconds / overlay_seconds:.1f}x")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if len(sys.argv) > 1 and sys.argv[1] == "--benchmark":
+        benchmark_contracts(int(sys.argv[2]) if len(sys.argv) > 2 else 20, *sys.argv[3:4])
+    else:
+        print("Uso: python contract_pdf.py --benchmark [n_bombas] [modelo.docx]")
@@ -0,0 +1,32 @@
+import logging
+import os
+import sys
+import time
+from dotenv import load_dotenv
+
+def benchmark_dashboard_metrics(app, filial=None, repeats=5):
+    """Compara tempo e resultado das métricas do dashboard via RPC e em pandas (funções do `app` importado)."""
+    results = {}
+    for name, compute in (("rpc", app.get_dashboard_metrics_rpc), ("pandas", app.get_dashboard_metrics_pandas)):
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            results[name] = compute(filial)
+            timings.append(time.perf_counter() - start)
+        timings.sort()
+        print(f"{name}: mediana {timings[len(timings) // 2] * 1000:.1f} ms, mínimo {timings[0] * 1000:.1f} ms ({repeats} execuções)")
+    rpc, local = results["rpc"] or {}, results["pandas"] or {}
+    for key in sorted(set(rpc) | set(local)):
+        a, b = rpc.get(key), local.get(key)
+        if key == "modelos_por_filial":
+            a, b = (sorted(tuple(sorted(record.items())) for record in records or []) for records in (a, b))
+        print(f"{'igual' if a == b else 'DIFERENTE'}: {key}" + ("" if a == b else f"\n  rpc:    {a}\n  pandas: {b}"))
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    load_dotenv()
+    # Sem credenciais o app para na importação (st.stop); aqui basta avisar
+    if not os.getenv("SUPABASE_URL") or not os.getenv("SUPABASE_KEY"):
+        sys.exit("Variáveis SUPABASE_URL ou SUPABASE_KEY não encontradas no arquivo .env.")
+    import app
+    benchmark_dashboard_metrics(app, sys.argv[1] if len(sys.argv) > 1 else None, *(int(arg) for arg in sys.argv[2:3]))
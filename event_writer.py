@@ -0,0 +1,334 @@
+import atexit
+import json
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+
+# Lote máximo por insert e intervalo máximo (s) entre o registro e o envio
+EVENT_BATCH_SIZE = int(os.getenv("EVENT_BATCH_SIZE", "50"))
+EVENT_FLUSH_INTERVAL = float(os.getenv("EVENT_FLUSH_INTERVAL", "2"))
+EVENT_JOURNAL_PATH = os.getenv("EVENT_JOURNAL_PATH", os.path.join(".cache", "eventos", "historico.sqlite3"))
+
+# Espera máxima entre tentativas com o Supabase fora do ar (as tentativas não têm limite)
+EVENT_RETRY_MAX_BACKOFF = 60
+# Um lote reservado por um processo que morreu volta para a fila depois disto (s)
+EVENT_CLAIM_TIMEOUT = 120
+
+class EventWriter:
+    """
+    Grava eventos em lote a partir de um thread próprio, compartilhado pelas sessões.
+    append() só registra no diário local (SQLite, um arquivo por app) e volta; o
+    thread envia ao `sink` quando o lote chega a `batch_size` ou a cada
+    `flush_interval` segundos, e apaga do diário o que foi aceito. Se o envio falha,
+    os eventos ficam no diário e são repetidos com espera crescente, sem limite de
+    tentativas (uma queda longa não descarta eventos); o que sobrou de
+    uma execução anterior é enviado ao iniciar. A entrega é "pelo menos uma vez":
+    se o processo cai entre o insert e a limpeza do diário, o lote é reenviado.
+    Quando is_rejected(erro) diz que o destino recusou os dados (e não que está fora
+    do ar), o lote é dividido ao meio até isolar os eventos inválidos; estes vão
+    para a tabela `rejeitados` do diário e, se houver, para o sink `dead_letter`,
+    e os demais seguem normalmente.
+    """
+    def __init__(self, sink, journal_path=EVENT_JOURNAL_PATH, batch_size=EVENT_BATCH_SIZE, flush_interval=EVENT_FLUSH_INTERVAL, on_flush=None, name="historico", is_rejected=None, dead_letter=None):
+        self.sink = sink
+        self.is_rejected = is_rejected
+        self.dead_letter = dead_letter
+        self.name = name
+        self.journal_path = journal_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_flush = on_flush
+        self.latencies = deque(maxlen=1000)
+        self.stats = {"registrados": 0, "enviados": 0, "lotes": 0, "falhas": 0, "rejeitados": 0, "ultimo_erro": None}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._idle = threading.Condition(self._lock)
+        self._stopped = threading.Event()
+        self._conn = self._connect()
+        self._pending = self._count("1 = 1")
+        if self._pending:
+            logging.info(f"Diário de eventos {journal_path}: {self._pending} eventos pendentes de execuções anteriores.")
+        self._thread = threading.Thread(target=self._run, name=f"{name}-writer", daemon=True)
+
+    def _connect(self):
+        directory = os.path.dirname(self.journal_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.journal_path, timeout=30, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS eventos (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                payload TEXT NOT NULL,
+                criado_em REAL NOT NULL,
+                tentativas INTEGER NOT NULL DEFAULT 0,
+                reservado_em REAL
+            )""")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS rejeitados (
+                id INTEGER PRIMARY KEY,
+                payload TEXT NOT NULL,
+                criado_em REAL NOT NULL,
+                rejeitado_em REAL NOT NULL,
+                erro TEXT,
+                encaminhado INTEGER NOT NULL DEFAULT 0
+            )""")
+        return conn
+
+    def _count(self, where, *params):
+        with self._lock:
+            return self._conn.execute(f"SELECT COUNT(*) FROM eventos WHERE {where}", params).fetchone()[0]
+
+    def start(self):
+        self._thread.start()
+        atexit.register(self.close)
+        return self
+
+    def append(self, events):
+        """Registra `events` (dicts) no diário numa única transação; não espera o envio."""
+        rows = [(json.dumps(event, ensure_ascii=False, default=str), time.time()) for event in events]
+        if not rows:
+            return
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany("INSERT INTO eventos (payload, criado_em) VALUES (?, ?)", rows)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._pending += len(rows)
+            self.stats["registrados"] += len(rows)
+            full = self._pending >= self.batch_size
+        if full:
+            self._wake.set()
+
+    def _claim(self):
+        """Reserva o próximo lote (os mais antigos primeiro) para este processo."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                batch = self._conn.execute(
+                    "SELECT id, payload FROM eventos WHERE reservado_em IS NULL OR reservado_em < ? ORDER BY id LIMIT ?",
+                    (now - EVENT_CLAIM_TIMEOUT, self.batch_size)).fetchall()
+                self._conn.executemany("UPDATE eventos SET reservado_em = ? WHERE id = ?", [(now, row_id) for row_id, _ in batch])
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return batch
+
+    def _settle(self, ids, error=None):
+        """Apaga do diário um lote aceito, ou devolve-o à fila (falha transitória, sem contar tentativa)."""
+        with self._lock:
+            if error is None:
+                self._conn.executemany("DELETE FROM eventos WHERE id = ?", [(row_id,) for row_id in ids])
+                self._pending = max(self._pending - len(ids), 0)
+            else:
+                self._conn.executemany("UPDATE eventos SET reservado_em = NULL WHERE id = ?", [(row_id,) for row_id in ids])
+
+    def _reject(self, row, error):
+        """Move um evento recusado pelo destino do diário para a tabela de rejeitados."""
+        row_id, payload = row
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("INSERT OR REPLACE INTO rejeitados (id, payload, criado_em, rejeitado_em, erro) SELECT id, payload, criado_em, ?, ? FROM eventos WHERE id = ?", (time.time(), str(error), row_id))
+                self._conn.execute("DELETE FROM eventos WHERE id = ?", (row_id,))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._pending = max(self._pending - 1, 0)
+            self.stats["rejeitados"] += 1
+        logging.error(f"Evento recusado pelo destino ({self.name}), movido para os rejeitados de {self.journal_path}: {error} {payload}")
+
+    def _deliver(self, batch):
+        """Envia o lote; se o destino recusa os dados, divide ao meio até isolar os eventos inválidos."""
+        try:
+            self.sink([json.loads(payload) for _, payload in batch])
+        except Exception as e:
+            if self.is_rejected is None or not self.is_rejected(e):
+                raise
+            # Só recusas do destino contam tentativa; quedas são repetidas sem limite
+            with self._lock:
+                self._conn.executemany("UPDATE eventos SET tentativas = tentativas + 1 WHERE id = ?", [(row_id,) for row_id, _ in batch])
+            if len(batch) == 1:
+                self._reject(batch[0], e)
+                return
+            middle = len(batch) // 2
+            self._deliver(batch[:middle])
+            self._deliver(batch[middle:])
+            return
+        self._settle([row_id for row_id, _ in batch])
+        with self._lock:
+            self.stats["enviados"] += len(batch)
+
+    def _forward_rejected(self):
+        """Encaminha ao dead_letter os rejeitados ainda não encaminhados; se falhar, tenta no próximo ciclo."""
+        with self._lock:
+            rows = self._conn.execute("SELECT id, payload, criado_em, rejeitado_em, erro FROM rejeitados WHERE encaminhado = 0 ORDER BY id LIMIT ?", (self.batch_size,)).fetchall()
+        if not rows:
+            return
+        try:
+            self.dead_letter([{"payload": json.loads(payload), "erro": erro, "criado_em": criado_em, "rejeitado_em": rejeitado_em} for _, payload, criado_em, rejeitado_em, erro in rows])
+        except Exception as e:
+            logging.warning(f"Falha ao encaminhar {len(rows)} eventos rejeitados ({self.name}); ficam no diário: {e}")
+            return
+        with self._lock:
+            self._conn.executemany("UPDATE rejeitados SET encaminhado = 1 WHERE id = ?", [(row[0],) for row in rows])
+
+    def _drain(self):
+        """Envia lotes até o diário esvaziar; devolve False se um envio falhou."""
+        sent = self.stats["enviados"]
+        try:
+            while True:
+                batch = self._claim()
+                if not batch:
+                    if self.dead_letter:
+                        self._forward_rejected()
+                    return True
+                ids = [row_id for row_id, _ in batch]
+                start = time.perf_counter()
+                try:
+                    self._deliver(batch)
+                except Exception as e:
+                    # Os eventos já aceitos saíram do diário; os demais voltam para a fila
+                    self._settle(ids, error=e)
+                    with self._lock:
+                        self.stats["falhas"] += 1
+                        self.stats["ultimo_erro"] = str(e)
+                    logging.warning(f"Falha ao enviar {len(ids)} eventos ({self.name}); ficam no diário para nova tentativa: {e}")
+                    return False
+                with self._lock:
+                    self.latencies.append(time.perf_counter() - start)
+                    self.stats["lotes"] += 1
+        finally:
+            if self.stats["enviados"] > sent and self.on_flush:
+                try:
+                    self.on_flush()
+                except Exception as e:
+                    logging.error(f"Erro após gravar eventos: {e}")
+            with self._lock:
+                self._idle.notify_all()
+
+    def _run(self):
+        backoff = 0
+        while not self._stopped.is_set():
+            # Depois de uma falha espera o backoff inteiro, mesmo com lotes cheios chegando
+            if backoff:
+                self._stopped.wait(backoff)
+            else:
+                self._wake.wait(timeout=self.flush_interval)
+            self._wake.clear()
+            try:
+                ok = self._drain()
+            except Exception as e:
+                logging.error(f"Erro no diário de eventos {self.journal_path}: {e}")
+                ok = False
+            backoff = 0 if ok else min(max(backoff * 2, 1), EVENT_RETRY_MAX_BACKOFF)
+
+    def flush(self, timeout=10):
+        """Pede o envio imediato e espera o diário esvaziar (True) ou o prazo acabar."""
+        deadline = time.monotonic() + timeout
+        self._wake.set()
+        with self._lock:
+            while self._pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._thread.is_alive():
+                    return False
+                self._idle.wait(min(remaining, 0.5))
+        return True
+
+    def close(self, timeout=5):
+        """Tenta enviar o que falta antes de o processo sair; o resto fica no diário."""
+        if self._thread.is_alive():
+            self.flush(timeout)
+        self._stopped.set()
+        self._wake.set()
+
+    def metrics(self):
+        """Contadores, eventos pendentes/rejeitados no diário e latência (s) dos inserts."""
+        with self._lock:
+            latencies = sorted(self.latencies)
+            rejected = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(encaminhado = 0), 0) FROM rejeitados").fetchone()
+            metrics = dict(self.stats, pendentes=self._pending, rejeitados_no_diario=rejected[0], rejeitados_nao_encaminhados=rejected[1])
+        if latencies:
+            metrics["latency_p50_s"] = round(latencies[len(latencies) // 2], 4)
+            metrics["latency_max_s"] = round(latencies[-1], 4)
+        return metrics
+
+def benchmark_events(n_actions=200, latency_ms=80, outage_s=2.0):
+    """Compara o insert síncrono por ação com o diário, incluindo uma queda do destino e a retomada."""
+    received = []
+    down_until = [0.0]
+
+    def sink(events):
+        time.sleep(latency_ms / 1000)
+        if time.monotonic() < down_until[0]:
+            raise ConnectionError("destino fora do ar (simulado)")
+        received.extend(events)
+
+    events = [{"data_evento": f"2026-01-01 00:{i // 60 % 60:02d}:{i % 60:02d}", "descricao": f"EVENTO {i}", "filial": "GOIANIA"} for i in range(n_actions)]
+    start = time.perf_counter()
+    for event in events:
+        sink([event])
+    sync_seconds = time.perf_counter() - start
+    print(f"Ações: {n_actions} (latência simulada de {latency_ms} ms por insert)")
+    print(f"Insert síncrono por ação: {sync_seconds:.2f}s no total, {sync_seconds / n_actions * 1000:.1f} ms por ação")
+
+    with tempfile.TemporaryDirectory() as directory:
+        journal = os.path.join(directory, "historico.sqlite3")
+        received.clear()
+        writer = EventWriter(sink, journal, batch_size=EVENT_BATCH_SIZE, flush_interval=0.5).start()
+        down_until[0] = time.monotonic() + outage_s
+        waits = []
+        for event in events:
+            start = time.perf_counter()
+            writer.append([event])
+            waits.append(time.perf_counter() - start)
+        waits.sort()
+        print(f"Diário: p50 {waits[len(waits) // 2] * 1000:.2f} ms, máx {waits[-1] * 1000:.2f} ms por ação (destino fora do ar por {outage_s:.0f}s)")
+        start = time.perf_counter()
+        writer.flush(timeout=outage_s + EVENT_RETRY_MAX_BACKOFF)
+        print(f"Entregues {len(received)}/{n_actions} após a queda em {time.perf_counter() - start:.2f}s. Métricas: {writer.metrics()}")
+        writer.close()
+
+        # Reinício com eventos no diário: um novo gravador os envia ao iniciar
+        received.clear()
+        down_until[0] = float("inf")
+        writer = EventWriter(sink, journal, flush_interval=0.2)
+        writer.append(events[:10])
+        down_until[0] = 0.0
+        writer = EventWriter(sink, journal, flush_interval=0.2).start()
+        writer.flush()
+        print(f"Reenviados ao reiniciar: {len(received)}/10")
+        writer.close()
+
+        # Eventos que o destino recusa no meio dos lotes: são isolados e o resto é entregue
+        received.clear()
+        def strict_sink(events):
+            if any(event["filial"] is None for event in events):
+                raise ValueError('null value in column "filial" (simulado)')
+            received.extend(events)
+        bad = [dict(event, filial=None) for event in events[:3]]
+        writer = EventWriter(strict_sink, os.path.join(directory, "rejeicao.sqlite3"), flush_interval=0.2, is_rejected=lambda e: isinstance(e, ValueError)).start()
+        writer.append(events[:40] + bad[:1] + events[40:80] + bad[1:] + events[80:100])
+        writer.flush()
+        metrics = writer.metrics()
+        print(f"Com {len(bad)} eventos inválidos: {len(received)}/100 entregues, {metrics['rejeitados']} rejeitados em {metrics['lotes']} lotes")
+        writer.close()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if len(sys.argv) > 1 and sys.argv[1] == "--benchmark":
+        benchmark_events(*(int(arg) for arg in sys.argv[2:4]))
+    else:
+        print("Uso: python event_writer.py --benchmark [n_acoes] [latencia_ms]")
@@ -0,0 +1,206 @@
+import logging
+import sys
+import time
+import unicodedata
+import numpy as np
+import pandas as pd
+
+# Tokens mais longos que isto entram nos n-gramas só pelo começo e são sempre conferidos
+MAX_GRAM_TOKEN_LEN = 48
+BIGRAM_FLAG = 1 << 24
+
+def fold_text(text):
+    """Mesma normalização de normalize_text (text_normalize.py): sem acentos, maiúsculas, sem espaços nas pontas."""
+    if not isinstance(text, str):
+        return ""
+    return unicodedata.normalize('NFKD', text).encode('ASCII', 'ignore').decode('ASCII').upper().strip()
+
+def fold_texts(texts):
+    return [fold_text(text) for text in texts]
+
+def _sorted_unique(values):
+    """np.unique por ordenação (mais rápido que o de hash para arrays int64 grandes)."""
+    values = np.sort(values)
+    return values[np.concatenate(([True], values[1:] != values[:-1]))] if len(values) else values
+
+def _csr(keys, values):
+    """Agrupa `values` por `keys` (já ordenados por chave): (chaves distintas, offsets, valores)."""
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1]))) if len(keys) else np.array([], dtype=np.int64)
+    return keys[starts], np.append(starts, len(keys)), values
+
+class SearchIndex:
+    """
+    Índice invertido sobre um texto por linha, sem acento e sem caixa. Os textos são
+    quebrados em tokens por espaço e o vocabulário fica ordenado, com as linhas de cada
+    token numa lista contígua: busca por prefixo é uma faixa do vocabulário e um slice.
+    Para substring, bigramas e trigramas do vocabulário apontam os tokens candidatos,
+    conferidos com `in`. Todos os termos da consulta precisam aparecer (E).
+    """
+    def __init__(self, documents, normalize=fold_texts):
+        self.size = len(documents)
+        tokens = pd.Series(normalize(list(documents)), dtype=object).str.split().explode().dropna()
+        tokens = tokens[tokens != ""]
+        codes, vocabulary = pd.factorize(tokens, sort=True)
+        rows = tokens.index.to_numpy(dtype=np.int64)
+        pairs = _sorted_unique(codes.astype(np.int64) * max(self.size, 1) + rows)
+        self.vocabulary = np.asarray(vocabulary, dtype=object)
+        self.vocabulary_list = self.vocabulary.tolist()
+        # Todo token do vocabulário aparece em alguma linha: os offsets cobrem 0..V
+        self.posting_tokens = pairs // max(self.size, 1)
+        _, self.token_offsets, self.token_rows = _csr(self.posting_tokens, pairs % max(self.size, 1))
+        self._build_grams()
+
+    def _build_grams(self):
+        vocabulary = self.vocabulary_list
+        if not vocabulary:
+            self.gram_keys, self.gram_offsets, self.gram_tokens = np.array([], dtype=np.int64), np.array([0]), np.array([], dtype=np.int64)
+            self.long_tokens = np.array([], dtype=np.int64)
+            self.char_masks = [np.array([], dtype=np.uint64)] * 2
+            return
+        lengths = np.fromiter((len(token) for token in vocabulary), dtype=np.int64, count=len(vocabulary))
+        width = int(min(lengths.max(), MAX_GRAM_TOKEN_LEN))
+        chars = np.array(vocabulary, dtype=f"S{width}").view(np.uint8).reshape(len(vocabulary), width).astype(np.int64)
+        lengths_capped = np.minimum(lengths, width)
+        token_ids = np.arange(len(vocabulary), dtype=np.int64)
+        grams, owners = [], []
+        for size in (2, 3):
+            if width < size:
+                continue
+            span = width - size + 1
+            code = chars[:, :span] << 16 if size == 3 else (chars[:, :span] << 8) | BIGRAM_FLAG
+            code = code | (chars[:, 1:span + 1] << (8 if size == 3 else 0))
+            if size == 3:
+                code = code | chars[:, 2:span + 2]
+            valid = np.arange(span)[None, :] + size <= lengths_capped[:, None]
+            grams.append(code[valid])
+            owners.append(np.broadcast_to(token_ids[:, None], code.shape)[valid])
+        keys = _sorted_unique(np.concatenate(grams) * len(vocabulary) + np.concatenate(owners))
+        self.gram_keys, self.gram_offsets, self.gram_tokens = _csr(keys // len(vocabulary), keys % len(vocabulary))
+        self.long_tokens = np.flatnonzero(lengths > width)
+        # Caracteres presentes em cada token (bit = código ASCII), para termos de um caractere
+        in_token = np.arange(width)[None, :] < lengths_capped[:, None]
+        bit = np.left_shift(np.uint64(1), (chars & 63).astype(np.uint64))
+        self.char_masks = [np.bitwise_or.reduce(np.where(in_token & (chars >> 6 == half), bit, np.uint64(0)), axis=1) for half in (0, 1)]
+
+    def _gram_postings(self, code):
+        i = np.searchsorted(self.gram_keys, code)
+        if i < len(self.gram_keys) and self.gram_keys[i] == code:
+            return self.gram_tokens[self.gram_offsets[i]:self.gram_offsets[i + 1]]
+        return np.array([], dtype=np.int64)
+
+    def _prefix_range(self, term):
+        lo = np.searchsorted(self.vocabulary, term, side="left")
+        hi = np.searchsorted(self.vocabulary, term[:-1] + chr(ord(term[-1]) + 1), side="left")
+        return int(lo), int(hi)
+
+    def _tokens_containing(self, term):
+        """Ids dos tokens do vocabulário que contêm `term`."""
+        data = term.encode("ascii")  # fold_text já deixa só ASCII
+        if len(data) == 1:
+            mask = self.char_masks[data[0] >> 6] & np.uint64(1 << (data[0] & 63))
+            return np.concatenate([np.flatnonzero(mask), self._long_tokens_containing(term)])
+        if len(data) == 2:
+            codes = [BIGRAM_FLAG | (data[0] << 8) | data[1]]
+        else:
+            codes = sorted({(data[i] << 16) | (data[i + 1] << 8) | data[i + 2] for i in range(len(data) - 2)})
+        postings = sorted((self._gram_postings(code) for code in codes), key=len)
+        candidates = postings[0]
+        for posting in postings[1:]:
+            if not len(candidates):
+                break
+            candidates = np.intersect1d(candidates, posting, assume_unique=True)
+        if len(data) > 3:
+            candidates = candidates[[term in self.vocabulary_list[i] for i in candidates]] if len(candidates) else candidates
+        return np.concatenate([candidates, self._long_tokens_containing(term)])
+
+    def _long_tokens_containing(self, term):
+        # Podem repetir candidatos já achados pelos n-gramas: quem usa não depende de unicidade
+        return self.long_tokens[[term in self.vocabulary_list[i] for i in self.long_tokens]] if len(self.long_tokens) else self.long_tokens
+
+    def _rows_for_tokens(self, token_ids):
+        """Linhas (ordenadas) com algum dos tokens; cada lista já vem ordenada e sem repetição."""
+        if not len(token_ids):
+            return np.array([], dtype=np.int64)
+        if len(token_ids) == 1:
+            return self.token_rows[self.token_offsets[token_ids[0]]:self.token_offsets[token_ids[0] + 1]]
+        rows = np.zeros(self.size, dtype=bool)
+        if len(token_ids) <= 64:
+            for t in token_ids:
+                rows[self.token_rows[self.token_offsets[t]:self.token_offsets[t + 1]]] = True
+        else:
+            # Muitos tokens (termos curtos): filtra todas as listas de uma vez
+            wanted = np.zeros(len(self.vocabulary_list), dtype=bool)
+            wanted[token_ids] = True
+            rows[self.token_rows[wanted[self.posting_tokens]]] = True
+        return np.flatnonzero(rows)
+
+    def _rows_for_prefix(self, term):
+        # Tokens com o prefixo são vizinhos no vocabulário: suas listas formam um único trecho
+        lo, hi = self._prefix_range(term)
+        if hi - lo <= 1:
+            return self._rows_for_tokens(np.arange(lo, hi))
+        rows = np.zeros(self.size, dtype=bool)
+        rows[self.token_rows[self.token_offsets[lo]:self.token_offsets[hi]]] = True
+        return np.flatnonzero(rows)
+
+    def search(self, query, prefix=False):
+        """
+        Posições (ordenadas) das linhas com todos os termos de `query`: como início de
+        um token se prefix=True, ou em qualquer parte de um token (padrão).
+        """
+        terms = fold_text(query).split()
+        if not terms:
+            return np.arange(self.size)
+        result = None
+        for term in sorted(set(terms), key=len, reverse=True):
+            if prefix:
+                rows = self._rows_for_prefix(term)
+            else:
+                rows = self._rows_for_tokens(self._tokens_containing(term))
+            result = rows if result is None else np.intersect1d(result, rows, assume_unique=True)
+            if not len(result):
+                break
+        return result
+
+def benchmark_search(n_rows=100_000):
+    """Histórico sintético: busca linha a linha (como no app) x índice invertido."""
+    rng = np.random.default_rng(7)
+    cidades = ["Goiânia", "Brasília", "Cuiabá", "Anápolis", "São Paulo"]
+    nomes = ["João", "Maria", "José", "Antônio", "Conceição", "Luíza", "Sebastião", "Inês"]
+    historico = pd.DataFrame({
+        "data_evento": pd.date_range("2024-01-01", periods=n_rows, freq="7min").strftime("%d/%m/%Y, %H:%M"),
+        "descricao": [f"BOMBA DEVOLVIDA (SERIAL: SN{serial:07d}) NF: {nf} PACIENTE {nomes[p]} HOSPITAL {cidades[c]}"
+                      for serial, nf, p, c in zip(rng.integers(0, 10**7, n_rows), rng.integers(10**5, 10**6, n_rows), rng.integers(0, len(nomes), n_rows), rng.integers(0, len(cidades), n_rows))],
+        "filial": rng.choice(["GOIANIA", "BRASILIA", "CUIABA"], n_rows),
+    })
+    documents = historico["data_evento"] + " " + historico["descricao"] + " " + historico["filial"]
+    start = time.perf_counter()
+    index = SearchIndex(documents.tolist())
+    build_seconds = time.perf_counter() - start
+    print(f"Linhas: {n_rows}, vocabulário: {len(index.vocabulary_list)} tokens, construção: {build_seconds:.2f}s")
+
+    start = time.perf_counter()
+    historico.apply(lambda row: "goiania" in str(row.values).lower(), axis=1)
+    print(f"Busca linha a linha (str(row.values), como no app): {time.perf_counter() - start:.1f}s por consulta")
+
+    folded = pd.Series(fold_texts(documents.tolist()))
+    serial = historico["descricao"].iloc[n_rows // 2].split("SERIAL: ")[1][:9]
+    queries = [("GOIANIA", False), ("goiânia", False), (serial, False), (serial[:6], True), ("SN00", True), ("CONCEI", False), ("5", False), ("JOSE ANAPOLIS", False)]
+    for query, prefix in queries:
+        start = time.perf_counter()
+        expected = np.ones(n_rows, dtype=bool)
+        for term in fold_text(query).split():
+            expected &= folded.str.contains(term, regex=False).to_numpy() if not prefix else folded.str.contains(r"(?:^|\s)" + term, regex=True).to_numpy()
+        pandas_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        rows = index.search(query, prefix=prefix)
+        index_seconds = time.perf_counter() - start
+        ok = "ok" if np.array_equal(rows, np.flatnonzero(expected)) else "DIVERGE"
+        print(f"{query!r:>18} {'prefixo' if prefix else 'substring':>9}: {len(rows):>6} linhas em {index_seconds * 1000:7.3f} ms (str.contains: {pandas_seconds * 1000:6.1f} ms, {ok})")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if len(sys.argv) > 1 and sys.argv[1] == "--benchmark":
+        benchmark_search(*(int(arg) for arg in sys.argv[2:3]))
+    else:
+        print("Uso: python search_index.py --benchmark [n_linhas]")
@@ -0,0 +1,312 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import httpx
+
+# Downloads simultâneos por processo e tentativas extras em falhas transitórias
+STORAGE_WORKERS = int(os.getenv("STORAGE_WORKERS", "8"))
+STORAGE_RETRIES = int(os.getenv("STORAGE_RETRIES", "3"))
+STORAGE_RETRY_BACKOFF = 0.25
+
+# Índices de prefixo: tamanho da página do list(), onde ficam salvos, intervalo
+# mínimo entre atualizações incrementais e entre varreduras completas (s)
+STORAGE_PAGE_SIZE = 1000
+# Atualização incremental: primeira página pequena (em geral só há alguns arquivos
+# novos), dobrando enquanto a página inteira for mais nova que a última sincronização
+STORAGE_FIRST_PAGE_SIZE = 50
+STORAGE_INDEX_DIR = os.getenv("STORAGE_INDEX_DIR", os.path.join(".cache", "storage"))
+STORAGE_INDEX_MAX_AGE = 60
+STORAGE_INDEX_FULL_REFRESH = int(os.getenv("STORAGE_INDEX_FULL_REFRESH", "3600"))
+
+def is_not_found(error):
+    return "not found" in str(error).lower() or str(getattr(error, "status", "")) == "404"
+
+def is_transient(error):
+    """
+    Só valem nova tentativa 429, 5xx e falhas de rede ou tempo esgotado (httpx,
+    OSError, TimeoutError). Os demais 4xx e erros sem status (bugs, respostas
+    inválidas) falham de primeira.
+    """
+    status = getattr(error, "status", None)
+    if status is None and isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+    if str(status).isdigit():
+        return str(status) == "429" or str(status).startswith("5")
+    return isinstance(error, (httpx.TransportError, OSError, TimeoutError))
+
+class StorageClient:
+    """
+    Downloads de um bucket do Supabase Storage num pool de threads. Permite
+    disparar downloads em segundo plano (submit), baixar muitos arquivos com
+    concorrência limitada (download_many), repete falhas transitórias com
+    espera crescente e registra a latência de cada chamada.
+    """
+    def __init__(self, storage, bucket, max_workers=STORAGE_WORKERS, retries=STORAGE_RETRIES):
+        self.storage = storage
+        self.bucket = bucket
+        self.max_workers = max_workers
+        self.retries = retries
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="storage")
+        self.latencies = deque(maxlen=1000)
+        self.stats = {"downloads": 0, "not_found": 0, "retries": 0, "failures": 0, "bytes": 0}
+        self._lock = threading.Lock()
+
+    def _record(self, start, outcome, size=0):
+        with self._lock:
+            self.latencies.append(time.perf_counter() - start)
+            self.stats[outcome] += 1
+            self.stats["bytes"] += size
+
+    def download(self, path):
+        """Conteúdo de `path`, ou None se o objeto não existe."""
+        for attempt in range(self.retries + 1):
+            start = time.perf_counter()
+            try:
+                data = self.storage.from_(self.bucket).download(path)
+                self._record(start, "downloads", len(data))
+                return data
+            except Exception as e:
+                if is_not_found(e):
+                    self._record(start, "not_found")
+                    return None
+                if attempt == self.retries or not is_transient(e):
+                    self._record(start, "failures")
+                    raise
+                with self._lock:
+                    self.stats["retries"] += 1
+                logging.warning(f"Falha transitória ao baixar {path} ({e}); tentativa {attempt + 2} de {self.retries + 1}.")
+                time.sleep(STORAGE_RETRY_BACKOFF * 2 ** attempt)
+
+    def submit(self, path):
+        """Começa a baixar `path` em segundo plano; o Future resolve para os bytes (ou None)."""
+        return self.executor.submit(self.download, path)
+
+    def download_many(self, paths, max_concurrency=None):
+        """
+        Gera (path, bytes ou None) na ordem em que os downloads terminam, com no
+        máximo `max_concurrency` em andamento. Quem consome pode gravar e descartar
+        cada arquivo, então a memória fica limitada à janela de downloads.
+        """
+        max_concurrency = max_concurrency or self.max_workers
+        pending = {}
+        paths = iter(paths)
+        while True:
+            for path in paths:
+                pending[self.submit(path)] = path
+                if len(pending) >= max_concurrency:
+                    break
+            if not pending:
+                return
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                try:
+                    yield path, future.result()
+                except Exception as e:
+                    logging.error(f"Erro ao baixar {path}: {e}")
+                    yield path, None
+
+    def metrics(self):
+        """Contadores e latência (s) das chamadas ao storage."""
+        with self._lock:
+            latencies = sorted(self.latencies)
+            metrics = dict(self.stats)
+        if latencies:
+            metrics["latency_p50_s"] = round(latencies[len(latencies) // 2], 4)
+            metrics["latency_p95_s"] = round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 4)
+            metrics["latency_max_s"] = round(latencies[-1], 4)
+        return metrics
+
+class StorageIndex:
+    """
+    Mapa chave -> {path, etag, updated_at} dos objetos de um prefixo, salvo em disco.
+    key_func(nome) dá a chave de cada arquivo (None ignora). A primeira carga e as
+    varreduras periódicas paginam o prefixo inteiro; nas demais o list() vem do mais
+    novo para o mais antigo, começa com uma página pequena que dobra enquanto só há
+    objetos novos, e para no primeiro objeto anterior à última sincronização.
+    Envios e remoções feitos pelo app entram com put/remove, sem listar de novo.
+    """
+    def __init__(self, storage, bucket, prefix, key_func, directory=STORAGE_INDEX_DIR, page_size=STORAGE_PAGE_SIZE):
+        self.storage = storage
+        self.bucket = bucket
+        self.prefix = prefix
+        self.key_func = key_func
+        self.page_size = page_size
+        self.file_path = os.path.join(directory, f"{bucket}_{prefix.strip('/').replace('/', '_')}.json")
+        self.entries = {}
+        self.last_sync = None  # maior updated_at já visto
+        self.last_full = 0.0
+        self.checked_at = 0.0
+        self.stats = {"full_scans": 0, "incremental": 0, "pages": 0, "objects": 0}
+        self._lock = threading.RLock()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.file_path, encoding="utf-8") as f:
+                saved = json.load(f)
+            self.entries, self.last_sync, self.last_full = saved["entries"], saved["last_sync"], saved["last_full"]
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning(f"Índice do storage {self.file_path} ignorado: {e}")
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+            tmp_path = f"{self.file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"entries": self.entries, "last_sync": self.last_sync, "last_full": self.last_full}, f)
+            os.replace(tmp_path, self.file_path)
+        except Exception as e:
+            logging.warning(f"Não foi possível salvar o índice do storage {self.file_path}: {e}")
+
+    def _pages(self, first_page_size=None):
+        """
+        Objetos do prefixo, do mais novo para o mais antigo, página a página. Com
+        first_page_size a primeira página tem esse tamanho e cada página seguinte
+        dobra até page_size; quem consome para de pedir páginas ao achar um objeto antigo.
+        """
+        offset = 0
+        limit = min(first_page_size or self.page_size, self.page_size)
+        while True:
+            page = self.storage.from_(self.bucket).list(self.prefix, {"limit": limit, "offset": offset, "sortBy": {"column": "updated_at", "order": "desc"}})
+            self.stats["pages"] += 1
+            yield from page
+            if len(page) < limit:
+                return
+            offset += limit
+            limit = min(limit * 2, self.page_size)
+
+    def _entry(self, item):
+        return {"path": f"{self.prefix}{item['name']}", "etag": (item.get("metadata") or {}).get("eTag"), "updated_at": item.get("updated_at")}
+
+    def refresh(self, full=False, max_age=STORAGE_INDEX_MAX_AGE):
+        """Atualiza o índice se a última checagem tem mais de `max_age` segundos."""
+        with self._lock:
+            now = time.time()
+            if not full and now - self.checked_at < max_age:
+                return
+            full = full or self.last_sync is None or now - self.last_full >= STORAGE_INDEX_FULL_REFRESH
+            entries = {} if full else dict(self.entries)
+            seen = set()
+            last_sync = None if full else self.last_sync
+            for item in self._pages(None if full else STORAGE_FIRST_PAGE_SIZE):
+                updated_at = item.get("updated_at")
+                # Ordem decrescente: o primeiro objeto anterior à sincronização encerra a busca
+                if not full and updated_at and updated_at < self.last_sync:
+                    break
+                key = self.key_func(item.get("name") or "")
+                if key is None:
+                    continue
+                self.stats["objects"] += 1
+                last_sync = max(filter(None, [last_sync, updated_at]), default=None)
+                # Mais de um arquivo por chave: vale o mais recente (o primeiro desta listagem)
+                if key not in seen:
+                    entries[key] = self._entry(item)
+                    seen.add(key)
+            self.entries, self.last_sync, self.checked_at = entries, last_sync, now
+            if full:
+                self.last_full = now
+            self.stats["full_scans" if full else "incremental"] += 1
+            self._save()
+
+    def mapping(self):
+        """Cópia chave -> caminho."""
+        with self._lock:
+            return {key: entry["path"] for key, entry in self.entries.items()}
+
+    def get(self, key):
+        """Caminho de `key` no índice (sem listar o storage), ou None."""
+        with self._lock:
+            entry = self.entries.get(key)
+            return entry["path"] if entry else None
+
+    def entry(self, key):
+        """Cópia de {path, etag, updated_at} de `key` no índice (sem listar o storage), ou None."""
+        with self._lock:
+            entry = self.entries.get(key)
+            return dict(entry) if entry else None
+
+    def put(self, path, etag=None, updated_at=None):
+        """Registra um objeto recém-enviado pelo app."""
+        name = path[len(self.prefix):] if path.startswith(self.prefix) else path
+        key = self.key_func(name)
+        if key is None:
+            return
+        with self._lock:
+            self.entries[key] = {"path": f"{self.prefix}{name}", "etag": etag, "updated_at": updated_at}
+            self._save()
+
+    def remove(self, path):
+        """Tira do índice um objeto apagado pelo app."""
+        with self._lock:
+            for key in [key for key, entry in self.entries.items() if entry["path"] == path]:
+                del self.entries[key]
+            self._save()
+
+def benchmark_storage(n_files=50, latency_ms=80, workers=STORAGE_WORKERS):
+    """Mede downloads sequenciais x concorrentes contra um storage HTTP local com latência artificial."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from storage3 import SyncStorageClient
+
+    payload = os.urandom(64 * 1024)
+    requests_seen = {}
+    lock = threading.Lock()
+
+    class StandInHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(latency_ms / 1000)
+            with lock:
+                requests_seen[self.path] = requests_seen.get(self.path, 0) + 1
+                first_try = requests_seen[self.path] == 1
+            # Um em cada dez arquivos falha na primeira tentativa, para exercitar as repetições
+            if first_try and self.path.endswith("7.pdf"):
+                self.send_response(503); self.end_headers(); return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/pdf")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    storage = SyncStorageClient(f"http://127.0.0.1:{server.server_address[1]}/storage/v1", {})
+    paths = [f"nfs_assinadas/NF{i:04d}.pdf" for i in range(n_files)]
+    try:
+        sequential = StorageClient(storage, "bench", max_workers=1)
+        start = time.perf_counter()
+        for path in paths:
+            sequential.download(path)
+        sequential_seconds = time.perf_counter() - start
+
+        requests_seen.clear()
+        concurrent = StorageClient(storage, "bench", max_workers=workers)
+        start = time.perf_counter()
+        received = sum(1 for _, data in concurrent.download_many(paths) if data)
+        concurrent_seconds = time.perf_counter() - start
+    finally:
+        server.shutdown()
+
+    print(f"Arquivos: {n_files} (latência simulada de {latency_ms} ms)")
+    print(f"Sequencial: {sequential_seconds:.2f}s")
+    print(f"Concorrente ({workers} threads): {concurrent_seconds:.2f}s, {received} recebidos")
+    print(f"Métricas: {concurrent.metrics()}")
+    if concurrent_seconds > 0:
+        print(f"Ganho: {sequential_seconds / concurrent_seconds:.1f}x")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    if len(sys.argv) > 1 and sys.argv[1] == "--benchmark":
+        benchmark_storage(*(int(arg) for arg in sys.argv[2:4]))
+    else:
+        print("Uso: python storage_client.py --benchmark [n_arquivos] [latencia_ms]")
@@ -0,0 +1,98 @@
+-- Agregações do dashboard calculadas no Postgres (get_dashboard_metrics no app.py).
+-- Uma única chamada RPC devolve o mesmo dicionário que o cálculo em pandas.
+
+create extension if not exists unaccent;
+
+-- Equivalente ao normalize_text do app: remove acentos, caixa alta e sem espaços nas pontas.
+create or replace function public.normalize_text(t text)
+returns text
+language sql
+immutable
+parallel safe
+as $$
+  select coalesce(upper(trim(public.unaccent('public.unaccent'::regdictionary, t))), '')
+$$;
+
+create or replace function public.dashboard_metrics(p_filial text default null)
+returns jsonb
+language sql
+stable
+as $$
+  with ativas as (
+    select serial, status, hospital, filial, public.normalize_text(serial) as serial_norm
+    from public.bombas
+    where ativo
+  ),
+  ativas_filial as (
+    select * from ativas where p_filial is null or filial = p_filial
+  ),
+  manut as (
+    select filial, public.normalize_text(serial) as serial_norm
+    from public.manutencao
+    where status = 'Em Manutenção'
+  ),
+  dados as (
+    select public.normalize_text("Serial") as serial_norm, "Modelo" as modelo, "Venc_Manut" as venc_manut
+    from public."DADOS_BOMBAS"
+  ),
+  modelos_filial as (
+    select upper(d.modelo) as modelo
+    from ativas_filial a
+    left join dados d on d.serial_norm = a.serial_norm
+  ),
+  estoque as (
+    select d.modelo, d.venc_manut
+    from dados d
+    where d.serial_norm not in (
+      select serial_norm from ativas
+      union
+      select serial_norm from manut
+    )
+  ),
+  disponiveis as (
+    select upper(modelo) as modelo from estoque where venc_manut::date >= current_date
+  ),
+  contagens as (
+    select
+      (select count(*) from modelos_filial where modelo = 'ULTA') as ulta_count,
+      (select count(*) from modelos_filial where modelo = 'ACTIVAC') as activac_count,
+      (select count(*) from disponiveis) as disponiveis,
+      (select count(*) from manut where p_filial is null or filial = p_filial) as em_manutencao,
+      (select count(*) from dados) as total_bombas
+  )
+  select jsonb_build_object(
+    'ativas', c.ulta_count + c.activac_count,
+    'disponiveis', c.disponiveis,
+    'em_manutencao', c.em_manutencao,
+    'ulta_count', c.ulta_count,
+    'activac_count', c.activac_count,
+    'total_bombas', c.total_bombas,
+    'status_counts', coalesce((
+      select jsonb_object_agg(status, n) from (
+        select status, count(*) as n from ativas_filial where status is not null group by status
+      ) s), '{}'::jsonb),
+    'hosp_counts', coalesce((
+      select jsonb_object_agg(hospital, n) from (
+        select public.normalize_text(hospital) as hospital, count(*) as n from ativas_filial group by 1
+      ) h), '{}'::jsonb),
+    'bombas_por_filial', coalesce((
+      select jsonb_object_agg(filial, n) from (
+        select public.normalize_text(filial) as filial, count(*) as n from ativas group by 1
+      ) f), '{}'::jsonb),
+    'modelos_por_filial', coalesce((
+      select jsonb_agg(jsonb_build_object('filial', filial, 'Modelo', modelo, 'Quantidade', n) order by filial, modelo) from (
+        select a.filial, d.modelo, count(*) as n
+        from ativas a
+        join dados d on d.serial_norm = a.serial_norm
+        where a.filial is not null and d.modelo is not null
+        group by a.filial, d.modelo
+      ) m), '[]'::jsonb),
+    'modelos_disponiveis', coalesce((
+      select jsonb_object_agg(modelo, n) from (
+        select modelo, count(*) as n from disponiveis where modelo is not null group by modelo
+      ) md), '{}'::jsonb)
+  )
+  from contagens c
+$$;
+
+grant execute on function public.dashboard_metrics(text) to anon, authenticated;
@@ -0,0 +1,2 @@
+-- Publica as tabelas acompanhadas pelo ChangeFeed do app (SUPABASE_REALTIME=1).
+alter publication supabase_realtime add table public.bombas, public.manutencao, public.historico, public.saldo_curativo;
@@ -0,0 +1,50 @@
+-- Status das bombas mantido por um job diário (refresh_pump_status no app.py).
+-- O vencimento vira coluna gerada e indexada; o job só visita as bombas ativas
+-- que vencem até hoje+7 e ainda não estão "Fora Prazo".
+
+alter table public.bombas
+  add column if not exists data_vencimento date
+  generated always as (data_saida + periodo) stored;
+
+create index if not exists bombas_vencimento_pendente_idx
+  on public.bombas (data_vencimento)
+  where ativo and status is distinct from 'Fora Prazo';
+
+-- Mesmas faixas de calculate_status; retorna quantas linhas mudaram.
+create or replace function public.refresh_bombas_status(p_hoje date default current_date)
+returns integer
+language sql
+as $$
+  with alvo as (
+    select id,
+      case
+        when data_vencimento < p_hoje then 'Fora Prazo'
+        when data_vencimento <= p_hoje + 7 then 'Menos de 7 dias'
+        else 'No Prazo'
+      end as status
+    from public.bombas
+    where ativo
+      and status is distinct from 'Fora Prazo'
+      and data_vencimento <= p_hoje + 7
+      and periodo > 0
+  ),
+  alteradas as (
+    update public.bombas b
+    set status = a.status
+    from alvo a
+    where b.id = a.id and b.status is distinct from a.status
+    returning 1
+  )
+  select count(*)::integer from alteradas
+$$;
+
+grant execute on function public.refresh_bombas_status(date) to anon, authenticated;
+
+-- Agenda o job às 00:05 de Brasília quando o pg_cron estiver habilitado no projeto.
+do $$
+begin
+  if exists (select 1 from pg_extension where extname = 'pg_cron') then
+    perform cron.schedule('refresh-bombas-status', '5 3 * * *', 'select public.refresh_bombas_status()');
+  end if;
+end
+$$;
@@ -0,0 +1,35 @@
+-- Consulta paginada do histórico (query_historico no app.py). O tipo do evento vira
+-- coluna gerada, achada por igualdade; a busca usa um tsvector sem acentos. As páginas
+-- vêm do mais recente para o mais antigo, com (data_evento, id) como cursor.
+
+alter table public.historico
+  add column if not exists tipo_evento text
+  generated always as (
+    case
+      when descricao ilike '%BOMBA DEVOLVIDA%' then 'DEVOLVIDA'
+      when descricao ilike 'BOMBA REGISTRADA%' then 'REGISTRADA'
+      when descricao ilike 'DADOS DA BOMBA ATUALIZADOS%' then 'ATUALIZADA'
+      when descricao ilike 'DOCUMENTOS GERADOS%' then 'DOCUMENTOS'
+      when descricao ilike 'NF ASSINADA ENVIADA%' then 'NF_ASSINADA'
+      when descricao ilike 'MANUTENÇÃO REGISTRADA%' then 'MANUTENCAO'
+      else 'OUTRO'
+    end
+  ) stored;
+
+alter table public.historico
+  add column if not exists busca tsvector
+  generated always as (
+    to_tsvector('simple', translate(
+      coalesce(descricao, '') || ' ' || coalesce(filial, ''),
+      'áàâãäéèêëíìîïóòôõöúùûüçÁÀÂÃÄÉÈÊËÍÌÎÏÓÒÔÕÖÚÙÛÜÇ',
+      'aaaaaeeeeiiiiooooouuuucAAAAAEEEEIIIIOOOOOUUUUC'))
+  ) stored;
+
+create index if not exists historico_tipo_data_idx
+  on public.historico (tipo_evento, data_evento desc, id desc);
+
+create index if not exists historico_tipo_filial_data_idx
+  on public.historico (tipo_evento, filial, data_evento desc, id desc);
+
+create index if not exists historico_busca_idx
+  on public.historico using gin (busca);
@@ -0,0 +1,71 @@
+-- Registrar e devolver bombas numa única chamada (registrar_bomba/devolver_bomba no
+-- app.py): a alteração em bombas e a linha do histórico entram na mesma transação.
+-- A remoção da NF assinada no storage fica para o job em segundo plano do app.
+
+-- Um serial só pode estar ativo uma vez. Se já houver duplicatas, o índice não é
+-- criado (aviso abaixo) e a trava por serial das funções continua valendo.
+do $$
+begin
+  if exists (select 1 from public.bombas where ativo group by serial having count(*) > 1) then
+    raise notice 'bombas_serial_ativo_key não criado: há seriais ativos repetidos em public.bombas';
+  else
+    create unique index if not exists bombas_serial_ativo_key on public.bombas (serial) where ativo;
+  end if;
+end
+$$;
+
+-- Insere a bomba (campos de p_bomba, como no formulário) e o evento "BOMBA REGISTRADA".
+-- Serial já ativo falha com unique_violation (23505). Retorna a linha criada.
+create or replace function public.registrar_bomba(p_bomba jsonb, p_data_evento timestamptz default now())
+returns jsonb
+language plpgsql
+as $$
+declare
+  nova public.bombas;
+begin
+  -- Serializa registros do mesmo serial, com ou sem o índice único
+  perform pg_advisory_xact_lock(hashtext('bombas:' || (p_bomba->>'serial')));
+  if exists (select 1 from public.bombas where serial = p_bomba->>'serial' and ativo) then
+    raise exception 'A bomba com o serial ''%'' já está registrada e ativa.', p_bomba->>'serial'
+      using errcode = 'unique_violation';
+  end if;
+
+  insert into public.bombas (serial, hospital, paciente, medico, convenio, data_registro, data_saida, periodo, status, nf, pedido, ativo, filial, nf_devolucao)
+  select r.serial, r.hospital, r.paciente, r.medico, r.convenio, coalesce(r.data_registro, current_date), r.data_saida, r.periodo, r.status, r.nf, r.pedido, true, r.filial, coalesce(r.nf_devolucao, '')
+  from jsonb_populate_record(null::public.bombas, p_bomba) r
+  returning * into nova;
+
+  insert into public.historico (data_evento, descricao, filial)
+  values (p_data_evento, format('BOMBA REGISTRADA (SERIAL: %s)', nova.serial), nova.filial);
+
+  return to_jsonb(nova);
+end
+$$;
+
+-- Marca a bomba como devolvida e grava o evento "BOMBA DEVOLVIDA". Bomba inexistente
+-- ou já devolvida falha com no_data_found (P0002). Retorna a linha atualizada.
+create or replace function public.devolver_bomba(p_id bigint, p_data_retorno date, p_nf_devolucao text, p_data_evento timestamptz default now())
+returns jsonb
+language plpgsql
+as $$
+declare
+  devolvida public.bombas;
+begin
+  update public.bombas
+  set ativo = false, status = '✅ DEVOLVIDA', data_retorno = p_data_retorno, nf_devolucao = p_nf_devolucao
+  where id = p_id and ativo
+  returning * into devolvida;
+  if not found then
+    raise exception 'A bomba % não está ativa (já devolvida?).', p_id
+      using errcode = 'no_data_found';
+  end if;
+
+  insert into public.historico (data_evento, descricao, filial)
+  values (p_data_evento, upper(format('BOMBA DEVOLVIDA (SERIAL: %s) NF: %s', devolvida.serial, p_nf_devolucao)), devolvida.filial);
+
+  return to_jsonb(devolvida);
+end
+$$;
+
+grant execute on function public.registrar_bomba(jsonb, timestamptz) to anon, authenticated;
+grant execute on function public.devolver_bomba(bigint, date, text, timestamptz) to anon, authenticated;
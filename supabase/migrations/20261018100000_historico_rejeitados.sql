@@ -0,0 +1,12 @@
+-- Eventos do histórico que o banco recusou (dados inválidos, violação de restrição).
+-- O gravador em lote do app (event_writer.py) isola cada evento recusado, guarda-o no
+-- diário local e o encaminha para cá, para que os demais eventos do lote sejam gravados.
+create table if not exists public.historico_rejeitados (
+  id bigint generated always as identity primary key,
+  payload jsonb not null,
+  erro text,
+  criado_em timestamptz,
+  rejeitado_em timestamptz not null default now()
+);
+
+grant insert on public.historico_rejeitados to anon, authenticated;
@@ -0,0 +1,35 @@
+-- registrar_bomba grava a descrição do histórico em maiúsculas, como devolver_bomba e
+-- os eventos gravados pelo app: seriais digitados em minúsculas geravam linhas
+-- "BOMBA REGISTRADA (SERIAL: abc)" que as buscas e agrupamentos tratavam à parte.
+
+create or replace function public.registrar_bomba(p_bomba jsonb, p_data_evento timestamptz default now())
+returns jsonb
+language plpgsql
+as $$
+declare
+  nova public.bombas;
+begin
+  -- Serializa registros do mesmo serial, com ou sem o índice único
+  perform pg_advisory_xact_lock(hashtext('bombas:' || (p_bomba->>'serial')));
+  if exists (select 1 from public.bombas where serial = p_bomba->>'serial' and ativo) then
+    raise exception 'A bomba com o serial ''%'' já está registrada e ativa.', p_bomba->>'serial'
+      using errcode = 'unique_violation';
+  end if;
+
+  insert into public.bombas (serial, hospital, paciente, medico, convenio, data_registro, data_saida, periodo, status, nf, pedido, ativo, filial, nf_devolucao)
+  select r.serial, r.hospital, r.paciente, r.medico, r.convenio, coalesce(r.data_registro, current_date), r.data_saida, r.periodo, r.status, r.nf, r.pedido, true, r.filial, coalesce(r.nf_devolucao, '')
+  from jsonb_populate_record(null::public.bombas, p_bomba) r
+  returning * into nova;
+
+  insert into public.historico (data_evento, descricao, filial)
+  values (p_data_evento, upper(format('BOMBA REGISTRADA (SERIAL: %s)', nova.serial)), nova.filial);
+
+  return to_jsonb(nova);
+end
+$$;
+
+-- Linhas já gravadas pela versão anterior da função
+update public.historico
+set descricao = upper(descricao)
+where descricao like 'BOMBA REGISTRADA (SERIAL: %'
+  and descricao <> upper(descricao);
@@ -0,0 +1,157 @@
+from io import BytesIO
+
+import pytest
+from docx import Document
+from docx.oxml.ns import qn
+from docx.shared import Pt
+
+from contract_pdf import CompiledTemplate, _template_parts
+
+REPLACEMENTS = {
+    "{SERIAL}": "SN-0042",
+    "{PACIENTE}": "Maria José",
+    "{NOTA_FISCAL}": "555",
+    "{DATA_ATUAL}": "Brasília, 05 de Março de 2026",
+}
+
+def _replace_all(text):
+    for key, value in REPLACEMENTS.items():
+        text = text.replace(key, value)
+    return text
+
+# Caminho antigo do fill_contract_docx: troca o placeholder run a run
+def replace_text_in_paragraph(p, replacements):
+    for key, value in replacements.items():
+        if key in p.text:
+            inline = p.runs
+            for i in range(len(inline)):
+                if key in inline[i].text:
+                    inline[i].text = inline[i].text.replace(key, str(value))
+
+def all_paragraphs(doc):
+    """Parágrafos do corpo, de tabelas (inclusive aninhadas), cabeçalhos e rodapés."""
+    def walk(container):
+        for p in container.paragraphs:
+            yield p
+        for table in container.tables:
+            for row in table.rows:
+                for cell in row.cells:
+                    yield from walk(cell)
+    yield from walk(doc)
+    for section in doc.sections:
+        for part in (section.header, section.footer, section.first_page_header, section.first_page_footer):
+            if not part.is_linked_to_previous:
+                yield from walk(part)
+
+def legacy_fill(template_bytes, path):
+    doc = Document(BytesIO(template_bytes))
+    for p in all_paragraphs(doc):
+        replace_text_in_paragraph(p, REPLACEMENTS)
+    doc.save(path)
+    return path
+
+def run_layout(path):
+    """Por parte e parágrafo: (texto, formatação) de cada run."""
+    layout = {}
+    for partname, element in _template_parts(Document(path)).items():
+        layout[partname] = [
+            [("".join(t.text or "" for t in r.iter(qn("w:t"))), r.rPr.xml if r.rPr is not None else "") for r in p.xpath("./w:r")]
+            for p in element.xpath(".//w:p")
+        ]
+    return layout
+
+def paragraph_texts(path):
+    return {partname: ["".join(t.text or "" for t in p.iter(qn("w:t"))) for p in element.xpath(".//w:p")]
+            for partname, element in _template_parts(Document(path)).items()}
+
+def to_bytes(doc):
+    buffer = BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+@pytest.fixture
+def whole_runs_template():
+    """Placeholders inteiros num run: no corpo, em tabela aninhada, cabeçalho e rodapé."""
+    doc = Document()
+    p = doc.add_paragraph("Contrato de comodato ")
+    p.add_run("{SERIAL}").bold = True
+    p.add_run(" entregue a {PACIENTE}, NF {NOTA_FISCAL}.")
+    doc.add_paragraph("Sem placeholders aqui.")
+    doc.add_paragraph("{SERIAL} / {SERIAL}")
+    table = doc.add_table(rows=2, cols=2)
+    table.cell(0, 0).text = "Serial: {SERIAL}"
+    table.cell(0, 1).paragraphs[0].add_run("{PACIENTE}").italic = True
+    nested = table.cell(1, 0).add_table(rows=1, cols=1)
+    nested.cell(0, 0).text = "NF {NOTA_FISCAL}"
+    section = doc.sections[0]
+    section.header.paragraphs[0].text = "Comodato {SERIAL}"
+    section.footer.paragraphs[0].add_run("{DATA_ATUAL}").font.size = Pt(9)
+    return to_bytes(doc)
+
+@pytest.fixture
+def split_runs_template():
+    """Placeholders que o Word dividiu em vários runs, no corpo, em tabela e no rodapé."""
+    doc = Document()
+    p = doc.add_paragraph("Paciente: ")
+    first = p.add_run("{PACI")
+    first.bold = True
+    p.add_run("ENT")
+    p.add_run("E}, serial ")
+    p.add_run("{SER")
+    p.add_run("IAL}.")
+    table = doc.add_table(rows=1, cols=1)
+    cell = table.cell(0, 0).paragraphs[0]
+    cell.add_run("NF {NOTA_")
+    cell.add_run("FISCAL}")
+    footer = doc.sections[0].footer.paragraphs[0]
+    footer.add_run("{DATA")
+    footer.add_run("_ATUAL}")
+    return to_bytes(doc)
+
+def test_whole_runs_match_legacy_path(whole_runs_template, tmp_path):
+    compiled = CompiledTemplate.compile(whole_runs_template)
+    filled = compiled.fill(REPLACEMENTS, tmp_path / "compilado.docx")
+    legacy = legacy_fill(whole_runs_template, tmp_path / "antigo.docx")
+    assert run_layout(filled) == run_layout(legacy)
+
+def test_locations_cover_tables_headers_and_footers(whole_runs_template):
+    compiled = CompiledTemplate.compile(whole_runs_template)
+    assert compiled.placeholders == sorted(REPLACEMENTS)
+    parts = sorted(compiled.locations)
+    assert "/word/document.xml" in parts
+    assert any("header" in name for name in parts) and any("footer" in name for name in parts)
+
+def test_split_runs_are_filled(split_runs_template, tmp_path):
+    compiled = CompiledTemplate.compile(split_runs_template)
+    filled = paragraph_texts(compiled.fill(REPLACEMENTS, tmp_path / "compilado.docx"))
+    expected = {partname: [_replace_all(text) for text in texts]
+                for partname, texts in paragraph_texts(BytesIO(split_runs_template)).items()}
+    assert filled == expected
+
+    # O caminho antigo não encontra placeholders divididos
+    legacy = paragraph_texts(legacy_fill(split_runs_template, tmp_path / "antigo.docx"))
+    assert legacy == paragraph_texts(BytesIO(split_runs_template))
+
+def test_split_value_takes_first_run_formatting(split_runs_template, tmp_path):
+    compiled = CompiledTemplate.compile(split_runs_template)
+    body = run_layout(compiled.fill(REPLACEMENTS, tmp_path / "compilado.docx"))["/word/document.xml"]
+    template = run_layout(BytesIO(split_runs_template))["/word/document.xml"]
+    runs = [text for text, _ in body[0]]
+    assert runs == ["Paciente: ", "Maria José", "", ", serial ", "SN-0042", "."]
+    # A formatação de cada run não muda; o valor fica no run em negrito de "{PACI"
+    assert [fmt for _, fmt in body[0]] == [fmt for _, fmt in template[0]]
+    assert "w:b" in body[0][1][1]
+
+def test_missing_replacements_are_kept(whole_runs_template, tmp_path):
+    compiled = CompiledTemplate.compile(whole_runs_template)
+    partial = {"{SERIAL}": "SN-1"}
+    texts = paragraph_texts(compiled.fill(partial, tmp_path / "parcial.docx"))["/word/document.xml"]
+    assert texts[0] == "Contrato de comodato SN-1 entregue a {PACIENTE}, NF {NOTA_FISCAL}."
+    assert texts[2] == "SN-1 / SN-1"
+
+def test_fill_is_repeatable(whole_runs_template, tmp_path):
+    compiled = CompiledTemplate.compile(whole_runs_template)
+    first = compiled.fill(REPLACEMENTS, tmp_path / "a.docx")
+    second = compiled.fill(dict(REPLACEMENTS, **{"{SERIAL}": "OUTRO"}), tmp_path / "b.docx")
+    assert "SN-0042" in paragraph_texts(first)["/word/document.xml"][0]
+    assert "OUTRO" in paragraph_texts(second)["/word/document.xml"][0]
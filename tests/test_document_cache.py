@@ -0,0 +1,57 @@
+from io import BytesIO
+
+import pytest
+from PyPDF2 import PdfReader, PdfWriter
+
+import contract_pdf
+
+def blank_pdf(pages=1):
+    writer = PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(width=200, height=200)
+    buffer = BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+@pytest.fixture
+def renderer(tmp_path, monkeypatch):
+    """Contrato de uma página por sobreposição e cache de documentos num diretório temporário."""
+    template = tmp_path / "contrato.docx"
+    template.write_bytes(b"modelo")
+    contract = tmp_path / "contrato.pdf"
+    contract.write_bytes(blank_pdf())
+    cache = contract_pdf.DocumentCache(str(tmp_path / "documentos"))
+    monkeypatch.setattr(contract_pdf, "get_document_cache", lambda: cache)
+    monkeypatch.setattr(contract_pdf, "render_overlay", lambda *args: str(contract))
+    return str(template), cache
+
+def pages(data):
+    return len(PdfReader(BytesIO(data if isinstance(data, bytes) else data.getvalue())).pages)
+
+def failing_fetch(serial):
+    raise ConnectionError("storage fora do ar (simulado)")
+
+def test_failed_annex_is_not_cached(renderer):
+    template, cache = renderer
+    bomba = {"serial": "SN1", "paciente": "MARIA", "nf": "10"}
+    assert pages(contract_pdf.render_contract(template, bomba, failing_fetch, annex_etag="etag-1")) == 1
+    # Com o anexo de volta, o documento completo é gerado em vez de vir do cache
+    assert pages(contract_pdf.render_contract(template, bomba, lambda serial: blank_pdf(2), annex_etag="etag-1")) == 3
+    assert pages(contract_pdf.render_contract(template, bomba, failing_fetch, annex_etag="etag-1")) == 3
+    assert cache.hits == 1
+
+def test_missing_annex_is_cached(renderer):
+    template, cache = renderer
+    bomba = {"serial": "SN2", "paciente": "JOSE", "nf": "11"}
+    contract_pdf.render_contract(template, bomba, lambda serial: None, annex_etag="")
+    contract_pdf.render_contract(template, bomba, lambda serial: None, annex_etag="")
+    assert cache.hits == 1
+
+def test_batch_skips_cache_for_failed_annex(renderer):
+    template, cache = renderer
+    bombas = [{"serial": "SN3", "paciente": "ANA", "nf": "12"}, {"serial": "SN4", "paciente": "RUI", "nf": "13"}]
+    fetch = lambda serial: failing_fetch(serial) if serial == "SN3" else blank_pdf(2)
+    _, failures = contract_pdf.render_contracts(template, bombas, fetch, annex_etag=lambda serial: "etag-" + serial)
+    assert failures == []
+    _, failures = contract_pdf.render_contracts(template, bombas, lambda serial: blank_pdf(2), annex_etag=lambda serial: "etag-" + serial)
+    assert cache.hits == 1  # só SN4 estava no cache; SN3 foi gerado de novo, agora com o anexo
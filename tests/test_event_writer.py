@@ -0,0 +1,48 @@
+import event_writer
+
+def make_sink(received, down):
+    def sink(events):
+        if down[0]:
+            raise ConnectionError("destino fora do ar (simulado)")
+        received.extend(events)
+    return sink
+
+def attempts(writer):
+    return [row[0] for row in writer._conn.execute("SELECT tentativas FROM eventos ORDER BY id")]
+
+def test_long_outage_keeps_every_event(tmp_path):
+    received, down = [], [True]
+    journal = str(tmp_path / "historico.sqlite3")
+    writer = event_writer.EventWriter(make_sink(received, down), journal, batch_size=5)
+    writer.append([{"descricao": f"EVENTO {i}"} for i in range(12)])
+    # Bem mais falhas que qualquer limite: nada é descartado nem deixa de ser reservado
+    for _ in range(50):
+        assert writer._drain() is False
+    assert attempts(writer) == [0] * 12
+    assert writer.metrics()["pendentes"] == 12
+
+    # Depois de reiniciar, o novo gravador ainda vê e envia todos os eventos
+    down[0] = False
+    writer = event_writer.EventWriter(make_sink(received, down), journal, batch_size=5)
+    assert writer.metrics()["pendentes"] == 12
+    assert writer._drain() is True
+    assert [event["descricao"] for event in received] == [f"EVENTO {i}" for i in range(12)]
+    assert writer.metrics()["pendentes"] == 0
+
+def test_only_rejections_count_attempts(tmp_path):
+    received, down = [], [False]
+    deliver = make_sink(received, down)
+    def sink(events):
+        if not down[0] and any(event["filial"] is None for event in events):
+            raise ValueError("null value in column \"filial\" (simulado)")
+        deliver(events)
+    writer = event_writer.EventWriter(sink, str(tmp_path / "historico.sqlite3"), batch_size=4, is_rejected=lambda e: isinstance(e, ValueError))
+    writer.append([{"filial": "GOIANIA", "n": 1}, {"filial": None, "n": 2}, {"filial": "GOIANIA", "n": 3}])
+    down[0] = True
+    assert writer._drain() is False
+    assert attempts(writer) == [0, 0, 0]
+    down[0] = False
+    assert writer._drain() is True
+    assert [event["n"] for event in received] == [1, 3]
+    rejected = writer._conn.execute("SELECT payload FROM rejeitados").fetchall()
+    assert len(rejected) == 1 and '"n": 2' in rejected[0][0]
@@ -0,0 +1,156 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import analyze_curativo as ac
+
+# Cálculos originais, KPI a KPI, sobre a planilha inteira (antes de aggregate_kpi_rows)
+def baseline_kpis(df):
+    status_counts = df['Status Utili'].value_counts()
+    status_percentages = round(status_counts / status_counts.sum() * 100, 2)
+    sales_df = df[df['Status Utili'].isin(['Utilizado', 'Finalizado'])]
+    product_counts = sales_df['Desc Produto'].value_counts().head(5)
+    revenue_by_status = df.groupby('Status Utili')['Valor Cotado'].sum().round(2)
+    finalized_df = df[df['Status Utili'] == 'Finalizado']
+    revenue_by_product = finalized_df.groupby('Desc Produto')['Valor Cotado'].sum().nlargest(5).round(2)
+    client_sales = sales_df.groupby('Nome Cli').agg({'Desc Produto': 'count', 'Valor Cotado': 'sum'})
+    client_sales = client_sales.rename(columns={'Desc Produto': 'Sales Count', 'Valor Cotado': 'Revenue'}).nlargest(5, 'Sales Count')
+    client_sales['Revenue'] = client_sales['Revenue'].round(2)
+    total = len(df)
+    loss_rate = round(len(df[df['Status Utili'] == 'Não Encontrado']) / total * 100, 2) if total > 0 else 0
+    if finalized_df.empty:
+        avg_days = 0
+    else:
+        avg_days = (finalized_df['Dt Apont Uti'] - finalized_df['Dt Procedime']).dt.days.mean().round(2)
+    sales_df = sales_df.assign(Month=sales_df['Dt Procedime'].dt.to_period('M'))
+    sales_by_month = sales_df.groupby('Month').agg({'Desc Produto': 'count', 'Valor Cotado': 'sum'})
+    sales_by_month = sales_by_month.rename(columns={'Desc Produto': 'Sales Count', 'Valor Cotado': 'Revenue'})
+    sales_by_month['Revenue'] = sales_by_month['Revenue'].round(2)
+    return {
+        'status_df': pd.DataFrame({'Status': status_percentages.index, 'Percentage': status_percentages.values}),
+        'product_df': pd.DataFrame({'Product': product_counts.index, 'Count': product_counts.values}),
+        'revenue_status_df': pd.DataFrame({'Status': revenue_by_status.index, 'Revenue': revenue_by_status.values}),
+        'revenue_product_df': pd.DataFrame({'Product': revenue_by_product.index, 'Revenue': revenue_by_product.values}),
+        'client_sales': client_sales,
+        'loss_rate': loss_rate,
+        'avg_days_to_invoice': avg_days,
+        'sales_by_month': sales_by_month,
+    }
+
+def make_curativo(n_rows, seed):
+    """Planilha sintética no formato do bdcurativo, com vazios, empates e valores '- 0'."""
+    rng = np.random.default_rng(seed)
+    dates = pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 365, n_rows), unit='D')
+    df = pd.DataFrame({
+        'Status Utili': rng.choice(['Utilizado', 'Finalizado', 'Disponível', 'Não Encontrado', None], n_rows),
+        'Desc Produto': rng.choice([f'PRODUTO {i}' for i in range(8)] + [None], n_rows),
+        'Nome Cli': rng.choice([f'CLIENTE {i}' for i in range(7)] + [None], n_rows),
+        'Valor Cotado': rng.choice(['- 0', '', '150.5', '89.9', '10'], n_rows),
+        'Dt Procedime': dates.strftime('%d/%m/%Y'),
+        'Dt Apont Uti': (dates + pd.to_timedelta(rng.integers(0, 30, n_rows), unit='D')).strftime('%d/%m/%Y'),
+    })
+    df.loc[rng.random(n_rows) < 0.1, 'Dt Apont Uti'] = None
+    return df
+
+@pytest.fixture(scope='module', params=[(40, 1), (300, 2)], ids=['40-linhas', '300-linhas'])
+def workbook(request, tmp_path_factory):
+    n_rows, seed = request.param
+    path = tmp_path_factory.mktemp('curativo') / 'bdcurativo.xlsx'
+    make_curativo(n_rows, seed).to_excel(path, index=False)
+    return str(path)
+
+@pytest.fixture(scope='module')
+def expected(workbook):
+    return baseline_kpis(ac.read_curativo_xlsx(workbook))
+
+@pytest.fixture(scope='module')
+def kpis(workbook):
+    return ac.compute_kpis(ac.aggregate_kpi_rows(ac.read_curativo_xlsx(workbook)))
+
+@pytest.fixture(scope='module')
+def streamed_kpis(workbook):
+    return ac.compute_kpis(ac.aggregate_kpi_stream(workbook, chunk_rows=7))
+
+def assert_kpi_equal(result, expected):
+    if isinstance(expected, pd.DataFrame):
+        pd.testing.assert_frame_equal(result, expected, check_dtype=False, check_index_type=False, check_names=False)
+    elif pd.isna(expected):
+        assert pd.isna(result)
+    else:
+        assert result == expected
+
+@pytest.mark.parametrize('name', sorted(ac.KPI_REGISTRY))
+def test_kpi_matches_baseline(kpis, expected, name):
+    assert_kpi_equal(kpis[name], expected[name])
+
+@pytest.mark.parametrize('name', sorted(ac.KPI_REGISTRY))
+def test_streaming_kpi_matches_baseline(streamed_kpis, expected, name):
+    assert_kpi_equal(streamed_kpis[name], expected[name])
+
+def test_registry_covers_dashboard_kpis():
+    assert set(ac.KPI_REGISTRY) == set(baseline_kpis(ac.clean_curativo_df(make_curativo(5, 0))))
+
+def test_empty_workbook(tmp_path):
+    path = tmp_path / 'vazio.xlsx'
+    make_curativo(0, 0).to_excel(path, index=False)
+    result = ac.compute_kpis(ac.aggregate_kpi_stream(str(path)))
+    assert result['loss_rate'] == 0
+    assert result['avg_days_to_invoice'] == 0
+    assert result['status_df'].empty and result['client_sales'].empty
+
+def kpi_tables_equal(result, expected):
+    for name in ac.KPI_TABLES:
+        pd.testing.assert_frame_equal(result[name], expected[name], check_dtype=False)
+
+@pytest.fixture(scope='module')
+def versions():
+    """Versão anterior e a seguinte com linhas acrescentadas ao fim (novos clientes e produtos)."""
+    old = ac.clean_curativo_df(make_curativo(200, 3))
+    extra = make_curativo(60, 4)
+    extra['Nome Cli'] = extra['Nome Cli'].replace('CLIENTE 1', 'CLIENTE NOVO')
+    new = ac.clean_curativo_df(pd.concat([make_curativo(200, 3), extra], ignore_index=True))
+    return old, new
+
+def test_delta_aggregates_only_appended_rows(versions, monkeypatch):
+    old, new = versions
+    _, state = ac.aggregate_kpi_delta([old])
+    aggregated = []
+    aggregate = ac.aggregate_kpi_rows
+    monkeypatch.setattr(ac, 'aggregate_kpi_rows', lambda df: aggregated.append(len(df)) or aggregate(df))
+    tables, new_state = ac.aggregate_kpi_delta([new.iloc[:150], new.iloc[150:230], new.iloc[230:]], state)
+    assert aggregated == [30, 30]
+    kpi_tables_equal(tables, aggregate(new))
+    assert new_state['rows'] == len(new) and new_state['digest'] == ac.aggregate_kpi_delta([new])[1]['digest']
+
+def test_delta_without_new_rows_reuses_tables(versions):
+    old, _ = versions
+    tables, state = ac.aggregate_kpi_delta([old])
+    assert ac.aggregate_kpi_delta([old.iloc[:50], old.iloc[50:]], state)[0] is tables
+
+@pytest.mark.parametrize('change', ['editada', 'removida', 'colunas'])
+def test_delta_falls_back_when_old_rows_change(versions, change):
+    old, new = versions
+    _, state = ac.aggregate_kpi_delta([old])
+    new = new.copy()
+    if change == 'editada':
+        new.loc[10, 'Valor Cotado'] += 1
+    elif change == 'removida':
+        new = new.drop(index=10).reset_index(drop=True)
+        new.attrs = old.attrs
+    else:
+        new.attrs = {'source_columns': old.attrs['source_columns'] + ['Observação']}
+    assert ac.aggregate_kpi_delta([new], state) is None
+
+def test_delta_falls_back_on_fewer_rows(versions):
+    old, _ = versions
+    _, state = ac.aggregate_kpi_delta([old])
+    assert ac.aggregate_kpi_delta([old.iloc[:150]], state) is None
+
+def test_streamed_delta_matches_full_read(tmp_path):
+    path = tmp_path / 'bdcurativo.xlsx'
+    pd.concat([make_curativo(200, 3), make_curativo(60, 4)], ignore_index=True).to_excel(path, index=False)
+    head = tmp_path / 'anterior.xlsx'
+    make_curativo(200, 3).to_excel(head, index=False)
+    _, state = ac.aggregate_kpi_delta(ac.iter_curativo_chunks(str(head), chunk_rows=64))
+    tables, _ = ac.aggregate_kpi_delta(ac.iter_curativo_chunks(str(path), chunk_rows=64), state)
+    kpi_tables_equal(tables, ac.aggregate_kpi_rows(ac.read_curativo_xlsx(str(path))))
@@ -0,0 +1,56 @@
+from io import BytesIO
+
+from PyPDF2 import PageObject, PdfReader, PdfWriter
+from PyPDF2.generic import DecodedStreamObject, DictionaryObject, NameObject
+
+import contract_pdf
+
+PLACEHOLDERS = ["{NOTA_FISCAL}", "{PACIENTE}", "{SERIAL}"]
+
+def make_pdf(content):
+    """PDF de uma página em Helvetica com o content stream `content`."""
+    writer = PdfWriter()
+    page = PageObject.create_blank_page(width=595, height=842)
+    font = DictionaryObject({
+        NameObject("/Type"): NameObject("/Font"), NameObject("/Subtype"): NameObject("/Type1"),
+        NameObject("/BaseFont"): NameObject("/Helvetica"), NameObject("/Encoding"): NameObject("/WinAnsiEncoding"),
+    })
+    page[NameObject("/Resources")] = DictionaryObject({NameObject("/Font"): DictionaryObject({NameObject("/F1"): font})})
+    stream = DecodedStreamObject()
+    stream.set_data(content)
+    page[NameObject("/Contents")] = stream
+    writer.add_page(page)
+    buffer = BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+LINES = [
+    b"BT /F1 11 Tf 72 760 Td (Contrato de comodato da bomba {SERIAL}) Tj ET",
+    b"BT /F1 11 Tf 72 740 Td (Paciente: {PACIENTE}) Tj ET",
+    b"BT /F1 11 Tf 72 720 Td (Nota fiscal {NOTA_FISCAL}) Tj ET",
+]
+
+def page_text(pdf):
+    return PdfReader(BytesIO(pdf)).pages[0].extract_text()
+
+def test_all_placeholders_located_renders():
+    overlay = contract_pdf.compile_overlay_template(make_pdf(b"\n".join(LINES)), PLACEHOLDERS)
+    assert overlay is not None
+    text = page_text(overlay.render({"{SERIAL}": "SN-1", "{PACIENTE}": "MARIA", "{NOTA_FISCAL}": "55"}))
+    assert "SN-1" in text and "MARIA" in text and "{" not in text
+
+def test_placeholder_missing_from_pdf_falls_back():
+    # O extrator não achou {NOTA_FISCAL} (codificação, tabela, ligadura): sem sobreposição
+    pdf = make_pdf(b"\n".join(LINES[:2] + [b"BT /F1 11 Tf 72 720 Td (Nota fiscal) Tj ET"]))
+    assert contract_pdf.compile_overlay_template(pdf) is not None
+    assert contract_pdf.compile_overlay_template(pdf, PLACEHOLDERS) is None
+
+def test_placeholder_not_in_docx_falls_back():
+    assert contract_pdf.compile_overlay_template(make_pdf(b"\n".join(LINES)), ["{SERIAL}", "{PACIENTE}"]) is None
+
+def test_justified_line_falls_back():
+    justified = b"BT /F1 11 Tf 2.5 Tw 72 740 Td (Paciente: {PACIENTE} em comodato) Tj ET"
+    assert contract_pdf.compile_overlay_template(make_pdf(b"\n".join([LINES[0], justified, LINES[2]])), PLACEHOLDERS) is None
+    # Tw só antes do placeholder (texto que não é reescrito) não impede a sobreposição
+    before = b"BT /F1 11 Tf 72 740 Td 2.5 Tw (Paciente: ) Tj 0 Tw ({PACIENTE}) Tj ET"
+    assert contract_pdf.compile_overlay_template(make_pdf(b"\n".join([LINES[0], before, LINES[2]])), PLACEHOLDERS) is not None
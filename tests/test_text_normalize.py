@@ -0,0 +1,36 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+import text_normalize
+
+VALUES = pd.Series(["  Goiânia ", "BRASÍLIA", None, "Cuiabá", "  Goiânia ", np.nan, 42, "São José"], index=range(10, 18))
+
+def test_series_matches_normalize_text():
+    memo = text_normalize.NormalizedTextMemo()
+    expected = VALUES.map(text_normalize.normalize_text)
+    assert memo.series(VALUES).equals(expected)
+    assert memo.series(VALUES).equals(expected)  # memo quente
+    assert memo.series(VALUES).tolist()[:4] == ["GOIANIA", "BRASILIA", "", "CUIABA"]
+
+def test_memo_is_cleared_past_max_size():
+    memo = text_normalize.NormalizedTextMemo(max_size=5)
+    memo.series(pd.Series([f"nome {i}" for i in range(4)]))
+    assert len(memo) == 4
+    memo.series(pd.Series([f"outro {i}" for i in range(3)]))
+    assert len(memo) == 3
+
+def test_concurrent_sessions_with_small_memo():
+    memo = text_normalize.NormalizedTextMemo(max_size=50)
+    names = np.array([f"Hospital São José {i}" for i in range(200)], dtype=object)
+    errors = []
+    def session(seed):
+        sample = pd.Series(np.random.default_rng(seed).choice(names, 500))
+        for _ in range(5):
+            if not memo.series(sample).equals(sample.map(text_normalize.normalize_text)):
+                errors.append(seed)
+    threads = [threading.Thread(target=session, args=(seed,)) for seed in range(6)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    assert errors == []
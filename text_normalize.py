@@ -0,0 +1,107 @@
+import logging
+import sys
+import threading
+import time
+import unicodedata
+import numpy as np
+import pandas as pd
+
+def normalize_text(text):
+    """Sem acentos, maiúsculas e sem espaços nas pontas; "" para o que não é str."""
+    if not isinstance(text, str):
+        return ""
+    return unicodedata.normalize('NFKD', text).encode('ASCII', 'ignore').decode('ASCII').upper().strip()
+
+def normalize_texts(texts):
+    """normalize_text para uma lista de str, vetorizado com pyarrow.compute quando disponível."""
+    try:
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        arr = pc.utf8_normalize(pa.array(texts, type=pa.string()), "NFKD")
+        arr = pc.replace_substring_regex(arr, r"[^\x00-\x7f]", "")
+        return pc.ascii_trim_whitespace(pc.ascii_upper(arr)).to_pylist()
+    except Exception:
+        return [normalize_text(text) for text in texts]
+
+class NormalizedTextMemo:
+    """
+    Memo (valor original -> normalize_text(valor)) compartilhado entre sessões. O
+    dicionário só é lido e alterado com o lock; ao passar de `max_size` entradas, é
+    esvaziado antes de receber as novas.
+    """
+
+    def __init__(self, max_size=200_000):
+        self.max_size = max_size
+        self._memo = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._memo)
+
+    def clear(self):
+        with self._lock:
+            self._memo.clear()
+
+    def series(self, values):
+        """
+        normalize_text vetorizado para uma Series. Cada valor distinto é normalizado uma
+        única vez; os já vistos vêm do memo. Os valores novos são normalizados fora do lock.
+        """
+        codes, uniques = pd.factorize(values)
+        uniques = np.asarray(uniques, dtype=object).tolist()
+        with self._lock:
+            normalized = [self._memo.get(value) for value in uniques]
+        unseen = [value for value, text in zip(uniques, normalized) if text is None]
+        if unseen:
+            texts = [value for value in unseen if isinstance(value, str)]
+            fresh = dict.fromkeys(unseen, "")
+            fresh.update(zip(texts, normalize_texts(texts)))
+            with self._lock:
+                if len(self._memo) + len(fresh) > self.max_size:
+                    self._memo.clear()
+                self._memo.update(fresh)
+            normalized = [fresh[value] if text is None else text for value, text in zip(uniques, normalized)]
+        # Código -1 (valor ausente) aponta para o "" no fim da tabela
+        lookup = np.array(normalized + [""], dtype=object)
+        return pd.Series(lookup[codes], index=values.index)
+
+def benchmark_normalize(n_rows=100_000, n_threads=8):
+    """Compara normalize_text linha a linha com NormalizedTextMemo.series (memo frio e quente) e roda sessões concorrentes."""
+    rng = np.random.default_rng(0)
+    nomes = np.array([f"Hospital São José {i}" for i in range(5_000)] + ["  Goiânia ", "BRASÍLIA", "Cuiabá", None], dtype=object)
+    values = pd.Series(rng.choice(nomes, n_rows))
+    start = time.perf_counter()
+    expected = values.map(normalize_text)
+    print(f"Linhas: {n_rows}, valores distintos: {values.nunique()}")
+    print(f"normalize_text por linha: {time.perf_counter() - start:.3f}s")
+    memo = NormalizedTextMemo()
+    for label in ("memo frio", "memo quente"):
+        start = time.perf_counter()
+        result = memo.series(values)
+        print(f"series ({label}): {time.perf_counter() - start:.3f}s")
+        assert result.equals(expected)
+
+    # Memo pequeno: as sessões concorrentes limpam o memo enquanto as outras consultam
+    memo = NormalizedTextMemo(max_size=1_000)
+    errors = []
+    def session(seed):
+        sample = pd.Series(np.random.default_rng(seed).choice(nomes, n_rows // n_threads))
+        for _ in range(5):
+            try:
+                if not memo.series(sample).equals(sample.map(normalize_text)):
+                    errors.append("resultado diferente")
+            except Exception as e:
+                errors.append(repr(e))
+    threads = [threading.Thread(target=session, args=(seed,)) for seed in range(n_threads)]
+    start = time.perf_counter()
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    print(f"{n_threads} sessões concorrentes com memo limitado a {memo.max_size}: {time.perf_counter() - start:.3f}s, {len(errors)} erros {errors[:3]}")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if len(sys.argv) > 1 and sys.argv[1] == "--benchmark":
+        benchmark_normalize(*(int(arg) for arg in sys.argv[2:4]))
+    else:
+        print("Uso: python text_normalize.py --benchmark [n_linhas] [n_sessoes]")